@@ -0,0 +1,71 @@
+"""
+Measure the cost of debug logging on the merge path with debug logging disabled.
+
+Builds a large set of reasoner responses, merges them, and logs the merged knowledge graph
+the way the interpreter used to (an eagerly formatted f-string) and the way it does now
+(LazyJSON passed as a logger argument).
+
+    PYTHONPATH=. python bench/bench_logging.py [--responses 20] [--nodes 500] [--repeat 3]
+"""
+import argparse
+import copy
+import json
+import logging
+import time
+from tranql.main import TranQL
+from tranql.tranql_ast import SelectStatement
+from tranql.util import LazyJSON
+
+logger = logging.getLogger ("bench")
+logger.setLevel (logging.INFO)
+
+def make_response (index, nodes):
+    """ A reasoner response with a chain of nodes, edges and one answer per edge. """
+    kg_nodes = [ { "id" : f"CHEBI:{index}-{n}", "type" : "chemical_substance", "name" : f"chemical {n}" }
+                 for n in range(nodes) ]
+    kg_edges = [ { "id" : f"e{index}-{n}", "type" : "affects",
+                   "source_id" : kg_nodes[n]['id'], "target_id" : kg_nodes[n+1]['id'] }
+                 for n in range(nodes - 1) ]
+    knowledge_map = [ { "node_bindings" : { "chemical_substance" : e['source_id'] },
+                        "edge_bindings" : { "e0" : e['id'] } } for e in kg_edges ]
+    return {
+        "knowledge_graph" : { "nodes" : kg_nodes, "edges" : kg_edges },
+        "knowledge_map" : knowledge_map
+    }
+
+def timed (function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter ()
+        function ()
+        elapsed = time.perf_counter () - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main ():
+    parser = argparse.ArgumentParser (description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument ('--responses', type=int, default=20)
+    parser.add_argument ('--nodes', type=int, default=500)
+    parser.add_argument ('--repeat', type=int, default=3)
+    args = parser.parse_args ()
+
+    tranql = TranQL ()
+    tranql.resolve_names = False
+    """ Merging needs no schema, so skip the constructor and the schema load it triggers. """
+    statement = SelectStatement.__new__ (SelectStatement)
+    responses = [ make_response (i, args.nodes) for i in range(args.responses) ]
+    merged = statement.merge_results (copy.deepcopy (responses), "bench", tranql)
+
+    merge = timed (lambda: statement.merge_results (copy.deepcopy (responses), "bench", tranql), args.repeat)
+    eager = timed (lambda: logger.debug (f"{json.dumps(merged, indent=2)}"), args.repeat)
+    lazy = timed (lambda: logger.debug ("%s", LazyJSON (merged)), args.repeat)
+
+    print (f"responses={args.responses} nodes/response={args.nodes} "
+           f"merged nodes={len(merged['knowledge_graph']['nodes'])} "
+           f"edges={len(merged['knowledge_graph']['edges'])}")
+    print (f"merge                         {merge:10.4f}s")
+    print (f"debug log, eager f-string     {eager:10.4f}s")
+    print (f"debug log, LazyJSON           {lazy:10.6f}s")
+
+if __name__ == "__main__":
+    main ()
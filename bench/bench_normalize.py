@@ -0,0 +1,56 @@
+"""
+Time backplane normalization of 0.9 messages with large results payloads.
+
+Each result has a small result graph drawn from a shared pool of nodes and edges, the way
+ROBOKOP and RTX answers overlap, so most nodes and edges are duplicates.
+
+    PYTHONPATH=. python bench/bench_normalize.py [--results 1000 5000 20000] [--repeat 3]
+"""
+import argparse
+import copy
+import random
+import time
+from tranql.backplane.server import StandardAPIResource
+
+def make_message (result_count, pool_size):
+    random.seed (result_count)
+    results = []
+    for i in range (result_count):
+        a, b = random.randrange (pool_size), random.randrange (pool_size)
+        nodes = [ { "id" : f"CHEBI:{a}", "type" : "chemical_substance" },
+                  { "id" : f"MONDO:{b}", "type" : "disease" } ]
+        edges = [ { "id" : f"e{a}-{b}", "type" : "treats",
+                    "source_id" : f"CHEBI:{a}", "target_id" : f"MONDO:{b}" } ]
+        results.append ({
+            "node_bindings" : { "n0" : nodes[0]['id'], "n1" : nodes[1]['id'] },
+            "edge_bindings" : { "e0" : edges[0]['id'] },
+            "result_graph" : { "nodes" : nodes, "edges" : edges }
+        })
+    return { "question_graph" : { "nodes" : [], "edges" : [] }, "results" : results }
+
+def timed (function, messages):
+    best = None
+    for message in messages:
+        start = time.perf_counter ()
+        result = function (message)
+        elapsed = time.perf_counter () - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main ():
+    parser = argparse.ArgumentParser (description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument ('--results', type=int, nargs='+', default=[ 1000, 5000, 20000 ])
+    parser.add_argument ('--repeat', type=int, default=3)
+    args = parser.parse_args ()
+
+    resource = StandardAPIResource ()
+    print (f"{'results':>8} {'nodes':>8} {'edges':>8} {'normalize':>12}")
+    for count in args.results:
+        message = make_message (count, pool_size=count)
+        messages = [ copy.deepcopy (message) for i in range (args.repeat) ]
+        elapsed, result = timed (resource.normalize_message, messages)
+        kg = result['knowledge_graph']
+        print (f"{count:>8} {len(kg['nodes']):>8} {len(kg['edges']):>8} {elapsed*1000:10.2f}ms")
+
+if __name__ == "__main__":
+    main ()
@@ -0,0 +1,56 @@
+"""
+Compare JSON serializers and response compression on the test mock payloads.
+
+    PYTHONPATH=. python bench/bench_serialization.py [--repeat 20]
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import time
+from tranql import serialization
+
+def timed (function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter ()
+        function ()
+        elapsed = time.perf_counter () - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main ():
+    parser = argparse.ArgumentParser (description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument ('--repeat', type=int, default=20)
+    args = parser.parse_args ()
+
+    mock_dir = os.path.join (os.path.dirname (__file__), "..", "tranql", "tests", "mock")
+    payloads = []
+    for file_name in sorted (glob.glob (os.path.join (mock_dir, "*.json"))):
+        with open (file_name) as stream:
+            payloads.append ((os.path.basename (file_name), json.load (stream)))
+
+    print (f"{'payload':40} {'bytes':>9} " +
+           " ".join ([ f"{name:>10}" for name in serialization.serializers ]) +
+           f" {'gzip':>16} {'br':>16}")
+    for name, payload in payloads:
+        timings = []
+        for serializer_name in serialization.serializers:
+            serializer = serialization.serializers[serializer_name] ()
+            timings.append (timed (lambda: serializer.dumps (payload), args.repeat))
+        data = serialization.JSONSerializer ().dumps (payload)
+        compressed = []
+        for coding in [ "gzip", "br" ]:
+            if coding == "br" and serialization.brotli is None:
+                compressed.append (f"{'n/a':>16}")
+                continue
+            elapsed = timed (lambda: serialization.compress (data, coding), args.repeat)
+            size = len(serialization.compress (data, coding))
+            compressed.append (f"{size:>8} {elapsed*1000:6.2f}ms")
+        print (f"{name:40} {len(data):>9} " +
+               " ".join ([ f"{t*1000:8.3f}ms" for t in timings ]) + " " +
+               " ".join (compressed))
+
+if __name__ == "__main__":
+    main ()
@@ -6,6 +6,8 @@ import argparse
 import json
 import logging
 import os
+import queue
+import threading
 import traceback
 import yaml
 import jsonschema
@@ -18,9 +20,16 @@ from tranql.concept import ConceptModel
 from tranql.main import TranQL
 import networkx as nx
 from tranql.util import JSONKit
+from tranql.util import LazyJSON
 from tranql.tranql_schema import GraphTranslator, Schema
 from tranql.concept import BiolinkModelWalker
-from tranql.exception import TranQLException
+from tranql.exception import TranQLException, QueryCancelledError
+from tranql.config import Config
+from tranql.instrumentation import configure_exporter
+from tranql.metrics import instrument
+from tranql.capture import capture, configure_capture
+from tranql.serialization import configure_serialization, dumps
+from tranql.jobs import Job, JobManager
 #import flask_monitoringdashboard as dashboard
 
 logger = logging.getLogger (__name__)
@@ -39,6 +48,18 @@ app.config['SWAGGER'] = {
     'uiversion': 3
 }
 swagger = Swagger(app) #, template=template)
+instrument (app, "api")
+
+config = Config ("conf.yml")
+configure_exporter (config.get ('TRACE_EXPORTER'))
+configure_capture (config)
+configure_serialization (app, api, config)
+
+ndjson_mimetype = "application/x-ndjson"
+
+""" Queries submitted to run in the background. """
+jobs = JobManager (workers=int(config.get ('JOB_WORKERS', 4)),
+                   ttl=int(config.get ('JOB_TTL', 3600)))
 
 class StandardAPIResource(Resource):
     def validate (self, request):
@@ -50,7 +71,7 @@ class StandardAPIResource(Resource):
         try:
             jsonschema.validate(request.json, to_validate)
         except jsonschema.exceptions.ValidationError as error:
-            logging.error (f"ERROR: {str(error)}")
+            logger.error ("ERROR: %s", error)
             abort(Response(str(error), 400))
     def handle_exception (self, e, warning=False):
         result = {}
@@ -191,6 +212,15 @@ class TranQLQuery(StandardAPIResource):
                         properties:
                             query:
                                 type: string
+                            timings:
+                                type: boolean
+                                description: Include per phase timing spans in the response.
+                            async:
+                                type: boolean
+                                description: Run the query as a job. Respond at once with a job id to poll at /tranql/jobs/{job_id}.
+                            stream:
+                                type: boolean
+                                description: Respond with newline delimited JSON records (node, edge, answer, then summary) sent as the result is merged. Also chosen by accepting application/x-ndjson.
         responses:
             '200':
                 description: Success
@@ -199,6 +229,12 @@ class TranQLQuery(StandardAPIResource):
                         schema:
                             type: string
                             example: "Successfully validated"
+            '202':
+                description: Accepted as a job
+                content:
+                    application/json:
+                        schema:
+                            type: object
             '400':
                 description: Malformed message
                 content:
@@ -208,25 +244,129 @@ class TranQLQuery(StandardAPIResource):
 
         """
         #self.validate (request)
+        if self.wants_job (request.json, request.args):
+            job = jobs.submit (request.json.get ('query', ''),
+                               traceparent=request.headers.get ('traceparent'))
+            return self.job_accepted (job), 202
+        if self.wants_stream (request.json, request.args, request.headers):
+            return Response (
+                self.stream_query (request.json.get ('query', ''),
+                                   request.headers.get ('traceparent'),
+                                   request.json, request.args),
+                mimetype=ndjson_mimetype)
         result = {}
         tranql = TranQL ()
         try:
-            logging.debug (request.json)
+            logger.debug ("%s", LazyJSON (request.json))
             query = request.json['query'] if 'query' in request.json else ''
-            logging.debug (f"--> query: {query}")
-            context = tranql.execute (query) #, cache=True)
-            result = context.mem.get ('result', {})
-            logger.debug (f" -- backplane: {context.mem.get('backplane', '')}")
-            if len(context.mem.get ('requestErrors', [])) > 0:
-                errors = self.handle_exception(context.mem['requestErrors'], warning=True)
-                for key in errors:
-                    result[key] = errors[key]
+            logger.debug ("--> query: %s", query)
+            context = tranql.execute (query, traceparent=request.headers.get ('traceparent')) #, cache=True)
+            result = self.query_result (context)
         except Exception as e:
-            traceback.print_exc()
-            errors = [e, *tranql.context.mem.get ('requestErrors', [])]
-            result = self.handle_exception (errors)
-        with open ('query.out', 'w') as stream:
-            json.dump (result, stream, indent=2)
+            result = self.query_failure (tranql, e)
+        return self.finish_query (tranql, result, request.json, request.args)
+
+    def wants_job (self, body, args):
+        return body.get ('async', False) or args.get ('async', 'false') == 'true'
+
+    def job_accepted (self, job):
+        result = job.to_dict ()
+        result['url'] = f"/tranql/jobs/{job.id}"
+        return result
+
+    def wants_stream (self, body, args, headers):
+        return body.get ('stream', False) or args.get ('stream', 'false') == 'true' or \
+            ndjson_mimetype in headers.get ('accept', '')
+
+    def stream_query (self, query, traceparent, body, args):
+        """
+        Execute a program as a job, yielding NDJSON records. If the final statement is a select, its
+        nodes, edges and knowledge map entries are sent as they are merged, and not kept, followed by
+        a summary holding the rest of the result. Otherwise the whole result is sent as one record.
+        Failures are reported in an error record. A bounded queue keeps a slow client from piling up
+        records. Streamed queries share the job pool, so they wait their turn like other jobs.
+        """
+        records = queue.Queue (maxsize=1000)
+        end = object ()
+        closed = threading.Event ()
+        finished = threading.Event ()
+        def put (record):
+            while not closed.is_set ():
+                try:
+                    records.put (record, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+            raise QueryCancelledError ("The client went away.")
+        def sink (kind, item):
+            put ({ "type" : kind, kind : item })
+        def done (future):
+            """ Called on the job loop, so it must not wait for the client. """
+            finished.set ()
+            try:
+                records.put_nowait (end)
+            except queue.Full:
+                pass
+        job = jobs.submit (query, traceparent=traceparent, sink=sink)
+        job.future.add_done_callback (done)
+        try:
+            while True:
+                try:
+                    record = records.get (timeout=1)
+                except queue.Empty:
+                    if finished.is_set ():
+                        break
+                    continue
+                if record is end:
+                    break
+                yield dumps (record) + b"\n"
+            record = self.job_record (job)
+            if record is not None:
+                if job.tranql is not None and (body.get ('timings', False) or args.get ('timings', 'false') == 'true'):
+                    record['timings'] = job.tranql.instrumentation.to_dict ()
+                yield dumps (record) + b"\n"
+        finally:
+            closed.set ()
+            jobs.cancel (job.id)
+
+    def job_record (self, job):
+        """ The last record of a streamed job: a summary of its result, its result, an error, or None if cancelled. """
+        if job.status == Job.DONE:
+            result = self.query_result (job.context)
+            if not job.tranql.streamed:
+                return { "type" : "result", "result" : result }
+            record = { k : v for k, v in result.items () if k != 'knowledge_map' }
+            record['knowledge_graph'] = {
+                k : v for k, v in result.get ('knowledge_graph', {}).items () if k not in ('nodes', 'edges')
+            }
+            record['type'] = 'summary'
+            return record
+        if job.status == Job.FAILED:
+            if job.tranql is None:
+                return { "type" : "error", **self.handle_exception ([ job.error ]) }
+            return { "type" : "error", **self.query_failure (job.tranql, job.error) }
+        return None
+
+    def query_result (self, context):
+        """ The result of a program, with warnings for any failed reasoner requests. """
+        result = context.mem.get ('result', {})
+        logger.debug (f" -- backplane: {context.mem.get('backplane', '')}")
+        if len(context.mem.get ('requestErrors', [])) > 0:
+            errors = self.handle_exception(context.mem['requestErrors'], warning=True)
+            for key in errors:
+                result[key] = errors[key]
+        return result
+
+    def query_failure (self, tranql, e):
+        traceback.print_exc()
+        errors = [e, *tranql.context.mem.get ('requestErrors', [])]
+        return self.handle_exception (errors)
+
+    def finish_query (self, tranql, result, body, args):
+        """ Attach timings if asked for them and capture the result. """
+        if body.get ('timings', False) or args.get ('timings', 'false') == 'true':
+            result['timings'] = tranql.instrumentation.to_dict ()
+        capture ("query", { "query" : body.get ('query', ''), "result" : result })
         return result
 
 class AnnotateGraph(StandardAPIResource):
@@ -284,6 +424,75 @@ class AnnotateGraph(StandardAPIResource):
 
         return messageObject
 
+class TranQLJob(StandardAPIResource):
+    """ Status, results and cancellation of a query job. """
+
+    def get(self, job_id):
+        """
+        job
+        ---
+        tag: validation
+        description: Status of a query job. Includes the result of the most recently completed statement while the job runs, and the result or error once it finishes.
+        parameters:
+            - in: path
+              name: job_id
+              type: string
+              required: true
+            - in: query
+              name: timings
+              type: boolean
+              description: Include per phase timing spans once the job is done.
+        responses:
+            '200':
+                description: Success
+                content:
+                    application/json:
+                        schema:
+                            type: object
+            '404':
+                description: No such job
+        """
+        job = jobs.get (job_id)
+        if job is None:
+            return { "message" : f"No such job: {job_id}", "status" : "Error" }, 404
+        return self.report (job)
+
+    def delete(self, job_id):
+        """
+        job
+        ---
+        tag: validation
+        description: Cancel a query job, aborting its in flight reasoner requests.
+        parameters:
+            - in: path
+              name: job_id
+              type: string
+              required: true
+        responses:
+            '200':
+                description: Cancelled
+            '404':
+                description: No such job
+        """
+        job = jobs.cancel (job_id)
+        if job is None:
+            return { "message" : f"No such job: {job_id}", "status" : "Error" }, 404
+        return job.to_dict ()
+
+    def report (self, job):
+        result = job.to_dict ()
+        query = TranQLQuery ()
+        if job.status == Job.DONE:
+            result['result'] = query.query_result (job.context)
+            if request.args.get ('timings', 'false') == 'true':
+                result['timings'] = job.tranql.instrumentation.to_dict ()
+        elif job.status in (Job.FAILED, Job.CANCELLED):
+            request_errors = job.tranql.context.mem.get ('requestErrors', []) if job.tranql else []
+            result['error'] = self.handle_exception ([ job.error, *request_errors ])
+        else:
+            result['partial'] = job.partial
+        return result
+
 class SchemaGraph(StandardAPIResource):
     """ Graph of schema to display to the client """
 
@@ -307,7 +516,7 @@ class SchemaGraph(StandardAPIResource):
                             type: string
         """
         tranql = TranQL ()
-        schema = Schema (backplane=tranql.context.mem.get('backplane'))
+        schema = Schema.shared (tranql.context.mem.get('backplane'))
         schemaGraph = GraphTranslator(schema.schema_graph)
 
         # logger.info(schema.schema_graph.net.nodes)
@@ -365,7 +574,7 @@ class ModelConceptsQuery(StandardAPIResource):
         try:
             concept_model = ConceptModel ("biolink-model")
             result = sorted (list(concept_model.by_name.keys ()))
-            logging.debug (result)
+            logger.debug ("%s", result)
         except Exception as e:
             #traceback.print_exc (e)
             result = self.handle_exception (e)
@@ -414,7 +623,7 @@ class ModelRelationsQuery(StandardAPIResource):
         try:
             concept_model = ConceptModel ("biolink-model")
             result = sorted (list(concept_model.relations_by_name.keys ()))
-            logging.debug (result)
+            logger.debug ("%s", result)
         except Exception as e:
             #traceback.print_exc (e)
             result = self.handle_exception (e)
@@ -427,6 +636,7 @@ class ModelRelationsQuery(StandardAPIResource):
 ###############################################################################################
 
 api.add_resource(TranQLQuery, '/tranql/query')
+api.add_resource(TranQLJob, '/tranql/jobs/<job_id>')
 api.add_resource(SchemaGraph, '/tranql/schema')
 api.add_resource(AnnotateGraph, '/tranql/annotate')
 api.add_resource(ModelConceptsQuery, '/tranql/model/concepts')
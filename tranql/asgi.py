@@ -0,0 +1,108 @@
+"""
+Serve the TranQL API over ASGI.
+
+POST /tranql/query is handled by a coroutine driving the asynchronous interpreter, so a
+long running query holds no thread while it waits on reasoners. Every other route is
+served by the Flask app through a WSGI adapter.
+
+    uvicorn tranql.asgi:app --port 8001
+or
+    python -m tranql.asgi -port 8001
+"""
+import argparse
+import json
+import logging
+import time
+from urllib.parse import parse_qsl
+from asgiref.wsgi import WsgiToAsgi
+from tranql.api import app as flask_app, jobs, ndjson_mimetype, TranQLQuery
+from tranql.main import TranQL
+from tranql.metrics import http_requests_in_flight, observe_http_request
+from tranql.request_util import run_blocking
+from tranql.asgi_util import ASGIApplication
+
+logger = logging.getLogger (__name__)
+
+class TranQLApp(ASGIApplication):
+    """ An ASGI application answering queries natively and delegating the rest to Flask. """
+
+    query_path = '/tranql/query'
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WsgiToAsgi (wsgi_app)
+        self.resource = TranQLQuery ()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == self.query_path and scope['method'] == 'POST':
+            await self.query (scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan (receive, send)
+        else:
+            await self.wsgi (scope, receive, send)
+
+    async def stream (self, send, records):
+        """ Send NDJSON records as the query produces them, without holding the event loop while waiting. """
+        await send ({
+            'type' : 'http.response.start',
+            'status' : 200,
+            'headers' : [ (b'content-type', ndjson_mimetype.encode ('ascii')) ]
+        })
+        try:
+            while True:
+                record = await run_blocking (next, records, None)
+                if record is None:
+                    break
+                await send ({ 'type' : 'http.response.body', 'body' : record, 'more_body' : True })
+            await send ({ 'type' : 'http.response.body', 'body' : b'', 'more_body' : False })
+        finally:
+            try:
+                records.close ()
+            except ValueError:
+                """ Still running in a worker; it stops at its next record. """
+                pass
+
+    async def query (self, scope, receive, send):
+        """ Execute a TranQL program. Accepts the same message and options as the Flask route. """
+        start = time.perf_counter ()
+        status = 200
+        http_requests_in_flight.labels ("api").inc ()
+        try:
+            try:
+                body = json.loads (await self.read_body (receive) or b'{}')
+            except ValueError as e:
+                status = 400
+                await self.respond (send, status, { "message" : f"Malformed request: {e}", "status" : "Error" })
+                return
+            headers = self.request_headers (scope)
+            args = dict (parse_qsl (scope.get ('query_string', b'').decode ('latin-1')))
+            if self.resource.wants_job (body, args):
+                job = jobs.submit (body.get ('query', ''), traceparent=headers.get ('traceparent'))
+                status = 202
+                await self.respond (send, status, self.resource.job_accepted (job))
+                return
+            if self.resource.wants_stream (body, args, headers):
+                await self.stream (send, self.resource.stream_query (
+                    body.get ('query', ''), headers.get ('traceparent'), body, args))
+                return
+            tranql = await run_blocking (TranQL)
+            try:
+                query = body.get ('query', '')
+                logger.debug ("--> query: %s", query)
+                context = await tranql.execute_async (query, traceparent=headers.get ('traceparent'))
+                result = self.resource.query_result (context)
+            except Exception as e:
+                result = self.resource.query_failure (tranql, e)
+            result = await run_blocking (self.resource.finish_query, tranql, result, body, args)
+            await self.respond (send, status, result, headers)
+        finally:
+            http_requests_in_flight.labels ("api").dec ()
+            observe_http_request ("api", "POST", self.query_path, status, time.perf_counter () - start)
+
+app = TranQLApp (flask_app)
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description='TranQL ASGI server')
+    parser.add_argument('-port', action="store", dest="port", default=8001, type=int)
+    args = parser.parse_args()
+    uvicorn.run (app, host='0.0.0.0', port=args.port)
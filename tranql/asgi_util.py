@@ -0,0 +1,56 @@
+"""
+Plumbing shared by the ASGI applications of the API and the backplane.
+"""
+import logging
+from tranql import serialization
+from tranql.serialization import choose_encoding, compress, dumps
+
+logger = logging.getLogger (__name__)
+
+class ASGIApplication:
+    """ Answers lifespan events and reads and writes JSON bodies. """
+
+    async def startup (self):
+        pass
+
+    async def shutdown (self):
+        pass
+
+    async def lifespan (self, receive, send):
+        while True:
+            message = await receive ()
+            if message['type'] == 'lifespan.startup':
+                await self.startup ()
+                await send ({ 'type' : 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown ()
+                await send ({ 'type' : 'lifespan.shutdown.complete' })
+                return
+
+    async def read_body (self, receive):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive ()
+            body += message.get ('body', b'')
+            more_body = message.get ('more_body', False)
+        return body
+
+    def request_headers (self, scope):
+        return { k.decode ('latin-1').lower () : v.decode ('latin-1') for k, v in scope.get ('headers', []) }
+
+    async def respond (self, send, status, result, headers={}, content_type='application/json'):
+        """ Send a JSON response, or a text one if content_type says so, compressed if the client accepts it. """
+        body = dumps (result) if content_type == 'application/json' else str(result).encode ('utf-8')
+        response_headers = [ (b'content-type', content_type.encode ('ascii')), (b'vary', b'Accept-Encoding') ]
+        coding = choose_encoding (headers.get ('accept-encoding'))
+        if coding is not None and len(body) >= serialization.minimum_size:
+            body = compress (body, coding)
+            response_headers.append ((b'content-encoding', coding.encode ('ascii')))
+        response_headers.append ((b'content-length', str(len(body)).encode ('ascii')))
+        await send ({
+            'type' : 'http.response.start',
+            'status' : status,
+            'headers' : response_headers
+        })
+        await send ({ 'type' : 'http.response.body', 'body' : body })
@@ -0,0 +1,109 @@
+"""
+Serve the backplane over ASGI.
+
+Each adapter that answers from an upstream reasoner (Gamma, RTX, Indigo, ICEES, GNBR) is
+served by a coroutine that awaits the upstream call, so requests waiting on reasoners hold no
+thread and one process can absorb a wide fan-out of concurrent questions. A batch (a list of
+messages) is answered with a list of answers, the upstream calls all awaited at once. Every
+other route is served by the Flask app through a WSGI adapter.
+
+    uvicorn tranql.backplane.asgi:app --port 8099
+or
+    python -m tranql.backplane.asgi -port 8099
+"""
+import argparse
+import json
+import logging
+import time
+from asgiref.wsgi import WsgiToAsgi
+from tranql.asgi_util import ASGIApplication
+from tranql.backplane.server import app as flask_app, StandardAPIResource
+from tranql.backplane.upstream import get_upstream
+from tranql.instrumentation import Instrumentation, span
+from tranql.metrics import http_requests_in_flight, observe_http_request, record_error
+from tranql.request_util import run_blocking
+
+logger = logging.getLogger (__name__)
+
+def proxy_routes (wsgi_app):
+    """ Map (method, path) to the resource class of each route answered by an upstream. """
+    routes = {}
+    for rule in wsgi_app.url_map.iter_rules ():
+        resource_class = getattr (wsgi_app.view_functions[rule.endpoint], 'view_class', None)
+        if resource_class is None or not issubclass (resource_class, StandardAPIResource) or \
+           resource_class.upstream_call is StandardAPIResource.upstream_call:
+            continue
+        for method in rule.methods & { 'GET', 'POST' }:
+            if hasattr (resource_class, method.lower ()):
+                routes[(method, rule.rule)] = resource_class
+    return routes
+
+class BackplaneApp(ASGIApplication):
+    """ An ASGI application proxying reasoners natively and delegating the rest to Flask. """
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WsgiToAsgi (wsgi_app)
+        self.routes = proxy_routes (wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        resource_class = self.routes.get ((scope.get ('method'), scope.get ('path'))) \
+                         if scope['type'] == 'http' else None
+        if resource_class is not None:
+            await self.proxy (scope, receive, send, resource_class)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan (receive, send)
+        else:
+            await self.wsgi (scope, receive, send)
+
+    async def shutdown (self):
+        await get_upstream ().close_async ()
+
+    async def proxy (self, scope, receive, send, resource_class):
+        """ Validate a message, await the upstream's answer and translate it, as the Flask resource would. """
+        start = time.perf_counter ()
+        status = 200
+        method, path = scope['method'], scope['path']
+        http_requests_in_flight.labels ("backplane").inc ()
+        try:
+            headers = self.request_headers (scope)
+            instrumentation = Instrumentation (traceparent=headers.get ('traceparent'))
+            with instrumentation.activate ():
+                with span (f"{method} {path}", kind="server", resource=resource_class.__name__):
+                    resource = resource_class ()
+                    message = None
+                    if method == 'POST':
+                        try:
+                            message = json.loads (await self.read_body (receive) or b'null')
+                        except ValueError as e:
+                            status = 400
+                            await self.respond (send, status, { "message" : f"Malformed request: {e}" })
+                            return
+                        if isinstance (message, list):
+                            await self.respond (send, status, await resource.proxy_batch_async (message), headers)
+                            return
+                        if resource.validates:
+                            error = await run_blocking (resource.message_error, message)
+                            if error is not None:
+                                status = 400
+                                await self.respond (send, status, error, content_type='text/plain')
+                                return
+                    try:
+                        result = await resource.proxy_async (message)
+                    except Exception as e:
+                        logger.exception ("%s %s failed", method, path)
+                        record_error (e)
+                        status = 500
+                        result = { "message" : "Internal Server Error" }
+                    await self.respond (send, status, result, headers)
+        finally:
+            http_requests_in_flight.labels ("backplane").dec ()
+            observe_http_request ("backplane", method, path, status, time.perf_counter () - start)
+
+app = BackplaneApp (flask_app)
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description='TranQL Backplane ASGI server')
+    parser.add_argument('-port', action="store", dest="port", default=8099, type=int)
+    args = parser.parse_args()
+    uvicorn.run (app, host='0.0.0.0', port=args.port)
@@ -0,0 +1,85 @@
+"""
+Rewrite curie prefixes between the standard forms TranQL uses and the forms an upstream expects.
+
+A rewriter is built once from a prefix map and rewrites a whole message in one traversal:
+question graph curies, knowledge graph node ids, equivalent identifiers and edge endpoints,
+and knowledge map node bindings. Each distinct curie is split at most once; its rewritten
+form is remembered.
+"""
+import logging
+
+logger = logging.getLogger (__name__)
+
+class CurieRewriter:
+    """ Translate the prefixes of curies by a fixed map of prefixes. """
+
+    """ Forget remembered curies past this many, so the memo can't grow without bound. """
+    cache_limit = 100000
+
+    def __init__(self, prefix_map=None):
+        """
+        :param prefix_map: Maps a prefix to its replacement, eg: { "CHEMBL" : "CHEMBL.COMPOUND" }.
+        """
+        self.prefix_map = dict(prefix_map or {})
+        self.cache = {}
+
+    def __bool__(self):
+        return bool(self.prefix_map)
+
+    def reverse (self):
+        """ A rewriter undoing this one. """
+        return CurieRewriter ({ v : k for k, v in self.prefix_map.items () })
+
+    def curie (self, curie):
+        """ Rewrite one curie. """
+        rewritten = self.cache.get (curie)
+        if rewritten is None:
+            rewritten = curie
+            if isinstance (curie, str):
+                prefix, colon, local_id = curie.partition (':')
+                replacement = self.prefix_map.get (prefix) if colon else None
+                if replacement is not None:
+                    rewritten = f"{replacement}:{local_id}"
+                if len(self.cache) >= self.cache_limit:
+                    self.cache.clear ()
+                self.cache[curie] = rewritten
+        return rewritten
+
+    def identifiers (self, value):
+        """ Rewrite a curie or a list of curies. """
+        if isinstance (value, list):
+            return [ self.curie (v) for v in value ]
+        return self.curie (value)
+
+    def rewrite_message (self, message):
+        """ Rewrite every curie of a message in place and return the message. """
+        if not self.prefix_map or not isinstance (message, dict):
+            return message
+        question_graph = message.get ('question_graph') or {}
+        for node in question_graph.get ('nodes', []):
+            if 'curie' in node:
+                node['curie'] = self.identifiers (node['curie'])
+        knowledge_graph = message.get ('knowledge_graph') or {}
+        for node in knowledge_graph.get ('nodes', []):
+            if 'id' in node:
+                node['id'] = self.curie (node['id'])
+            if 'equivalent_identifiers' in node:
+                node['equivalent_identifiers'] = self.identifiers (node['equivalent_identifiers'])
+        for edge in knowledge_graph.get ('edges', []):
+            if 'source_id' in edge:
+                edge['source_id'] = self.curie (edge['source_id'])
+            if 'target_id' in edge:
+                edge['target_id'] = self.curie (edge['target_id'])
+        for answer in message.get ('knowledge_map') or []:
+            bindings = answer.get ('node_bindings') or {}
+            for key, value in bindings.items ():
+                bindings[key] = self.identifiers (value)
+        return message
+
+def prefix_map (config, upstream):
+    """ The prefix map of an upstream from the CURIE_PREFIXES setting, honoring environment overrides. """
+    prefixes = config.get ('CURIE_PREFIXES')
+    upstream_prefixes = prefixes.get (upstream) if prefixes is not None else None
+    if upstream_prefixes is None:
+        return {}
+    return { prefix : upstream_prefixes[prefix] for prefix in upstream_prefixes.conf }
@@ -1,7 +1,12 @@
 import requests
 import json
 import argparse
+import concurrent.futures
+import contextvars
 import logging
+from tranql.backplane.upstream import upstream_request
+from tranql.metrics import observe_cache_lookup
+from tranql.util import ExpiringCache, Lazy, LazyJSON
 requests.packages.urllib3.disable_warnings()
 
 tabular_headers = {"Content-Type" : "application/json", "accept": "text/tabular"}
@@ -29,8 +34,8 @@ class Bionames:
         })
         logger.debug (f"url: {url}")
         result = None
-        response = requests.get(
-            url = url,
+        response = upstream_request (
+            "get", url,
             headers = {
                 'accept': 'application/json'
             })
@@ -42,7 +47,13 @@ class Bionames:
         return result
     
 class ICEES:
-    
+
+    """ The most identifier lookups to have in flight at once. """
+    identifier_workers = 8
+
+    """ Identifiers by feature name. They change rarely, so they are shared by all clients for a day. """
+    identifier_cache = ExpiringCache ("icees_identifiers", ttl=24 * 60 * 60, observe=observe_cache_lookup)
+
     def __init__(self):
         """ Initalize ICEES API. """
         self.bionames = Bionames ()
@@ -57,7 +68,7 @@ class ICEES:
         
     def get_cohort(self, feature, value, operator):
         """ Get a cohort by a single feature spec. """
-        return self.run_define_cohort(feature, value, operator)
+        return self.def_cohort.run_define_cohort(feature, value, operator)
     
     def feature_to_all_features (self, feature, value, operator, max_p_val, cohort_id):
         """ Get association from one feature to all other features within a cohort. """
@@ -69,13 +80,30 @@ class ICEES:
             cohort_id = cohort_id)
 
     def get_identifiers (self, feature):
-        query = f"https://icees.renci.org/1.0.0/patient/{feature}/identifiers"
-        response = requests.get (query, verify=False).json ()
-        return response['return value']['identifiers']
+        identifiers = self.identifier_cache.get (feature)
+        if identifiers is None:
+            query = f"https://icees.renci.org/1.0.0/patient/{feature}/identifiers"
+            response = upstream_request ("get", query, verify=False).json ()
+            identifiers = self.identifier_cache.put (feature, response['return value']['identifiers'])
+        return identifiers
+
+    def get_identifiers_for (self, features):
+        """ Map each of the features to its identifiers, looking up those not cached concurrently. """
+        features = list(dict.fromkeys (features))
+        missing = [ f for f in features if self.identifier_cache.peek (f) is None ]
+        if len(missing) > 1:
+            with concurrent.futures.ThreadPoolExecutor (
+                    max_workers=min (self.identifier_workers, len(missing))) as executor:
+                futures = [ executor.submit (contextvars.copy_context ().run, self.get_identifiers, f)
+                            for f in missing ]
+                fetched = dict(zip (missing, [ future.result () for future in futures ]))
+        else:
+            fetched = {}
+        return { f : fetched[f] if f in fetched else self.get_identifiers (f) for f in features }
 
-    def build_associations (self, feature, type_name, source_id, p_value, edges, nodes):
-        identifiers = self.get_identifiers (feature)
-        print (identifiers)
+    def build_associations (self, feature, type_name, source_id, p_value, edges, nodes, identifiers=None):
+        if identifiers is None:
+            identifiers = self.get_identifiers (feature)
         if len(identifiers) > 0:
             logger.debug (f"Got ids for {feature}: {identifiers}")
             for index, an_id in enumerate(identifiers):
@@ -105,38 +133,46 @@ class ICEES:
             "type" : "population_of_individual_organisms"
         }]
         edges = []
-        print (f"{json.dumps(response, indent=2)}")
+        logger.debug ("%s", LazyJSON (response))
+        """ Find the associations to build, then look up the identifiers of all their features at once. """
+        associations = []
         if 'return value' in response:
             for value in response['return value']:
-                logger.debug (f" value {value}")
+                logger.debug ("value %s", value)
                 if 'feature_b' in value:
                     feature_name = value['feature_b'].get ('feature_name', None)
                     if feature_name is None:
                         continue
-                    logger.debug (f"feature_name: {feature_name}")
+                    logger.debug ("feature_name: %s", feature_name)
                     for type_name in target_types:
                         if type_name == 'chemical_substance':
                             # Handle drugs 
                             if any([ v for v in self.drug_suffix if feature_name.endswith (v) ]):
-                                self.build_associations (
-                                    feature=feature_name, type_name=type_name,
-                                    source_id=cohort_id, p_value=value['p_value'],
-                                    edges=edges, nodes=nodes)
+                                associations.append ((feature_name, type_name, value['p_value']))
                         elif type_name == 'disease':
                             # Handle disease diagnoses
                             if feature_name in self.diagnoses:
-                                self.build_associations (
-                                    feature=feature_name, type_name=type_name,
-                                    source_id=cohort_id, p_value=value['p_value'],
-                                    edges = edges, nodes=nodes)
+                                associations.append ((feature_name, type_name, value['p_value']))
                         else:
-                            logger.debug (f"ignoring unhanlded type name: {type_name}")
+                            logger.debug ("ignoring unhanlded type name: %s", type_name)
+        identifiers = self.get_identifiers_for ([ feature for feature, type_name, p_value in associations ])
+        for feature, type_name, p_value in associations:
+            self.build_associations (
+                feature=feature, type_name=type_name,
+                source_id=cohort_id, p_value=p_value,
+                edges=edges, nodes=nodes,
+                identifiers=identifiers[feature])
         return {
             "nodes" : nodes,
             "edges" : edges
         }
     
 class DefineCohort ():
+
+    """ Cohorts defined by ICEES, by (feature, operator, value, year, table, version). ICEES answers the same
+    filter with the same cohort, so a definition is only requested once a day. """
+    cohort_cache = ExpiringCache ("icees_cohorts", ttl=24 * 60 * 60, observe=observe_cache_lookup)
+
     def __init__(self):
         pass
     
@@ -145,13 +181,18 @@ class DefineCohort ():
         return feature_variables
     
     def define_cohort_query(self, feature_variables, year=2010, table='patient', version='1.0.0'): # year, table, and version are hardcoded for now
-        define_cohort_response = requests.post('https://icees.renci.org/{0}/{1}/{2}/cohort'.format(version, table, year), data=feature_variables, headers = json_headers, verify = False)               
+        define_cohort_response = upstream_request ("post", 'https://icees.renci.org/{0}/{1}/{2}/cohort'.format(version, table, year), data=feature_variables, headers = json_headers, verify = False)
         return define_cohort_response
 
-    def run_define_cohort (self, feature, value, operator):
-        feature_variables = self.make_cohort_definition(feature, value, operator)
-        define_cohort_query = self.define_cohort_query(feature_variables)
-        define_cohort_query_json = define_cohort_query.json()
+    def run_define_cohort (self, feature, value, operator, year=2010, table='patient', version='1.0.0'):
+        key = (feature, operator, str(value), year, table, version)
+        define_cohort_query_json = self.cohort_cache.get (key)
+        if define_cohort_query_json is None:
+            feature_variables = self.make_cohort_definition(feature, value, operator)
+            define_cohort_query = self.define_cohort_query(feature_variables, year=year, table=table, version=version)
+            define_cohort_query_json = define_cohort_query.json()
+            if 'cohort_id' in (define_cohort_query_json.get ('return value') or {}):
+                self.cohort_cache.put (key, define_cohort_query_json)
         return define_cohort_query_json
 
 class GetCohortDefinition():
@@ -159,7 +200,7 @@ class GetCohortDefinition():
         pass
     
     def get_cohort_definition_query(self, cohort_id, year=2010, table='patient', version='1.0.0'):
-        cohort_definition_response = requests.get('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}'.format(version, table, year, cohort_id), headers = json_headers, verify = False)               
+        cohort_definition_response = upstream_request ("get", 'https://icees.renci.org/{0}/{1}/{2}/cohort/{3}'.format(version, table, year, cohort_id), headers = json_headers, verify = False)
         return cohort_definition_response
 
     def run_get_cohort_definition(self, cohort_id):
@@ -172,7 +213,7 @@ class GetFeatures():
         pass
 
     def get_features_query(self, cohort_id, year=2010, table='patient', version='1.0.0'):
-        features_response = requests.get('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/features'.format(version, table, year, cohort_id), headers=json_headers, verify=False)
+        features_response = upstream_request ("get", 'https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/features'.format(version, table, year, cohort_id), headers=json_headers, verify=False)
         return features_response
 
     def run_get_features(self, cohort_id):
@@ -193,28 +234,36 @@ class AssociationToAllFeatures():
         return feature_variable_and_p_value
 
     def assocation_to_all_features_query(self, feature_variable_and_p_value, cohort_id, year=2010, table='patient', version='1.0.0'):
-        assoc_to_all_features_response = requests.post('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/associations_to_all_features'.format(version, table, year, cohort_id), data=feature_variable_and_p_value, headers= json_headers, verify=False)
+        assoc_to_all_features_response = upstream_request ("post", 'https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/associations_to_all_features'.format(version, table, year, cohort_id), data=feature_variable_and_p_value, headers= json_headers, verify=False, idempotent=True)
         return assoc_to_all_features_response
 
     def run_association_to_all_features(self, feature, value, operator, maximum_p_value, cohort_id):
         feature_variable_and_p_value = self.make_association_to_all_features(feature, value, operator, maximum_p_value)
-        print (json.dumps (feature_variable_and_p_value, indent=2))
-        print (json.dumps (json.loads(feature_variable_and_p_value), indent=2))
+        logger.debug ("%s", Lazy (lambda: json.dumps (json.loads(feature_variable_and_p_value), indent=2)))
         assoc_to_all_features_query = self.assocation_to_all_features_query(feature_variable_and_p_value, cohort_id)
         assoc_to_all_features_query_json = assoc_to_all_features_query.json()
         return assoc_to_all_features_query_json
 
 class GetDictionary():
+
+    """ Cohort dictionaries by (year, table, version). """
+    dictionary_cache = ExpiringCache ("icees_dictionary", ttl=60 * 60, observe=observe_cache_lookup)
+
     def __init__(self):
         pass
 
     def get_dictionary_query(self, year=2010, table='patient', version='1.0.0'):
-        dictionary_response = requests.get('https://icees.renci.org/{0}/{1}/{2}/cohort/dictionary'.format(version, table, year), headers = json_headers, verify = False) 
+        dictionary_response = upstream_request ("get", 'https://icees.renci.org/{0}/{1}/{2}/cohort/dictionary'.format(version, table, year), headers = json_headers, verify = False)
         return dictionary_response
 
-    def run_get_dictionary(self):
-        dictionary_query = self.get_dictionary_query()
-        dictionary_query_json = dictionary_query.json()
+    def run_get_dictionary(self, year=2010, table='patient', version='1.0.0'):
+        key = (year, table, version)
+        dictionary_query_json = self.dictionary_cache.get (key)
+        if dictionary_query_json is None:
+            dictionary_query = self.get_dictionary_query(year=year, table=table, version=version)
+            dictionary_query_json = dictionary_query.json()
+            if dictionary_query.status_code == 200:
+                self.dictionary_cache.put (key, dictionary_query_json)
         return dictionary_query_json
 
 
@@ -1,11 +1,16 @@
 """
 Provide a standard protocol for asking graph oriented questions of Translator data sources.
 """
+import asyncio
+import concurrent.futures
+import contextvars
 import copy
+import functools
 import argparse
 import json
 import logging
 import os
+import time
 import yaml
 import jsonschema
 import requests
@@ -16,12 +21,33 @@ from flask_cors import CORS
 #from tranql.lib.ndex import NDEx
 from tranql.main import TranQL
 import networkx as nx
-from tranql.util import JSONKit
+from tranql.util import JSONKit, Lazy, LazyJSON
 from tranql.concept import BiolinkModelWalker
 from tranql.backplane.iceesclient import ICEES
+from tranql.config import Config
+from tranql.instrumentation import Instrumentation, span, configure_exporter
+from tranql.metrics import instrument, record_error
+from tranql.request_util import run_blocking
+from tranql.capture import capture, configure_capture, get_capture
+from tranql.serialization import configure_serialization
+from tranql.backplane.upstream import configure_upstream, upstream_request, upstream_request_async
+from tranql.backplane.curies import CurieRewriter, prefix_map
 
 logger = logging.getLogger (__name__)
 
+config = Config ("conf.yml")
+configure_exporter (config.get ('TRACE_EXPORTER'))
+configure_capture (config)
+configure_upstream (config)
+
+""" Most messages of a batch answered at once. """
+batch_workers = int(config.get ('BACKPLANE_BATCH_WORKERS', 8))
+
+""" Answers the messages of batches sent to the Flask app. """
+batch_executor = concurrent.futures.ThreadPoolExecutor (
+    max_workers=batch_workers,
+    thread_name_prefix="backplane-batch")
+
 app = Flask(__name__)
 
 api = Api(app)
@@ -30,14 +56,74 @@ CORS(app)
 """ https://github.com/NCATS-Gamma/NCATS-ReasonerStdAPI """
 filename = 'translator_interchange.yaml'
 filename = os.path.join (os.path.dirname (__file__), 'translator_interchange_0.9.0.yaml')
-with open(filename, 'r') as file_obj:
-    template = yaml.load(file_obj)
+
+""" Interchange specifications by message schema version. """
+interchange_specs = { "0.9.0" : filename }
+default_schema_version = "0.9.0"
+
+""" How much to validate incoming messages: full (the interchange schema), structural
+(top level property types only) or none. """
+validation_mode = config.get ('BACKPLANE_VALIDATION', 'full')
+
+@functools.lru_cache (maxsize=None)
+def load_interchange_spec (version):
+    with open(interchange_specs[version], 'r') as file_obj:
+        return yaml.safe_load (file_obj)
+
+@functools.lru_cache (maxsize=None)
+def message_validator (version):
+    """ A compiled validator for messages of a schema version, built once. """
+    specs = copy.deepcopy (load_interchange_spec (version))
+    to_validate = specs["components"]["schemas"]["Message"]
+    to_validate["components"] = specs["components"]
+    to_validate["components"].pop("Message", None)
+    validator_class = jsonschema.validators.validator_for (to_validate)
+    validator_class.check_schema (to_validate)
+    return validator_class (to_validate)
+
+""" Python types of JSON schema types. """
+json_types = {
+    "object" : dict,
+    "array" : list,
+    "string" : str,
+    "integer" : int,
+    "number" : (int, float),
+    "boolean" : bool
+}
+
+@functools.lru_cache (maxsize=None)
+def message_property_types (version):
+    """ The Python types of the message's top level properties that declare a type. """
+    properties = load_interchange_spec (version)["components"]["schemas"]["Message"].get ("properties", {})
+    return {
+        name : json_types[prop["type"]]
+        for name, prop in properties.items () if prop.get ("type") in json_types
+    }
+
+def structural_error (message, version):
+    """ Cheaply check a message's shape, returning a description of the first problem or None. """
+    if not isinstance (message, dict):
+        return "A message must be a JSON object."
+    for name, types in message_property_types (version).items ():
+        if name in message and not isinstance (message[name], types):
+            return f"Message property {name} has the wrong type: {type(message[name]).__name__}."
+    return None
+
+@functools.lru_cache (maxsize=None)
+def curie_rewriters (upstream):
+    """ Rewriters to and from the curie prefixes of an upstream, built once. """
+    to_upstream = CurieRewriter (prefix_map (config, upstream) if upstream else None)
+    return to_upstream, to_upstream.reverse ()
+
+template = copy.deepcopy (load_interchange_spec (default_schema_version))
 app.config['SWAGGER'] = {
     'title': 'TranQL Backplane',
     'description': 'hi',
     'uiversion': 3
 }
 swagger = Swagger(app, template=template)
+instrument (app, "backplane")
+configure_serialization (app, api, config)
 
 #######################################################
 ##
@@ -59,17 +145,104 @@ class ICEESClusterArgs:
         self.max_p_val = max_p_val
 
 class StandardAPIResource(Resource):
+    """ The upstream's entry in CURIE_PREFIXES, if it spells curie prefixes its own way. """
+    upstream = None
+    def dispatch_request (self, *args, **kwargs):
+        """ Trace each request, continuing the caller's trace if it sent a traceparent header. """
+        instrumentation = Instrumentation (traceparent=request.headers.get ('traceparent'))
+        with instrumentation.activate ():
+            with span (f"{request.method} {request.path}", kind="server",
+                       resource=type(self).__name__):
+                if self.is_batch (request):
+                    return self.proxy_batch (request.json)
+                return super().dispatch_request (*args, **kwargs)
+    def is_batch (self, request):
+        """ A batch is a list of messages posted to a resource that answers batches. """
+        return request.method == 'POST' and self.answers_batches () and \
+            isinstance (request.get_json (silent=True), list)
+    @classmethod
+    def answers_batches (cls):
+        """ Resources answered by an upstream, or answering a message themselves in proxy, answer batches. """
+        return cls.upstream_call is not StandardAPIResource.upstream_call or \
+            cls.proxy is not StandardAPIResource.proxy
+    def message_error (self, message):
+        """ Validate a message against the interchange schema of its version, returning the error or None. """
+        if validation_mode == 'none':
+            return None
+        version = message.get ('schema_version') if isinstance (message, dict) else None
+        if version not in interchange_specs:
+            version = default_schema_version
+        error = structural_error (message, version)
+        if error is None and validation_mode == 'full':
+            error = jsonschema.exceptions.best_match (message_validator (version).iter_errors (message))
+        if error is not None:
+            logger.error ("ERROR: %s", error)
+        return error
     def validate (self, request):
-        with open(filename, 'r') as file_obj:
-            specs = yaml.load(file_obj)
-        to_validate = specs["components"]["schemas"]["Message"]
-        to_validate["components"] = specs["components"]
-        to_validate["components"].pop("Message", None)
-        try:
-            jsonschema.validate(request.json, to_validate)
-        except jsonschema.exceptions.ValidationError as error:
-            print (f"ERROR: {str(error)}")
+        error = self.message_error (request.json)
+        if error is not None:
             abort(Response(str(error), 400))
+    """ Whether incoming messages are validated before they are sent upstream. """
+    validates = True
+    def upstream_call (self, message):
+        """
+        The upstream request answering a validated message, as keyword arguments of upstream_request.
+        Resources that answer without an upstream return None.
+        """
+        return None
+    def upstream_result (self, call, response):
+        """ This resource's answer, given the upstream call it made and the upstream's response. """
+        return response.json ()
+    def proxy (self, message):
+        """ Answer a message with the upstream. """
+        call = self.upstream_call (message)
+        return self.upstream_result (call, upstream_request (**call))
+    async def proxy_async (self, message):
+        """ Answer a message with the upstream, without blocking the event loop on it or on reading its answer. """
+        call = self.upstream_call (message)
+        response = await upstream_request_async (**call)
+        return await run_blocking (self.upstream_result, call, response)
+    def batch_error (self, code, message):
+        return { "status" : "error", "code" : code, "message" : message }
+    def answer (self, message):
+        """ Answer one message of a batch, returning an error response rather than raising. """
+        error = self.message_error (message) if self.validates else None
+        if error is not None:
+            return self.batch_error ("invalid_message", str(error))
+        try:
+            return self.proxy (message)
+        except Exception as e:
+            logger.exception ("Failed to answer a batched message")
+            record_error (e)
+            return self.batch_error ("service_invocation_failure", str(e))
+    def proxy_batch (self, messages):
+        """ Answer a list of messages, asking the upstream concurrently. Answers are in message order. """
+        futures = [ batch_executor.submit (contextvars.copy_context ().run, self.answer, message)
+                    for message in messages ]
+        return [ future.result () for future in futures ]
+    async def answer_async (self, message):
+        error = await run_blocking (self.message_error, message) if self.validates else None
+        if error is not None:
+            return self.batch_error ("invalid_message", str(error))
+        try:
+            return await self.proxy_async (message)
+        except Exception as e:
+            logger.exception ("Failed to answer a batched message")
+            record_error (e)
+            return self.batch_error ("service_invocation_failure", str(e))
+    async def proxy_batch_async (self, messages):
+        """ Answer a list of messages, at most batch_workers at once, like proxy_batch. Answers are in message order. """
+        semaphore = asyncio.Semaphore (batch_workers)
+        async def answer (message):
+            async with semaphore:
+                return await self.answer_async (message)
+        return list(await asyncio.gather (*[ answer (message) for message in messages ]))
+    def to_upstream (self, message):
+        """ Rewrite a message's curies to the prefixes the upstream expects. """
+        return curie_rewriters (self.upstream)[0].rewrite_message (message)
+    def from_upstream (self, message):
+        """ Rewrite an upstream message's curies to the standard prefixes. """
+        return curie_rewriters (self.upstream)[1].rewrite_message (message)
     def get_opt (self, request, opt):
         return request.get('option', {}).get (opt)
     def rename_key (self, obj, old, new, default=None):
@@ -93,7 +266,13 @@ class StandardAPIResource(Resource):
                 "query_graph": question_graph
             }
         }
+    def edge_key (self, edge):
+        """ Edges are the same if they share an id or, lacking ids, a type, source and target. """
+        if 'id' in edge:
+            return edge['id']
+        return (edge.get ('type'), edge.get ('source_id'), edge.get ('target_id'))
     def merge_results (self, message):
+        """ Fold the result graphs of a 0.9 message into its knowledge graph, dropping duplicate nodes and edges. """
         results = message['results']
         del message['results']
         if 'knowledge_graph' not in message:
@@ -103,28 +282,32 @@ class StandardAPIResource(Resource):
             }
         if 'knowledge_map' not in message:
             message['knowledge_map'] = []
-        nodeIds = []
+        kg_nodes = message['knowledge_graph'].setdefault ('nodes', [])
+        kg_edges = message['knowledge_graph'].setdefault ('edges', [])
+        knowledge_map = message['knowledge_map']
+        node_ids = { node['id'] for node in kg_nodes }
+        edge_keys = { self.edge_key (edge) for edge in kg_edges }
         for result in results:
             # Convert 0.9.0 equivalent of knowledge_map to the knowledge_map format we want
             node_bindings = result.get('node_bindings',None)
             edge_bindings = result.get('edge_bindings',None)
             if node_bindings != None and edge_bindings != None:
-                message['knowledge_map'].append({
+                knowledge_map.append({
                     "node_bindings": node_bindings,
                     "edge_bindings": edge_bindings
                 })
 
-
             result = result.get('result_graph', {})
 
-            nodes = result.get('nodes',[])
-            edges = result.get('edges',[])
-
-            message['knowledge_graph']['edges'].extend(edges)
-            for node in nodes:
-                if not node['id'] in nodeIds:
-                    message['knowledge_graph']['nodes'].append(node)
-                    nodeIds.append(node['id'])
+            for node in result.get('nodes',[]):
+                if node['id'] not in node_ids:
+                    node_ids.add (node['id'])
+                    kg_nodes.append (node)
+            for edge in result.get('edges',[]):
+                key = self.edge_key (edge)
+                if key not in edge_keys:
+                    edge_keys.add (key)
+                    kg_edges.append (edge)
         return message
     def normalize_message (self, message):
         if 'results' in message:
@@ -179,9 +362,11 @@ class ICEESSchema(StandardAPIResource):
                             type: string
 
         """
-        return requests.get (
-            self.schema_url,
-            verify=False).json()['return value']
+        return self.proxy (None)
+    def upstream_call (self, message):
+        return { "method" : "get", "url" : self.schema_url, "verify" : False }
+    def upstream_result (self, call, response):
+        return response.json()['return value']
 
 class ICEESClusterQuery(StandardAPIResource):
     """ ICEES Resource. """
@@ -216,8 +401,11 @@ class ICEESClusterQuery(StandardAPIResource):
 
         """
         self.validate (request)
-        #print (f"{json.dumps(request.json, indent=2)}")
-        request.json['options'] = self.compile_options (request.json['options'])
+        return self.proxy (request.json)
+
+    def upstream_call (self, message):
+        #print (f"{json.dumps(message, indent=2)}")
+        message['options'] = self.compile_options (message['options'])
 
         ''' Give ICEES the spec version it wants.
         We have multiple versions of the spec live at once.
@@ -234,23 +422,26 @@ class ICEESClusterQuery(StandardAPIResource):
         del request.json['knowledge_graph']
         del request.json['knowledge_maps']
         '''
-        for e in request.json['question_graph']['edges']:
+        for e in message['question_graph']['edges']:
             e['type'] = 'association'
-        request.json['query_options'] = request.json.pop('options')
-        request.json['machine_question'] = request.json.pop('question_graph')
-
-        #print (f"{json.dumps(request.json, indent=2)}")
-        result = {}
+        message['query_options'] = message.pop('options')
+        message['machine_question'] = message.pop('question_graph')
 
         ''' Invoke ICEES '''
         icees_kg_url = "https://icees.renci.org/2.0.0/knowledge_graph"
-        #print (f"--- request.json ----------> {json.dumps(request.json, indent=2)}")
-        response = requests.post (icees_kg_url,
-                                  json=request.json,
-                                  verify=False)
+        #print (f"--- message ----------> {json.dumps(message, indent=2)}")
+        return {
+            "method" : "post",
+            "url" : icees_kg_url,
+            "json" : message,
+            "verify" : False,
+            "idempotent" : True
+        }
 
-        with open ('icees.out', 'w') as stream:
-            json.dump (response.json (), stream, indent=2)
+    def upstream_result (self, call, response):
+        result = {}
+        if get_capture ().enabled:
+            capture ("icees", response.json ())
         #print (f"-- response --> {json.dumps(response.json(), indent=2)}")
         #print (f"{json.dumps(response.json(), indent=2)}")
 
@@ -258,13 +449,13 @@ class ICEESClusterQuery(StandardAPIResource):
             result = {
                 "status" : "error",
                 "code"   : "service_invocation_failure",
-                "message" : f"Bad Gamma quick response. url: {self.robokop_url} request: {request.json} response: {response.text}."
+                "message" : f"Bad ICEES response. url: {call['url']} request: {call['json']} response: {response.text}."
             }
         else:
             result = self.normalize_message (response.json ())
 
-        with open ('icees.out.norm', 'w') as stream:
-            json.dump (result, stream, indent=2)
+        if get_capture ().enabled:
+            capture ("icees.norm", result)
 
         return result
 
@@ -356,49 +547,12 @@ class PublishToNDEx(StandardAPIResource):
                 })
 
 class RtxQuery(StandardAPIResource):
+    """ Rtx spells some curie prefixes differently, eg CHEMBL.COMPOUND for CHEMBL. """
+    upstream = "rtx"
     def __init__(self):
         super().__init__()
         self.base_url = 'https://rtx.ncats.io'
         self.query_url = f'{self.base_url}/beta/api/rtx/v1/query'
-    """
-    Rtx seems to divulge from the normal identifer syntax in some places so our syntax to be compliant with theirs.
-    """
-    @staticmethod
-    def convert_curies_to_rtx(message):
-        for i in message["question_graph"]:
-            for element in message["question_graph"][i]:
-                if 'curie' in element:
-                    curie = element['curie']
-                    identifierSource = curie.split(":")
-                    if identifierSource[0] == "CHEMBL":
-                        curie = "CHEMBL.COMPOUND:"+identifierSource[1]
-                    # print(element['curie'],curie)
-                    element['curie'] = curie
-        return message
-    """
-    We must convert these curies back to the standard form when returning the response.
-    """
-    @staticmethod
-    def convert_curies_to_standard(message):
-        for i in message["knowledge_map"]:
-            for n in i:
-                for k in i[n]:
-                    for enum, binding in enumerate(i[n][k]):
-                        identifierSource = binding.split(":")
-                        if identifierSource[0] == "CHEMBL.COMPOUND":
-                            binding = "CHEMBL:"+identifierSource[1]
-                        # print(element['curie'],curie)
-                        i[n][k][enum] = binding
-        for element in message["knowledge_graph"]["nodes"]:
-            identifierSource = element["id"].split(":")
-            if identifierSource[0] == "CHEMBL.COMPOUND":
-                element["id"] = "CHEMBL:"+identifierSource[1]
-        for element in message["knowledge_graph"]["edges"]:
-            for prop in ["source_id","target_id"]:
-                identifierSource = element[prop].split(":")
-                if identifierSource[0] == "CHEMBL.COMPOUND":
-                    element[prop] = "CHEMBL:"+identifierSource[1]
-        return message
     def post(self):
         """
         Visualize
@@ -428,10 +582,16 @@ class RtxQuery(StandardAPIResource):
                             type: string
         """
         self.validate(request)
-
-        data = self.format_as_query(self.convert_curies_to_rtx(request.json))
-        # print(json.dumps(data,indent=2))
-        response = requests.post(self.query_url, json=data)
+        return self.proxy (request.json)
+    def upstream_call (self, message):
+        return {
+            "method" : "post",
+            "url" : self.query_url,
+            "json" : self.format_as_query(self.to_upstream(message)),
+            "idempotent" : True
+        }
+    def upstream_result (self, call, response):
+        data = call['json']
         if not response.ok:
             if response.status_code == 500:
                 result = {
@@ -446,7 +606,7 @@ class RtxQuery(StandardAPIResource):
                     "message" : f"Bad Rtx query response. url: {self.query_url} \n request: {json.dumps(data, indent=2)} \nresponse: \n{response.text}\n (code={response.status_code})."
                 }
         else:
-            result = self.convert_curies_to_standard(self.normalize_message(response.json()))
+            result = self.from_upstream(self.normalize_message(response.json()))
         return result
 
 class IndigoQuery(StandardAPIResource):
@@ -483,11 +643,16 @@ class IndigoQuery(StandardAPIResource):
                             type: string
         """
         self.validate(request)
-
-        data = self.format_as_query(request.json)
-
-        # print("input",json.dumps(data,indent=2))
-        response = requests.post(self.query_url, json=data)
+        return self.proxy (request.json)
+    def upstream_call (self, message):
+        return {
+            "method" : "post",
+            "url" : self.query_url,
+            "json" : self.format_as_query(message),
+            "idempotent" : True
+        }
+    def upstream_result (self, call, response):
+        data = call['json']
         if not response.ok:
             if response.status_code == 500:
                 result = {
@@ -552,17 +717,25 @@ class GammaQuery(GammaResource):
                             type: string
         """
         self.validate (request)
+        return self.proxy (request.json)
+    def upstream_call (self, message):
+        message.pop ('knowledge_graph', None)
+        message.pop ('knowledge_maps', None)
+        message.pop ('options', None)
+        return {
+            "method" : "post",
+            "url" : self.quick_url,
+            "json" : message,
+            "idempotent" : True
+        }
+    def upstream_result (self, call, response):
         result = {}
-        del request.json['knowledge_graph']
-        del request.json['knowledge_maps']
-        del request.json['options']
-        response = requests.post (self.quick_url, json=request.json)
         # print (f"{json.dumps(response.json (), indent=2)}")
         if response.status_code >= 300:
             result = {
                 "status" : "error",
                 "code"   : "service_invocation_failure",
-                "message" : f"Bad Gamma quick response. url: {self.robokop_url} \n request: {json.dumps(request.json, indent=2)} response: \n{response.text}."
+                "message" : f"Bad Gamma quick response. url: {self.robokop_url} \n request: {json.dumps(call['json'], indent=2)} response: \n{response.text}."
             }
         else:
             result = self.normalize_message (response.json ())
@@ -608,25 +781,28 @@ class PublishToGamma(GammaResource):
             json.dump (request.json, stream, indent=2)
         return {}
         '''
-        if 'knowledge_map' in request.json:
-            request.json['answers'] = request.json['knowledge_map']
-            del request.json['knowledge_map']
-        #print (f"{json.dumps(request.json, indent=2)}")
-        view_post_response = requests.post(
-            self.view_post_url,
-            json=request.json)
+        return self.proxy (request.json)
+    def upstream_call (self, message):
+        if 'knowledge_map' in message:
+            message['answers'] = message.pop ('knowledge_map')
+        #print (f"{json.dumps(message, indent=2)}")
+        return { "method" : "post", "url" : self.view_post_url, "json" : message }
+    def upstream_result (self, call, view_post_response):
         if view_post_response.status_code >= 300:
-            print(f"{view_post_response}")
+            logger.error ("%s", view_post_response)
             raise Exception("Bad response view post")
         uid = json.loads(view_post_response.text)
-        print(f"view-post-response: {view_post_response}")
-        print(f"view-url: {self.view_url(uid)}")
+        logger.debug ("view-post-response: %s", view_post_response)
+        logger.debug ("view-url: %s", Lazy (lambda: self.view_url(uid)))
 
 class GNBRReasoner:
+    url = 'https://gnbr-reason.ncats.io/decorator'
     def query (self, message):
-        url=f'https://gnbr-reason.ncats.io/decorator'
-        response = requests.post(url,json=message)
-        print( f"Return Status: {response.status_code}" )
+        return self.result (upstream_request (**self.call (message)))
+    def call (self, message):
+        return { "method" : "post", "url" : self.url, "json" : message, "idempotent" : True }
+    def result (self, response):
+        logger.debug ("Return Status: %s", response.status_code)
         result = {}
         if response.status_code == 200:
             result = response.json()
@@ -634,6 +810,7 @@ class GNBRReasoner:
 
 class GNBRDecorator(StandardAPIResource):
     """ GNBR Knowledge Graph annotator."""
+    validates = False
     def post(self):
         """
         Decorate a knowledge graph via GNBR.
@@ -664,9 +841,9 @@ class GNBRDecorator(StandardAPIResource):
 
         """
         # self.validate (request)
-
-
-        knowledge_graph = request.json['knowledge_graph']
+        return self.proxy (request.json)
+    def upstream_call (self, message):
+        knowledge_graph = message['knowledge_graph']
 
         mapped_message = {
             'result_graph': {
@@ -700,8 +877,7 @@ class GNBRDecorator(StandardAPIResource):
         node_list = rtx_result['result_graph']['node_list']
         edge_list = rtx_result['result_graph']['edge_list']
 
-        gnbr_reasoner = GNBRReasoner ()
-        return gnbr_reasoner.query ({
+        return GNBRReasoner ().call ({
             "query_message": {
                 "query_graph": {
                     'nodes': node_list,
@@ -709,6 +885,8 @@ class GNBRDecorator(StandardAPIResource):
                 }
             }
         })
+    def upstream_result (self, call, response):
+        return GNBRReasoner ().result (response)
 
 class BiolinkModelWalkerService(StandardAPIResource):
     """ Biolink Model Walk Resource. """
@@ -745,12 +923,15 @@ class BiolinkModelWalkerService(StandardAPIResource):
 
         """
         self.validate (request)
-        question = request.json['question_graph']
+        return self.proxy (request.json)
+    def proxy (self, message):
+        """ Convert the types of a message's question, without an upstream. """
+        question = message['question_graph']
         question_nodes = question['nodes']
         source_node = question_nodes[0]
         target_node = question_nodes[1]
         target_type = target_node['type']
-        response = copy.deepcopy (request.json)
+        response = copy.deepcopy (message)
         if len(question_nodes) == 2:
             biolink_model_walker = BiolinkModelWalker ()
             conversion = biolink_model_walker.translate (
@@ -770,7 +951,7 @@ class BiolinkModelWalkerService(StandardAPIResource):
                 ]
             else:
                 raise ValueError (f"Unable to convert {source_node} to {target_type}")
-            print (json.dumps(response, indent=2))
+            logger.debug ("%s", LazyJSON (response))
         if not 'answers' in response:
             response['answers'] = []
         return self.normalize_message (response)
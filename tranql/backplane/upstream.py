@@ -0,0 +1,255 @@
+"""
+Outbound HTTP client for the reasoners behind the backplane.
+
+Each upstream host gets its own requests session, so connections are kept alive and pooled
+between calls instead of being opened for every request. Every call has a connect and read
+timeout. Idempotent calls that fail to connect or get a 502, 503 or 504 are retried a bounded
+number of times, sleeping for a random (jittered) exponential backoff between attempts. Calls
+that connect but time out reading the answer are not retried: they have already waited the read
+timeout, and asking again would wait as long. Each attempt is traced and counted per upstream.
+
+Coroutines make the same calls with request_async, which pools connections per upstream in
+an aiohttp session of the running event loop.
+"""
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from tranql.instrumentation import span, inject
+from tranql.metrics import observe_reasoner_requests, observe_upstream_retry, record_error
+
+logger = logging.getLogger (__name__)
+
+class UpstreamResponse:
+    """ The parts of a requests response that adapters use, read from an aiohttp response. """
+    def __init__(self, url, status_code, content, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def ok (self):
+        return self.status_code < 400
+
+    @property
+    def text (self):
+        return self.content.decode (self.encoding, errors='replace')
+
+    def json (self):
+        return json.loads (self.content)
+
+    def close (self):
+        pass
+
+    def __repr__(self):
+        return f"<UpstreamResponse [{self.status_code}]>"
+
+class UpstreamClient:
+    """ Pooled, timed and retrying HTTP requests to upstream services. """
+
+    """ Methods that are safe to repeat. Others are retried only if the caller says they are idempotent. """
+    idempotent_methods = frozenset ([ "GET", "HEAD", "OPTIONS", "PUT", "DELETE" ])
+
+    """ Statuses that mean the upstream may succeed if asked again. """
+    retry_statuses = frozenset ([ 502, 503, 504 ])
+
+    def __init__(self, connect_timeout=5.0, read_timeout=300.0, retries=2, backoff=0.5, max_backoff=10.0, pool_size=10):
+        """
+        :param connect_timeout: Seconds to wait for a connection to an upstream.
+        :param read_timeout: Seconds to wait between bytes of an upstream response.
+        :param retries: How many times to retry a failed idempotent call.
+        :param backoff: Base of the exponential backoff between retries, in seconds.
+        :param max_backoff: Longest backoff between retries, in seconds.
+        :param pool_size: Connections kept alive per upstream.
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.async_sessions = {}
+        self.lock = threading.Lock ()
+
+    def session (self, url):
+        """ The session of the upstream serving url, created on first use. """
+        parts = urlsplit (url)
+        upstream = f"{parts.scheme}://{parts.netloc}"
+        session = self.sessions.get (upstream)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get (upstream)
+                if session is None:
+                    session = requests.Session ()
+                    adapter = HTTPAdapter (pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount (f"{parts.scheme}://", adapter)
+                    self.sessions[upstream] = session
+        return session
+
+    def delay (self, attempt):
+        """ Full jitter: a random wait of up to backoff * 2^attempt seconds, capped. """
+        return random.uniform (0, min (self.max_backoff, self.backoff * (2 ** attempt)))
+
+    """ aiohttp timeouts connecting, in releases that tell them apart from timeouts reading. """
+    connect_timeouts = getattr (aiohttp, 'ConnectionTimeoutError', ())
+
+    def retryable (self, error):
+        """ Whether a failed call may succeed if tried again: it failed to connect, rather than timed out reading. """
+        if isinstance (error, self.connect_timeouts):
+            return True
+        if isinstance (error, (requests.ReadTimeout, asyncio.TimeoutError)):
+            return False
+        return isinstance (error, (requests.ConnectionError, aiohttp.ClientConnectionError))
+
+    def attempts (self, method, idempotent):
+        if idempotent is None:
+            idempotent = method in self.idempotent_methods
+        return 1 + (self.retries if idempotent else 0)
+
+    def request (self, method, url, idempotent=None, **kwargs):
+        """
+        Invoke an upstream, propagating the trace context of the current span.
+
+        :param idempotent: Whether the call may be retried. Defaults to whether the method is idempotent.
+        """
+        method = method.upper ()
+        kwargs.setdefault ('timeout', self.timeout)
+        session = self.session (url)
+        attempts = self.attempts (method, idempotent)
+        for attempt in range (attempts):
+            start = time.time ()
+            with span ("upstream", kind="client", method=method, url=url, attempt=attempt) as upstream_span:
+                kwargs['headers'] = inject (dict(kwargs.get ('headers') or {}))
+                try:
+                    response = session.request (method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    observe_reasoner_requests ([ { "url" : url, "status" : None, "elapsed" : time.time () - start } ])
+                    if attempt + 1 < attempts and self.retryable (e):
+                        self.retry (url, attempt, type(e).__name__, e)
+                        continue
+                    record_error (e)
+                    raise
+                except Exception as e:
+                    record_error (e)
+                    observe_reasoner_requests ([ { "url" : url, "status" : None, "elapsed" : time.time () - start } ])
+                    raise
+                upstream_span.set_attribute ("status", response.status_code)
+            observe_reasoner_requests ([ { "url" : url, "status" : response.status_code, "elapsed" : time.time () - start } ])
+            if response.status_code in self.retry_statuses and attempt + 1 < attempts:
+                response.close ()
+                self.retry (url, attempt, str(response.status_code), response.status_code)
+                continue
+            return response
+
+    def retry (self, url, attempt, reason, detail):
+        time.sleep (self.note_retry (url, attempt, reason, detail))
+
+    def note_retry (self, url, attempt, reason, detail):
+        """ Record a retry, returning how long to wait before it. """
+        delay = self.delay (attempt)
+        logger.warning ("Retrying %s in %.2fs after attempt %d failed: %s", url, delay, attempt + 1, detail)
+        observe_upstream_retry (url, reason)
+        return delay
+
+    def async_session (self):
+        """ The aiohttp session of the running event loop, created on first use. """
+        loop = asyncio.get_running_loop ()
+        session = self.async_sessions.get (loop)
+        if session is None or session.closed:
+            for stale in [ l for l in self.async_sessions if l.is_closed () ]:
+                del self.async_sessions[stale]
+            connect_timeout, read_timeout = self.timeout
+            session = aiohttp.ClientSession (
+                connector=aiohttp.TCPConnector (limit=0, limit_per_host=self.pool_size),
+                timeout=aiohttp.ClientTimeout (sock_connect=connect_timeout, sock_read=read_timeout))
+            self.async_sessions[loop] = session
+        return session
+
+    async def request_async (self, method, url, idempotent=None, **kwargs):
+        """
+        Invoke an upstream without blocking the event loop. Takes the keyword arguments of request.
+
+        :return: An UpstreamResponse.
+        """
+        method = method.upper ()
+        if not kwargs.pop ('verify', True):
+            kwargs['ssl'] = False
+        timeout = kwargs.pop ('timeout', None)
+        if timeout is not None:
+            connect_timeout, read_timeout = timeout if isinstance (timeout, tuple) else (timeout, timeout)
+            kwargs['timeout'] = aiohttp.ClientTimeout (sock_connect=connect_timeout, sock_read=read_timeout)
+        session = self.async_session ()
+        attempts = self.attempts (method, idempotent)
+        for attempt in range (attempts):
+            start = time.time ()
+            with span ("upstream", kind="client", method=method, url=url, attempt=attempt) as upstream_span:
+                kwargs['headers'] = inject (dict(kwargs.get ('headers') or {}))
+                try:
+                    async with session.request (method, url, **kwargs) as http_response:
+                        response = UpstreamResponse (
+                            url, http_response.status, await http_response.read (),
+                            http_response.get_encoding () if http_response.content_type.startswith ('text/') else None)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    observe_reasoner_requests ([ { "url" : url, "status" : None, "elapsed" : time.time () - start } ])
+                    if attempt + 1 < attempts and self.retryable (e):
+                        await asyncio.sleep (self.note_retry (url, attempt, type(e).__name__, e))
+                        continue
+                    record_error (e)
+                    raise
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    record_error (e)
+                    observe_reasoner_requests ([ { "url" : url, "status" : None, "elapsed" : time.time () - start } ])
+                    raise
+                upstream_span.set_attribute ("status", response.status_code)
+            observe_reasoner_requests ([ { "url" : url, "status" : response.status_code, "elapsed" : time.time () - start } ])
+            if response.status_code in self.retry_statuses and attempt + 1 < attempts:
+                await asyncio.sleep (self.note_retry (url, attempt, str(response.status_code), response.status_code))
+                continue
+            return response
+
+    def close (self):
+        with self.lock:
+            for session in self.sessions.values ():
+                session.close ()
+            self.sessions.clear ()
+
+    async def close_async (self):
+        """ Close the aiohttp session of the running event loop. """
+        session = self.async_sessions.pop (asyncio.get_running_loop (), None)
+        if session is not None:
+            await session.close ()
+
+""" The upstream client of the process. """
+_client = UpstreamClient ()
+
+def configure_upstream (config):
+    """ Install an upstream client from the UPSTREAM_* configuration settings. """
+    global _client
+    _client.close ()
+    _client = UpstreamClient (
+        connect_timeout=float(config.get ('UPSTREAM_CONNECT_TIMEOUT', 5)),
+        read_timeout=float(config.get ('UPSTREAM_READ_TIMEOUT', 300)),
+        retries=int(config.get ('UPSTREAM_RETRIES', 2)),
+        backoff=float(config.get ('UPSTREAM_BACKOFF', 0.5)),
+        pool_size=int(config.get ('UPSTREAM_POOL_SIZE', 10)))
+    return _client
+
+def get_upstream ():
+    return _client
+
+def upstream_request (method, url, **kwargs):
+    """ Invoke an upstream with the process upstream client. """
+    return _client.request (method, url, **kwargs)
+
+async def upstream_request_async (method, url, **kwargs):
+    """ Invoke an upstream from a coroutine with the process upstream client. """
+    return await _client.request_async (method, url, **kwargs)
@@ -0,0 +1,108 @@
+"""
+Capture a sample of query traffic for debugging without slowing requests down.
+
+Captured payloads go to a ring buffer of recent captures and, if a directory is configured,
+to a background thread that writes each one to its own file. Request threads never touch the
+disk: when the writer falls behind, captures are dropped and counted rather than queued
+without bound.
+"""
+import collections
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+logger = logging.getLogger (__name__)
+
+class QueryCapture:
+    """ Sampled, asynchronous capture of named payloads. """
+
+    def __init__(self, directory=None, sample_rate=0.0, capacity=100):
+        """
+        :param directory: Where to write captures. None keeps them in memory only.
+        :param sample_rate: Fraction of payloads to capture, from 0 (none) to 1 (all).
+        :param capacity: How many recent captures to keep in memory, and how many may wait to be written.
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.recent_captures = collections.deque (maxlen=capacity)
+        self.pending = queue.Queue (maxsize=capacity)
+        self.sequence = 0
+        self.dropped = 0
+        self.lock = threading.Lock ()
+        self.writer = None
+        if directory:
+            os.makedirs (directory, exist_ok=True)
+            self.writer = threading.Thread (target=self.write_captures, name="tranql-capture", daemon=True)
+            self.writer.start ()
+
+    @property
+    def enabled (self):
+        return self.sample_rate > 0
+
+    def capture (self, name, payload):
+        """ Capture a payload if it is sampled. Returns immediately. """
+        if self.sample_rate <= 0 or random.random () >= self.sample_rate:
+            return False
+        with self.lock:
+            self.sequence += 1
+            record = {
+                "name" : name,
+                "sequence" : self.sequence,
+                "time" : time.time (),
+                "payload" : payload
+            }
+        self.recent_captures.append (record)
+        if self.writer is not None:
+            try:
+                self.pending.put_nowait (record)
+            except queue.Full:
+                with self.lock:
+                    self.dropped += 1
+        return True
+
+    def recent (self):
+        """ The most recent captures, oldest first. """
+        return list(self.recent_captures)
+
+    def flush (self):
+        """ Wait until every pending capture is written. """
+        if self.writer is not None:
+            self.pending.join ()
+
+    def write_captures (self):
+        while True:
+            record = self.pending.get ()
+            try:
+                file_name = os.path.join (
+                    self.directory,
+                    f"{int(record['time'] * 1000)}-{record['sequence']:06d}-{record['name']}.json")
+                with open (file_name, "w") as stream:
+                    json.dump (record['payload'], stream, indent=2)
+            except Exception as e:
+                logger.warning (f"Failed to write capture {record['name']}: {e}")
+            finally:
+                self.pending.task_done ()
+
+""" The capture facility of the process. Disabled until configured. """
+_capture = QueryCapture ()
+
+def configure_capture (config):
+    """ Install a capture facility from the CAPTURE_* configuration settings. """
+    global _capture
+    directory = config.get ('CAPTURE_DIRECTORY')
+    _capture = QueryCapture (
+        directory=directory if directory and directory != 'none' else None,
+        sample_rate=float(config.get ('CAPTURE_SAMPLE_RATE', 0) or 0),
+        capacity=int(config.get ('CAPTURE_CAPACITY', 100)))
+    return _capture
+
+def get_capture ():
+    return _capture
+
+def capture (name, payload):
+    """ Capture a payload with the process capture facility. """
+    return _capture.capture (name, payload)
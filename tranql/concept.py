@@ -8,6 +8,8 @@ from collections import OrderedDict
 class Concept:
     """ A semantic type or concept. A high level idea comprising one or more identifier namespace.
     Provides rudimentary notion of specialization via is_a. """
+    __slots__ = ('name', 'is_a', 'id_prefixes')
+
     def __init__(self, name, is_a, id_prefixes):
         self.name = name
         #Only a single parent?
@@ -21,6 +23,8 @@ class Concept:
 class Relationship:
     """ A semantic type for a relationship (or slot)
     Provides rudimentary notion of specialization via is_a. """
+    __slots__ = ('name', 'is_a', 'mappings', 'identifier')
+
     def __init__(self, name, is_a, mappings):
         self.name = name
         #Only a single parent?
@@ -34,3 +34,7 @@ class IllegalConceptIdentifierError(TranQLException):
 class UnknownServiceError(TranQLException):
     def __init__(self, message):
         super().__init__(message)
+
+class QueryCancelledError(TranQLException):
+    def __init__(self, message):
+        super().__init__(message)
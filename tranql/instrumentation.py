@@ -0,0 +1,288 @@
+import contextvars
+import importlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger (__name__)
+
+""" W3C trace context header: version-trace_id-parent_id-flags """
+traceparent_pattern = re.compile (r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+def new_trace_id ():
+    return "%032x" % random.getrandbits (128)
+
+def new_span_id ():
+    return "%016x" % random.getrandbits (64)
+
+""" The instrumentation collecting spans in the current context, if any. """
+_active = contextvars.ContextVar ("tranql_instrumentation", default=None)
+
+""" The innermost open span in the current context. """
+_current = contextvars.ContextVar ("tranql_span", default=None)
+
+class Span:
+    """ A named, timed unit of work. Spans nest to form a tree. """
+
+    """ OpenTelemetry span kinds. """
+    kinds = { "internal" : 1, "server" : 2, "client" : 3 }
+
+    def __init__(self, name, attributes={}, trace_id=None, parent_span_id=None, kind="internal"):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.children = []
+        self.trace_id = trace_id or new_trace_id ()
+        self.span_id = new_span_id ()
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.start = time.time ()
+        self.started = time.perf_counter ()
+        self.duration = None
+
+    def set_attribute (self, key, value):
+        self.attributes[key] = value
+
+    def finish (self):
+        self.duration = time.perf_counter () - self.started
+
+    def walk (self):
+        """ Yield this span and all of its descendants. """
+        yield self
+        for child in self.children:
+            yield from child.walk ()
+
+    def traceparent (self):
+        """ The W3C trace context header value making this span the parent of a remote span. """
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp (self):
+        """ Encode the span in the OTLP JSON format. """
+        start = int (self.start * 1e9)
+        end = start + int ((self.duration or 0) * 1e9)
+        result = {
+            "traceId" : self.trace_id,
+            "spanId" : self.span_id,
+            "name" : self.name,
+            "kind" : self.kinds.get (self.kind, 1),
+            "startTimeUnixNano" : str(start),
+            "endTimeUnixNano" : str(end),
+            "attributes" : [
+                { "key" : k, "value" : otlp_value (v) } for k, v in self.attributes.items ()
+            ],
+            "status" : { "code" : 2 if "error" in self.attributes else 1 }
+        }
+        if self.parent_span_id:
+            result["parentSpanId"] = self.parent_span_id
+        return result
+
+    def to_dict (self):
+        return {
+            "name" : self.name,
+            "start" : self.start,
+            "duration" : self.duration,
+            "attributes" : self.attributes,
+            "children" : [ c.to_dict () for c in self.children ]
+        }
+
+    def __repr__(self):
+        return f"Span({self.name},{self.duration})"
+
+def otlp_value (value):
+    """ Encode an attribute value as an OTLP AnyValue. """
+    if isinstance(value, bool):
+        return { "boolValue" : value }
+    elif isinstance(value, int):
+        return { "intValue" : str(value) }
+    elif isinstance(value, float):
+        return { "doubleValue" : value }
+    return { "stringValue" : str(value) }
+
+class NullSpan:
+    """ Stand in for a span when no instrumentation is active. """
+    def set_attribute (self, key, value):
+        pass
+    def traceparent (self):
+        return None
+
+null_span = NullSpan ()
+
+class Instrumentation:
+    """
+    Collect timing spans for the execution of a program.
+
+    Code on execution paths opens spans with the module level span () function. Spans are recorded
+    only while an instrumentation is active in the current context, so library code pays nearly
+    nothing when nobody is listening. Context variables carry the active instrumentation and the
+    current span across asyncio tasks.
+
+    An instrumentation records a single trace. Given the traceparent header of an incoming request
+    it continues the caller's trace. Finished spans go to the configured exporter, if any.
+    """
+    def __init__(self, traceparent=None):
+        self.spans = []
+        self.trace_id = new_trace_id ()
+        self.remote_parent_id = None
+        match = traceparent_pattern.match (traceparent.strip().lower()) if traceparent else None
+        if match:
+            self.trace_id = match.group (2)
+            self.remote_parent_id = match.group (3)
+
+    @contextmanager
+    def activate (self):
+        """ Record spans opened in this context. """
+        token = _active.set (self)
+        span_token = _current.set (None)
+        try:
+            yield self
+        finally:
+            _current.reset (span_token)
+            _active.reset (token)
+
+    @contextmanager
+    def span (self, name, kind="internal", **attributes):
+        """ Time a block of work as a child of the current span. """
+        parent = _current.get ()
+        span = Span (name, attributes,
+                     trace_id=self.trace_id,
+                     parent_span_id=parent.span_id if parent else self.remote_parent_id,
+                     kind=kind)
+        if parent is None:
+            self.spans.append (span)
+        else:
+            parent.children.append (span)
+        token = _current.set (span)
+        try:
+            yield span
+        except Exception as e:
+            span.set_attribute ("error", type(e).__name__)
+            raise
+        finally:
+            span.finish ()
+            _current.reset (token)
+            exporter = _exporter
+            if exporter is not None:
+                try:
+                    exporter.export ([ span ])
+                except Exception as e:
+                    logger.warning (f"Failed to export span {span.name}: {e}")
+
+    def walk (self):
+        for root in self.spans:
+            yield from root.walk ()
+
+    def summarize (self):
+        """ Total time and count per span name. """
+        result = defaultdict(lambda: { "count" : 0, "total" : 0.0 })
+        for span in self.walk ():
+            if span.duration is not None:
+                phase = result[span.name]
+                phase['count'] += 1
+                phase['total'] += span.duration
+        return dict(result)
+
+    def to_dict (self):
+        return {
+            "total" : sum ([ s.duration for s in self.spans if s.duration is not None ]),
+            "phases" : self.summarize (),
+            "spans" : [ s.to_dict () for s in self.spans ]
+        }
+
+@contextmanager
+def span (name, kind="internal", **attributes):
+    """ Open a span on the active instrumentation. A no-op if none is active. """
+    instrumentation = _active.get ()
+    if instrumentation is None:
+        yield null_span
+    else:
+        with instrumentation.span (name, kind=kind, **attributes) as s:
+            yield s
+
+def inject (headers):
+    """ Add the trace context of the current span to a dict of outgoing HTTP headers. """
+    current = _current.get ()
+    if current is not None:
+        headers['traceparent'] = current.traceparent ()
+    return headers
+
+class SpanExporter:
+    """ Receives finished spans. Subclass to send them somewhere. """
+    def export (self, spans):
+        raise NotImplementedError ()
+    def shutdown (self):
+        pass
+
+class InMemorySpanExporter(SpanExporter):
+    """ Keep finished spans in memory. Useful for tests. """
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock ()
+    def export (self, spans):
+        with self.lock:
+            self.spans.extend (spans)
+    def get_finished_spans (self):
+        with self.lock:
+            return list(self.spans)
+    def clear (self):
+        with self.lock:
+            self.spans.clear ()
+
+class FileSpanExporter(SpanExporter):
+    """ Append finished spans to a file, one OTLP JSON encoded span per line. """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock ()
+    def export (self, spans):
+        lines = "".join ([ json.dumps (s.to_otlp ()) + "\n" for s in spans ])
+        with self.lock:
+            with open (self.path, "a") as stream:
+                stream.write (lines)
+
+class LoggingSpanExporter(SpanExporter):
+    """ Log finished spans. """
+    def export (self, spans):
+        for s in spans:
+            logger.info (json.dumps (s.to_otlp ()))
+
+""" The exporter receiving finished spans. None disables export. """
+_exporter = None
+
+def set_exporter (exporter):
+    """ Install the exporter receiving finished spans, returning the previous one. """
+    global _exporter
+    previous = _exporter
+    _exporter = exporter
+    return previous
+
+def get_exporter ():
+    return _exporter
+
+def configure_exporter (spec):
+    """
+    Install an exporter described by a configuration string:
+       none                   - disable export.
+       memory                 - keep spans in memory.
+       log                    - log spans.
+       file:<path>            - append spans to a file.
+       <module>:<class>       - any SpanExporter subclass with a no argument constructor.
+    """
+    exporter = None
+    if not spec or spec == 'none':
+        exporter = None
+    elif spec == 'memory':
+        exporter = InMemorySpanExporter ()
+    elif spec == 'log':
+        exporter = LoggingSpanExporter ()
+    elif spec.startswith ('file:'):
+        exporter = FileSpanExporter (spec[len('file:'):])
+    elif ':' in spec:
+        module_name, class_name = spec.split (':', 1)
+        exporter = getattr (importlib.import_module (module_name), class_name) ()
+    else:
+        raise ValueError (f"Unknown trace exporter: {spec}")
+    set_exporter (exporter)
+    return exporter
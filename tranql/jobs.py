@@ -0,0 +1,151 @@
+"""
+Run TranQL queries as background jobs.
+
+A job manager owns an event loop on a daemon thread and runs each submitted program with the
+asynchronous interpreter. At most `workers` jobs run at once; the rest wait their turn.
+Callers poll a job for its status and partial results and may cancel it. Cancelling a job
+cancels its task, which aborts the reasoner requests it has in flight.
+"""
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from tranql.exception import QueryCancelledError
+from tranql.main import TranQL
+from tranql.request_util import run_blocking
+
+logger = logging.getLogger (__name__)
+
+class Job:
+    """ A query submitted for background execution. """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, query, traceparent=None, sink=None):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.traceparent = traceparent
+        """ Receives the elements of the job's final select statement as they are merged. See TranQL.execute. """
+        self.sink = sink
+        self.status = Job.QUEUED
+        self.created = time.time ()
+        self.started = None
+        self.finished = None
+        self.tranql = None
+        self.context = None
+        self.error = None
+        self.completed = 0
+        self.total = None
+        self.partial = None
+        self.future = None
+
+    @property
+    def done (self):
+        return self.status in (Job.DONE, Job.FAILED, Job.CANCELLED)
+
+    def progress (self, completed, total, context):
+        """ Record the result of the most recently completed statement. """
+        self.completed = completed
+        self.total = total
+        self.partial = context.mem.get ('result')
+
+    def to_dict (self):
+        return {
+            "job_id" : self.id,
+            "status" : self.status,
+            "created" : self.created,
+            "started" : self.started,
+            "finished" : self.finished,
+            "statements" : {
+                "completed" : self.completed,
+                "total" : self.total
+            }
+        }
+
+class JobManager:
+    """ Run queries on a bounded pool and keep their outcomes for a while. """
+
+    def __init__(self, workers=4, ttl=3600):
+        self.workers = workers
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock ()
+        self.loop = None
+        self.semaphore = None
+
+    def start (self):
+        """ Start the event loop thread on first use. """
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop ()
+                thread = threading.Thread (target=loop.run_forever, name="tranql-jobs", daemon=True)
+                thread.start ()
+                self.loop = loop
+        return self.loop
+
+    def submit (self, query, traceparent=None, sink=None):
+        """ Queue a program for execution, returning its job. """
+        loop = self.start ()
+        self.expire ()
+        job = Job (query, traceparent=traceparent, sink=sink)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.future = asyncio.run_coroutine_threadsafe (self.run (job), loop)
+        job.future.add_done_callback (lambda future: self.cancelled (job, future))
+        return job
+
+    def cancelled (self, job, future):
+        """ A job cancelled while queued never ran, so record its cancellation here. """
+        if future.cancelled () and not job.done:
+            job.error = QueryCancelledError (f"Job {job.id} was cancelled.")
+            job.status = Job.CANCELLED
+            job.finished = time.time ()
+
+    def get (self, job_id):
+        with self.lock:
+            return self.jobs.get (job_id)
+
+    def cancel (self, job_id):
+        """ Cancel a job. Returns the job, or None if there is no such job. """
+        job = self.get (job_id)
+        if job is not None and not job.done and job.future is not None:
+            job.future.cancel ()
+        return job
+
+    def expire (self):
+        """ Forget jobs that finished more than ttl seconds ago. """
+        horizon = time.time () - self.ttl
+        with self.lock:
+            for job_id in [ k for k, v in self.jobs.items () if v.finished and v.finished < horizon ]:
+                del self.jobs[job_id]
+
+    async def run (self, job):
+        if self.semaphore is None:
+            """ Created here so it belongs to the job loop. """
+            self.semaphore = asyncio.Semaphore (self.workers)
+        try:
+            async with self.semaphore:
+                job.status = Job.RUNNING
+                job.started = time.time ()
+                job.tranql = await run_blocking (TranQL)
+                job.context = await job.tranql.execute_async (
+                    job.query,
+                    traceparent=job.traceparent,
+                    progress=job.progress,
+                    sink=job.sink)
+                job.status = Job.DONE
+        except asyncio.CancelledError:
+            job.error = QueryCancelledError (f"Job {job.id} was cancelled.")
+            job.status = Job.CANCELLED
+            raise
+        except Exception as e:
+            logger.exception ("Job %s failed", job.id)
+            job.error = e
+            job.status = Job.FAILED
+        finally:
+            job.finished = time.time ()
@@ -0,0 +1,178 @@
+"""
+Merge reasoner responses into a single knowledge graph, one response at a time.
+"""
+import logging
+import sys
+
+logger = logging.getLogger (__name__)
+
+class KnowledgeGraphMerger:
+    """
+    Incrementally merge reasoner messages.
+
+    The first message is the base of the result: its top level properties are kept and its
+    nodes and edges are taken as they are. Nodes of later messages that share an identifier
+    or equivalent identifier with a node already merged are dropped, and edges that refer to
+    them are pointed at the surviving node. Edges already merged with the same type, source and
+    target are dropped. Knowledge map entries are appended.
+
+    With a synonym index, nodes whose identifiers belong to the same clique are also merged.
+
+    The merged graph is made of the nodes, edges and knowledge map entries of the messages, not
+    copies of them. Their curies (node ids, edge endpoints and types, and bindings) are interned
+    as they are merged, so each distinct curie is held once however many responses repeat it.
+
+    Each message's nodes are merged before its edges, so an edge is final as soon as it is
+    merged. That lets a sink see nodes, edges and knowledge map entries as they are merged, and
+    a merger that doesn't keep them pass them on without holding the whole result.
+    """
+    def __init__(self, resolve=None, sink=None, synonyms=None, keep=True):
+        """
+        :param resolve: Called with a node lacking equivalent_identifiers to find them. By default
+                        a node is only equivalent to its own identifier.
+        :param sink: Called with ("node", node), ("edge", edge) or ("answer", entry) as each is merged.
+        :param synonyms: A SynonymIndex of the cliques of identifiers.
+        :param keep: Whether the result holds the nodes, edges and knowledge map entries merged.
+        """
+        self.resolve = resolve
+        self.sink = sink
+        self.synonyms = synonyms
+        self.keep = keep
+        """ The number of each kind of element merged. """
+        self.merged = { "node" : 0, "edge" : 0, "answer" : 0 }
+        self.message = None
+        self.node_map = {}
+        self.equivalents = {}
+        self.edge_keys = set ()
+        self.resolved = 0
+
+    def emit (self, kind, item, elements):
+        """ Count an element merged, keep it in a list of the result if keeping them, and pass it to the sink. """
+        self.merged[kind] += 1
+        if self.keep:
+            elements.append (item)
+        if self.sink is not None:
+            self.sink (kind, item)
+
+    def equivalent_identifiers (self, node):
+        if 'equivalent_identifiers' not in node:
+            node['equivalent_identifiers'] = self.resolve (node) if self.resolve else [ node['id'] ]
+            self.resolved += 1
+        return node['equivalent_identifiers']
+
+    def keys (self, node):
+        """ The identifiers a node is known by: its equivalent identifiers and their cliques. """
+        identifiers = self.equivalent_identifiers (node)
+        if self.synonyms is None:
+            return identifiers
+        cliques = [ self.synonyms.clique (identifier) for identifier in [ node['id'], *identifiers ] ]
+        return identifiers + [ clique for clique in cliques if clique is not None ]
+
+    def index_node (self, node, keys):
+        """ Make a node findable by its id and keys, earliest node first. """
+        self.node_map[node['id']] = node
+        self.equivalents.setdefault (node['id'], node)
+        for identifier in keys:
+            self.equivalents.setdefault (identifier, node)
+
+    def intern_node (self, node):
+        node['id'] = intern (node['id'])
+
+    def edge_key (self, edge):
+        """ Edges with the same type, source and target are the same edge. Interns their curies. """
+        for field in ('type', 'source_id', 'target_id'):
+            if field in edge:
+                edge[field] = intern (edge[field])
+        return (edge.get ('type', None), edge['source_id'], edge['target_id'])
+
+    def add (self, response):
+        """ Merge a reasoner message. """
+        if self.message is None:
+            self.start (response)
+        elif 'knowledge_graph' in response:
+            self.merge (response)
+
+    def start (self, response):
+        kg = response['knowledge_graph']
+        self.message = { k : v for k, v in response.items () if k not in ('knowledge_graph', 'knowledge_map') }
+        self.message['knowledge_graph'] = dict (kg, nodes=[], edges=[])
+        self.message['knowledge_map'] = []
+        nodes = self.message['knowledge_graph']['nodes']
+        edges = self.message['knowledge_graph']['edges']
+        for node in kg.get ('nodes', []):
+            self.intern_node (node)
+            self.index_node (node, self.keys (node))
+            self.emit ("node", node, nodes)
+        for edge in kg.get ('edges', []):
+            self.edge_keys.add (self.edge_key (edge))
+            self.emit ("edge", edge, edges)
+        self.add_answers (response)
+
+    def merge (self, response):
+        rkg = response['knowledge_graph']
+        nodes = self.message['knowledge_graph']['nodes']
+        edges = self.message['knowledge_graph']['edges']
+        """
+        If possible, try to convert all nodes to a single identifier so that we don't end up with multiple separate nodes that are actually the same in the graph.
+        Example: https://i.imgur.com/Z76R1wZ.png. The node on left is called "citric acid," and the node on right is called "anhydrous citric acid." The left node's id is "CHEBI:30769" and the right node's id is "CHEMBL:CHEMBL1261." These identifiers are actually equivalent to each other.
+        """
+        replace = {}
+        for node in rkg.get ('nodes', []):
+            self.intern_node (node)
+            existing = None
+            keys = self.keys (node)
+            for identifier in keys:
+                existing = self.equivalents.get (identifier)
+                if existing is not None:
+                    break
+            if existing is None:
+                self.index_node (node, keys)
+                self.emit ("node", node, nodes)
+            elif existing['id'] != node['id']:
+                replace[node['id']] = existing['id']
+        for edge in rkg.get ('edges', []):
+            if edge['source_id'] in replace:
+                edge['source_id'] = replace[edge['source_id']]
+            if edge['target_id'] in replace:
+                edge['target_id'] = replace[edge['target_id']]
+            key = self.edge_key (edge)
+            if key not in self.edge_keys:
+                self.edge_keys.add (key)
+                self.emit ("edge", edge, edges)
+        self.add_answers (response)
+
+    def add_answers (self, response):
+        knowledge_map = self.message['knowledge_map']
+        for answer in response.get ('knowledge_map', []):
+            intern_bindings (answer)
+            self.emit ("answer", answer, knowledge_map)
+
+    def result (self):
+        if self.message is None:
+            return {
+                "knowledge_graph": {
+                    "nodes": [],
+                    "edges": []
+                },
+                "knowledge_map": []
+            }
+        return self.message
+
+def intern (value):
+    """ The one copy of a string, or the value if it is not a string. """
+    return sys.intern (value) if isinstance (value, str) else value
+
+def intern_bindings (answer):
+    """ Intern the curies a knowledge map entry binds. """
+    bindings = answer.get ('node_bindings', None) if isinstance (answer, dict) else None
+    if isinstance (bindings, dict):
+        for name, value in bindings.items ():
+            bindings[name] = [ intern (v) for v in value ] if isinstance (value, list) else intern (value)
+
+def bindings (answers, name):
+    """ The values bound to a question node by each of a list of knowledge map entries binding it. """
+    return [
+        answer['node_bindings'][name]
+        for answer in answers
+        if isinstance (answer, dict) and name in (answer.get ('node_bindings') or {})
+    ]
@@ -36,13 +36,19 @@ import logging
 import os
 import requests_cache
 import sys
+import threading
 import traceback
 from tranql.config import Config
 from tranql.util import Context
 from tranql.util import JSONKit
 from tranql.util import Concept
 from tranql.util import LoggingUtil
-from tranql.tranql_ast import TranQL_AST
+from tranql.tranql_ast import TranQL_AST, SelectStatement
+from tranql.tranql_schema import Schema
+from tranql.instrumentation import Instrumentation, span, configure_exporter
+from tranql.name_resolver import NameResolver
+from tranql.synonyms import open_synonyms
+from tranql.request_util import run_blocking
 from pyparsing import (
     Combine, Word, White, Literal, delimitedList, Optional,
     Group, alphas, alphanums, printables, Forward, oneOf, quotedString,
@@ -58,9 +64,9 @@ Statements can be 'set' or 'select' statements.
 
 """
 statement = Forward()
-SELECT, FROM, WHERE, SET, AS, CREATE, GRAPH, AT = map(
+SELECT, FROM, WHERE, SET, AS, CREATE, GRAPH, AT, EXPLAIN, ANALYZE = map(
     CaselessKeyword,
-    "select from where set as create graph at".split())
+    "select from where set as create graph at explain analyze".split())
 
 concept_name    = Word( alphas, alphanums + ":_")
 ident          = Word( "$" + alphas, alphanums + "_$" ).setName("identifier")
@@ -112,13 +118,18 @@ setExpression << setStatement + ZeroOrMore( ( and_ | or_ ) + setExpression )
 optWhite = ZeroOrMore(LineEnd() | White())
 
 """ Define the statement grammar. """
+selectStatement = Group(
+    Group(SELECT + question_graph_expression)("concepts") + optWhite +
+    Group(FROM + tableNameList) + optWhite +
+    Group(Optional(WHERE + whereExpression("where"), "")) + optWhite +
+    Group(Optional(SET + setExpression("set"), ""))("select")
+)
 statement <<= (
     Group(
-        Group(SELECT + question_graph_expression)("concepts") + optWhite +
-        Group(FROM + tableNameList) + optWhite +
-        Group(Optional(WHERE + whereExpression("where"), "")) + optWhite +
-        Group(Optional(SET + setExpression("set"), ""))("select")
-    )
+        EXPLAIN + Optional(ANALYZE) + optWhite + selectStatement
+    )("explain")
+    |
+    selectStatement
     |
     Group(
         SET + (columnName + EQ + ( quotedString |
@@ -148,8 +159,56 @@ class TranQLParser:
         self.backplane = backplane
     def parse (self, line):
         """ Parse a program, returning an abstract syntax tree. """
-        result = self.program.parseString (line)
-        return TranQL_AST (result.asList (), self.backplane)
+        with span ("parse"):
+            result = self.program.parseString (line)
+        with span ("ast"):
+            return TranQL_AST (result.asList (), self.backplane)
+
+class InterpreterCore:
+    """
+    The parts of an interpreter that programs don't change: its configuration, parser, and the
+    services statements use. Built once per backplane and shared by every interpreter, so making
+    an interpreter per request costs a context and little else.
+    """
+    __slots__ = ('config', 'backplane', 'parser', 'asynchronous', 'resolve_names', 'batch_requests',
+                 'name_resolver', 'synonyms')
+
+    _shared = {}
+    _shared_lock = threading.Lock ()
+
+    def __init__(self, backplane, asynchronous):
+        self.config = Config ("conf.yml")
+
+        env_backplane = self.config['BACKPLANE']
+        self.backplane = env_backplane if env_backplane else backplane
+        self.parser = TranQLParser (self.backplane)
+
+        # If config has arg use, else use constructor arg
+        self.asynchronous = self.config.get('ASYNCHRONOUS_REQUESTS',asynchronous)
+        self.resolve_names = str(self.config.get ('RESOLVE_NAMES', False)).lower () == 'true'
+
+        """ Whether to send the backplane the questions of a statement in batches. """
+        self.batch_requests = str(self.config.get ('BATCH_REQUESTS', True)).lower () == 'true'
+
+        """ Looks up the identifiers of names, remembering them across queries. """
+        self.name_resolver = NameResolver.shared (
+            workers=int(self.config.get ('NAME_RESOLUTION_WORKERS', 8)),
+            ttl=float(self.config.get ('NAME_RESOLUTION_TTL', 24 * 60 * 60)),
+            limit=int(self.config.get ('NAME_RESOLUTION_CACHE_SIZE', 100000)))
+
+        """ A local index of equivalent identifiers consulted when merging, if one is configured. """
+        self.synonyms = open_synonyms (self.config)
+
+        Schema.shared_ttl = float(self.config.get ('SCHEMA_TTL', Schema.shared_ttl))
+
+    @classmethod
+    def shared (cls, backplane, asynchronous):
+        key = (backplane, asynchronous)
+        with cls._shared_lock:
+            core = cls._shared.get (key)
+            if core is None:
+                core = cls._shared[key] = cls (backplane, asynchronous)
+        return core
 
 class TranQL:
     """
@@ -159,27 +218,25 @@ class TranQL:
       Generate an abstract syntax tree
       Execute statements in the abstract syntax tree.
     """
+    """ Timing spans for the most recent execution. Empty until the first one. """
+    instrumentation = Instrumentation ()
+
     def __init__(self, backplane="http://localhost:8099", asynchronous=True):
-        """ Initialize the interpreter. """
+        """ Initialize the interpreter. Its configuration, parser and services are shared. """
+        core = InterpreterCore.shared (backplane, asynchronous)
+        self.core = core
+        self.config = core.config
         self.context = Context ()
-        config_path = "conf.yml"
-        self.config = Config (config_path)
-
-        t = os.path.join (os.path.dirname (__file__), "conf.test")
-        with open(t, "w") as stream:
-            stream.write (f" --- backplane: {self.config['BACKPLANE']}")
+        self.context.set ("backplane", core.backplane)
+        self.parser = core.parser
+        self.asynchronous = core.asynchronous
+        self.resolve_names = core.resolve_names
+        self.batch_requests = core.batch_requests
+        self.name_resolver = core.name_resolver
+        self.synonyms = core.synonyms
 
-        env_backplane = self.config['BACKPLANE']
-        if env_backplane:
-            backplane = env_backplane
-        self.context.set ("backplane", backplane)
-        self.parser = TranQLParser (backplane)
-
-        # If config has arg use, else use constructor arg
-        asynchronous = self.config.get('ASYNCHRONOUS_REQUESTS',asynchronous)
-
-        self.asynchronous = asynchronous
-        self.resolve_names = False
+        """ Whether the most recent execution streamed its result to a sink. """
+        self.streamed = False
 
     def parse (self, program):
         """ If we just want the AST. """
@@ -191,8 +248,10 @@ class TranQL:
             result = self.parse (stream.read ())
         return result
 
-    def execute (self, program, cache=False):
-        """ Execute a program - a list of statements. """
+    def execute (self, program, cache=False, traceparent=None, sink=None):
+        """ Execute a program - a list of statements.
+        A W3C traceparent header value makes the execution part of the caller's trace.
+        A sink receives the knowledge graph elements of a final select statement as they are merged. """
         ast = None
         if cache:
             requests_cache.install_cache('demo_cache',
@@ -200,15 +259,54 @@ class TranQL:
         else:
             requests_cache.disabled()
 
-        if isinstance(program, str):
-            ast = self.parse (program)
-        if not ast:
-            raise ValueError (f"Unhandled type: {type(program)}")
-        for statement in ast.statements:
-            logger.debug (f"execute: {statement} type={type(statement).__name__}")
-            statement.execute (interpreter=self)
+        self.instrumentation = Instrumentation (traceparent=traceparent)
+        with self.instrumentation.activate ():
+            with span ("execute"):
+                if isinstance(program, str):
+                    ast = self.parse (program)
+                if not ast:
+                    raise ValueError (f"Unhandled type: {type(program)}")
+                self.stream (ast, sink)
+                for statement in ast.statements:
+                    logger.debug ("execute: %s type=%s", statement, type(statement).__name__)
+                    with span ("statement", type=type(statement).__name__):
+                        statement.execute (interpreter=self)
         return self.context
 
+    async def execute_async (self, program, cache=False, traceparent=None, progress=None, sink=None):
+        """ Execute a program from a coroutine. Reasoner requests are awaited on the running
+        event loop; parsing and statements without native asynchronous I/O run in worker threads.
+        If given, progress (completed, total, context) is called after each statement. """
+        ast = None
+        if cache:
+            requests_cache.install_cache('demo_cache',
+                                         allowable_methods=('GET', 'POST', ))
+        else:
+            requests_cache.disabled()
+
+        self.instrumentation = Instrumentation (traceparent=traceparent)
+        with self.instrumentation.activate ():
+            with span ("execute"):
+                if isinstance(program, str):
+                    ast = await run_blocking (self.parse, program)
+                if not ast:
+                    raise ValueError (f"Unhandled type: {type(program)}")
+                self.stream (ast, sink)
+                for index, statement in enumerate(ast.statements):
+                    logger.debug ("execute: %s type=%s", statement, type(statement).__name__)
+                    with span ("statement", type=type(statement).__name__):
+                        await statement.execute_async (interpreter=self)
+                    if progress:
+                        progress (index + 1, len(ast.statements), self.context)
+        return self.context
+
+    def stream (self, ast, sink):
+        """ Connect a sink to the final statement if it is a select. """
+        self.streamed = False
+        if sink is not None and len(ast.statements) > 0 and isinstance (ast.statements[-1], SelectStatement):
+            ast.statements[-1].sink = sink
+            self.streamed = True
+
     def execute_file (self, program):
         """ Execute a file on disk, soup to nuts. """
         with open (program, "r") as stream:
@@ -260,7 +358,7 @@ class TranQL:
                                     print (f"{val}")
                             else:
                                 response = self.execute (block)
-                                print (f"{json.dumps(response.mem, indent=2)}")
+                                print (f"{json.dumps(dict(response.mem), indent=2)}")
                     print (f"$ ", end='')
                 else:
                     buf.append (line)
@@ -308,6 +406,8 @@ def main ():
     if args.verbose:
         set_verbose ()
 
+    configure_exporter (Config ("conf.yml").get ('TRACE_EXPORTER'))
+
     if args.cache:
         """ Turn on the requests cache. """
         requests_cache.install_cache('demo_cache',
@@ -316,7 +416,7 @@ def main ():
     """ Create an interpreter. """
     tranql = TranQL (backplane = args.backplane, asynchronous = args.asynchronous)
     for k, v in query_args.items ():
-        logger.debug (f"setting {k}={v}")
+        logger.debug ("setting %s=%s", k, v)
         tranql.context.set (k, v)
     context = None
     if args.shell:
@@ -326,7 +426,7 @@ def main ():
         """ Run a program. """
         context = tranql.execute_file (args.source)
         if args.output == 'stdout':
-            print (f"{json.dumps(context.mem, indent=2)}")
+            print (f"{json.dumps(dict(context.mem), indent=2)}")
             print (f"top-gene: {json.dumps(context.top('gene',k='chemical_pathways'), indent=2)}")
     else:
         print ("Either source or shell must be specified")
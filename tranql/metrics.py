@@ -0,0 +1,128 @@
+"""
+Prometheus metrics for the TranQL API and backplane.
+
+Metrics live in the default registry of the process. Servers call instrument (app, name) to
+count and time their routes and to expose the registry at /metrics. The interpreter records
+reasoner traffic, query shape and errors as it runs, whether or not a server is listening, so
+only instrument needs Flask, and imports it.
+
+Cache hit ratios are derived at query time, eg:
+    rate(tranql_cache_requests_total{result="hit"}[5m]) / rate(tranql_cache_requests_total[5m])
+"""
+import logging
+import time
+from urllib.parse import urlsplit
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger (__name__)
+
+http_requests = Counter (
+    "tranql_http_requests_total",
+    "HTTP requests served, by route and status.",
+    [ "app", "method", "route", "status" ])
+http_request_latency = Histogram (
+    "tranql_http_request_duration_seconds",
+    "Time spent serving HTTP requests, by route.",
+    [ "app", "method", "route" ],
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+http_requests_in_flight = Gauge (
+    "tranql_http_requests_in_flight",
+    "HTTP requests currently being served.",
+    [ "app" ])
+
+reasoner_requests = Counter (
+    "tranql_reasoner_requests_total",
+    "Requests made to downstream reasoners, by service and status.",
+    [ "service", "status" ])
+reasoner_latency = Histogram (
+    "tranql_reasoner_request_duration_seconds",
+    "Latency of requests to downstream reasoners, by service.",
+    [ "service" ],
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+upstream_retries = Counter (
+    "tranql_upstream_retries_total",
+    "Retried requests to upstream services, by service and reason.",
+    [ "service", "reason" ])
+
+cache_requests = Counter (
+    "tranql_cache_requests_total",
+    "Lookups of response caches, by cache and result (hit or miss).",
+    [ "cache", "result" ])
+
+questions_per_query = Histogram (
+    "tranql_questions_per_query",
+    "Questions sent to a reasoner per select statement.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+merge_size = Histogram (
+    "tranql_merge_size",
+    "Size of merged knowledge graphs, by element kind.",
+    [ "kind" ],
+    buckets=(0, 10, 100, 1000, 5000, 10000, 50000, 100000, 500000))
+
+errors = Counter (
+    "tranql_errors_total",
+    "Errors by exception class.",
+    [ "error" ])
+
+def service_label (url):
+    """ Label a downstream service by its url, less any query string. """
+    if not url:
+        return "unknown"
+    parts = urlsplit (url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}" if parts.netloc else parts.path
+
+def observe_reasoner_requests (stats):
+    """ Record the per request stats (url, status, elapsed, bytes) of calls to reasoners. """
+    for stat in stats:
+        service = service_label (stat.get ('url'))
+        reasoner_requests.labels (service, str(stat.get ('status'))).inc ()
+        reasoner_latency.labels (service).observe (stat.get ('elapsed', 0))
+
+def observe_upstream_retry (url, reason):
+    upstream_retries.labels (service_label (url), reason).inc ()
+
+def observe_cache (cache, response):
+    """ Record whether a response came from a requests_cache cache. """
+    observe_cache_lookup (cache, getattr (response, 'from_cache', False))
+
+def observe_cache_lookup (cache, hit):
+    cache_requests.labels (cache, "hit" if hit else "miss").inc ()
+
+def observe_merge (nodes, edges):
+    """ Record the number of nodes and edges in a merged knowledge graph. """
+    merge_size.labels ("nodes").observe (nodes)
+    merge_size.labels ("edges").observe (edges)
+
+def record_error (error):
+    errors.labels (type(error).__name__).inc ()
+
+def observe_http_request (app, method, route, status, elapsed):
+    http_requests.labels (app, method, route, str(status)).inc ()
+    http_request_latency.labels (app, method, route).observe (elapsed)
+
+def instrument (app, name):
+    """ Count and time every request served by a Flask app and serve the registry at /metrics. """
+    from flask import Response, g, request
+
+    def metrics_response ():
+        return Response (generate_latest (), mimetype=CONTENT_TYPE_LATEST)
+
+    @app.before_request
+    def start_request ():
+        g.metrics_start = time.perf_counter ()
+        http_requests_in_flight.labels (name).inc ()
+
+    @app.after_request
+    def finish_request (response):
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        elapsed = time.perf_counter () - g.get ('metrics_start', time.perf_counter ())
+        observe_http_request (name, request.method, route, response.status_code, elapsed)
+        return response
+
+    @app.teardown_request
+    def end_request (exception=None):
+        if 'metrics_start' in g:
+            http_requests_in_flight.labels (name).dec ()
+
+    app.add_url_rule ('/metrics', 'metrics', metrics_response)
+    return app
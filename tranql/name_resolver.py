@@ -0,0 +1,117 @@
+"""
+Resolve natural language names to ontology identifiers.
+
+A name is looked up once per biolink type at Bionames and, for chemical substances, at MyChem
+as well. Lookups of many names are made concurrently by a bounded pool of workers sharing a
+pooled session, each distinct (name, type) is asked for once per batch, and what it resolved
+to is remembered for a while, so repeated queries don't ask again.
+"""
+import concurrent.futures
+import contextvars
+import logging
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from tranql.exception import ServiceInvocationError
+from tranql.instrumentation import span
+from tranql.metrics import observe_cache_lookup
+from tranql.util import ExpiringCache
+
+logger = logging.getLogger (__name__)
+
+class NameResolver:
+    """ Concurrent, cached lookup of the identifiers of names. """
+
+    bionames_url = "https://bionames.renci.org/lookup/{input}/{type}/"
+    mychem_url = "http://mychem.info/v1/query"
+
+    _shared = {}
+    _shared_lock = threading.Lock ()
+
+    def __init__(self, workers=8, ttl=24 * 60 * 60, limit=100000):
+        """
+        :param workers: Most lookups in flight at once.
+        :param ttl: Seconds a resolved name is remembered.
+        :param limit: Most names remembered.
+        """
+        self.workers = workers
+        self.cache = ExpiringCache ("names", ttl, limit, observe=observe_cache_lookup)
+        """ Makes every lookup, so workers bounds those in flight across all callers of the resolver. """
+        self.executor = concurrent.futures.ThreadPoolExecutor (max_workers=workers, thread_name_prefix="name-resolver")
+        self.session = requests.Session ()
+        adapter = HTTPAdapter (pool_maxsize=workers)
+        self.session.mount ("http://", adapter)
+        self.session.mount ("https://", adapter)
+
+    @classmethod
+    def shared (cls, workers=8, ttl=24 * 60 * 60, limit=100000):
+        """ A resolver made on first use and shared by the process, so its names and session outlive a query. """
+        key = (workers, ttl, limit)
+        with cls._shared_lock:
+            resolver = cls._shared.get (key)
+            if resolver is None:
+                resolver = cls._shared[key] = cls (workers, ttl, limit)
+        return resolver
+
+    def lookup (self, name, type_name):
+        """ Ask the name services for the identifiers of a name of one type. """
+        with span ("resolve_name", kind="client", input=name, type=type_name):
+            response = self.session.get (
+                self.bionames_url.format (input=name, type=type_name),
+                headers = { 'accept': 'application/json' })
+            if response.status_code not in (200, 202):
+                raise ServiceInvocationError (response.text)
+            identifiers = [ i["id"] for i in response.json () ]
+            if type_name == 'chemical_substance':
+                response = self.session.get (self.mychem_url, params={ "q" : name })
+                for obj in response.json ().get ('hits', []):
+                    if 'chebi' in obj:
+                        identifiers.append (obj['chebi']['id'])
+                    if 'chembl' in obj:
+                        identifiers.append ("CHEMBL:"+obj['chembl']['molecule_chembl_id'])
+        return identifiers
+
+    def resolve_many (self, keys, strict=True):
+        """
+        Resolve (name, type) pairs, looking up those not remembered concurrently on the resolver's workers.
+
+        :param strict: Raise the first failed lookup. Otherwise log it and leave its key out.
+        :return: A dict of the identifiers of each resolved (name, type) pair.
+        """
+        result = {}
+        missing = []
+        for key in set (keys):
+            identifiers = self.cache.get (key)
+            if identifiers is None:
+                missing.append (key)
+            else:
+                result[key] = identifiers
+        if len(missing) == 0:
+            return result
+        futures = {
+            self.executor.submit (contextvars.copy_context ().run, self.lookup, *key) : key
+            for key in missing
+        }
+        try:
+            for future in concurrent.futures.as_completed (futures):
+                key = futures[future]
+                try:
+                    result[key] = self.cache.put (key, future.result ())
+                except Exception as e:
+                    if strict:
+                        raise
+                    logger.warning ("Unable to resolve %s of type %s: %s", key[0], key[1], e)
+        finally:
+            """ Lookups not started are dropped if this call gives up early. """
+            for future in futures:
+                future.cancel ()
+        return result
+
+    def resolve (self, name, type_names):
+        """ The identifiers of a name of any of the given types. """
+        if not isinstance (type_names, list):
+            type_names = [ type_names ]
+        resolved = self.resolve_many ([ (name, type_name) for type_name in type_names ])
+        result = [ i for type_name in type_names for i in resolved[(name, type_name)] ]
+        logger.debug ("name resolution result: %s => %s", name, result)
+        return result
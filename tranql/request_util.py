@@ -1,44 +1,91 @@
 import asyncio
+import contextvars
+import json
 import logging
 import aiohttp
 import concurrent.futures
 import random
 from time import time as now
-from tranql.exception import ServiceInvocationError, RequestTimeoutError
+from tranql.exception import ServiceInvocationError, RequestTimeoutError, UnknownServiceError
+from tranql.instrumentation import span, inject
 
 logger = logging.getLogger (__name__)
 
 async def make_request_async (semaphore, **kwargs):
+    """ Make a request once the semaphore admits it, returning its response, errors and stats. """
     response = {}
     errors = []
-    async with aiohttp.ClientSession () as session:
-        try:
-            async with session.request (**kwargs) as http_response:
-                # print(f"[{kwargs['method'].upper()}] requesting at url: {kwargs['url']}")
-                """ Check status and handle response. """
-                if http_response.status == 200 or http_response.status == 202:
-                    response = await http_response.json ()
-                    #logger.error (f" response: {json.dumps(response, indent=2)}")
-                    status = response.get('status', None)
-                    if status == "error":
-                        raise ServiceInvocationError(
-                            f"An error occurred invoking service: {kwargs['url']}.",
-                            response['message'])
-                elif http_response.status == 404:
-                    raise UnknownServiceError (f"Service {url} was not found. Is it misspelled?")
-                else:
-                    http_response.raise_for_status()
-                    # logger.error (f"error {http_response.status} processing request: {message}")
-                # logger.error (http_response.text)
-        except concurrent.futures.TimeoutError as e:
-            errors.append (RequestTimeoutError(f'Timeout error requesting content from url: "{kwargs.get("url","undefined")}"',kwargs))
-        except ServiceInvocationError as e:
-            errors.append (e)
-        except Exception as e:
-            errors.append (e)
+    http_status = None
+    size = 0
+    async with semaphore:
+        """ Latency counts from when the request is made, not from when it was queued. """
+        start = now ()
+        async with aiohttp.ClientSession () as session:
+            try:
+                with span ("request", kind="client", url=kwargs.get ("url")) as request_span:
+                    kwargs['headers'] = inject (dict(kwargs.get ('headers', {})))
+                    async with session.request (**kwargs) as http_response:
+                        # print(f"[{kwargs['method'].upper()}] requesting at url: {kwargs['url']}")
+                        """ Check status and handle response. """
+                        http_status = http_response.status
+                        request_span.set_attribute ("status", http_status)
+                        if http_response.status == 200 or http_response.status == 202:
+                            body = await http_response.read ()
+                            size = len(body)
+                            request_span.set_attribute ("bytes", size)
+                            response = json.loads (body)
+                            #logger.error (f" response: {json.dumps(response, indent=2)}")
+                            status = response.get('status', None) if isinstance (response, dict) else None
+                            if status == "error":
+                                raise ServiceInvocationError(
+                                    f"An error occurred invoking service: {kwargs['url']}.",
+                                    response['message'])
+                        elif http_response.status == 404:
+                            raise UnknownServiceError (f"Service {kwargs['url']} was not found. Is it misspelled?")
+                        else:
+                            http_response.raise_for_status()
+                            # logger.error (f"error {http_response.status} processing request: {message}")
+                        # logger.error (http_response.text)
+            except asyncio.CancelledError:
+                """ The query was abandoned. Let cancellation reach the caller. """
+                raise
+            except concurrent.futures.TimeoutError as e:
+                errors.append (RequestTimeoutError(f'Timeout error requesting content from url: "{kwargs.get("url","undefined")}"',kwargs))
+            except ServiceInvocationError as e:
+                errors.append (e)
+            except Exception as e:
+                errors.append (e)
+        elapsed = now () - start
     return {
         "response" : response,
-        "errors" : errors
+        "errors" : errors,
+        "stats" : {
+            "url" : kwargs.get ("url"),
+            "status" : http_status,
+            "elapsed" : elapsed,
+            "bytes" : size
+        }
+    }
+
+async def make_requests_async (requestPool, maxRequests=3):
+    """ Awaitable form of async_make_requests for callers already running in an event loop. """
+    semaphore = asyncio.BoundedSemaphore (maxRequests)
+    results = await asyncio.gather (*[ make_request_async (semaphore, **request) for request in requestPool ])
+
+    responses = []
+    errors = []
+    stats = []
+
+    for response in results:
+        errors.extend (response["errors"])
+        stats.append (response["stats"])
+        if len(response["errors"]) == 0:
+            responses.append (response["response"])
+
+    return {
+        "responses" : responses,
+        "errors" : errors,
+        "stats" : stats
     }
 
 """
@@ -50,7 +97,7 @@ Args:
     maxRequests (int, optional): Maximum number of requests that may be executing at any given time
 
 Returns:
-    Dict containing `responses` and `errors`
+    Dict containing `responses`, `errors`, and per request `stats` (url, status, elapsed seconds, bytes received)
 """
 def async_make_requests (requestPool, maxRequests=3):
 
@@ -62,30 +109,13 @@ def async_make_requests (requestPool, maxRequests=3):
         loop = asyncio.new_event_loop ()
         asyncio.set_event_loop (loop)
 
+    return loop.run_until_complete (make_requests_async (requestPool, maxRequests))
 
-    semaphore = asyncio.BoundedSemaphore (maxRequests)
-
-    # tasks = asyncio.gather (*[make_request (**request) for request in requestPool])
-
-    tasks = asyncio.gather(*[(make_request_async (semaphore, **request)) for request in requestPool])
-
-    # for request in requestPool:
-        # tasks.append (asyncio.ensure_future (make_request (semaphore, **request)))
-
-    results = loop.run_until_complete(tasks)
-
-    responses = []
-    errors = []
-
-    for response in results:
-        errors.extend (response["errors"])
-        if len(response["errors"]) == 0:
-            responses.append (response["response"])
-
-    return {
-        "responses" : responses,
-        "errors" : errors
-    }
+async def run_blocking (function, *args, **kwargs):
+    """ Run blocking work in the default executor, carrying context variables (like the current span) along. """
+    context = contextvars.copy_context ()
+    loop = asyncio.get_running_loop ()
+    return await loop.run_in_executor (None, lambda: context.run (function, *args, **kwargs))
 
 if __name__ == "__main__":
     reqs = [
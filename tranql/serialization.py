@@ -0,0 +1,133 @@
+"""
+Serialize and compress HTTP responses.
+
+JSON is encoded with orjson when it is installed and with the standard library otherwise.
+Responses are compressed with brotli or gzip when the client accepts it.
+"""
+import gzip
+import json
+import logging
+from flask import make_response, request
+
+logger = logging.getLogger (__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+""" Releases of orjson before 3 can't encode dicts with keys that aren't strings: use json with them. """
+if orjson is not None and not hasattr (orjson, 'OPT_NON_STR_KEYS'):
+    logger.warning ("orjson %s is too old, encoding JSON with the standard library", getattr (orjson, '__version__', ''))
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class JSONSerializer:
+    """ Encode JSON with the standard library. """
+    name = "json"
+    def dumps (self, obj):
+        return json.dumps (obj).encode ('utf-8')
+    def loads (self, data):
+        return json.loads (data)
+
+class ORJSONSerializer(JSONSerializer):
+    """ Encode JSON with orjson, falling back to the standard library for types orjson refuses. """
+    name = "orjson"
+    def dumps (self, obj):
+        try:
+            return orjson.dumps (obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return super().dumps (obj)
+    def loads (self, data):
+        return orjson.loads (data)
+
+serializers = { "json" : JSONSerializer }
+if orjson is not None:
+    serializers["orjson"] = ORJSONSerializer
+
+""" The serializer in use. """
+_serializer = ORJSONSerializer () if orjson is not None else JSONSerializer ()
+
+def set_serializer (name):
+    """ Choose a serializer by name: json, orjson, or auto for the fastest available. """
+    global _serializer
+    if not name or name == 'auto':
+        name = "orjson" if orjson is not None else "json"
+    if name not in serializers:
+        raise ValueError (f"Unknown or unavailable serializer: {name}")
+    _serializer = serializers[name] ()
+    return _serializer
+
+def dumps (obj):
+    """ Encode an object as JSON bytes. """
+    return _serializer.dumps (obj)
+
+def loads (data):
+    return _serializer.loads (data)
+
+""" Responses smaller than this many bytes are not worth compressing. """
+minimum_size = 1024
+
+""" Content types worth compressing. """
+compressible = ( "application/json", "text/", "application/javascript", "image/svg+xml" )
+
+def choose_encoding (accept_encoding):
+    """ Pick the best content coding the client accepts, or None. """
+    accepted = {}
+    for part in (accept_encoding or '').split (','):
+        fields = part.strip ().split (';')
+        coding = fields[0].strip ().lower ()
+        quality = 1.0
+        for field in fields[1:]:
+            field = field.strip ()
+            if field.startswith ('q='):
+                try:
+                    quality = float (field[2:])
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            accepted[coding] = quality
+    for coding in ([ "br" ] if brotli is not None else []) + [ "gzip" ]:
+        if accepted.get (coding, accepted.get ('*', 0)) > 0:
+            return coding
+    return None
+
+def compress (data, coding):
+    if coding == "br":
+        return brotli.compress (data, quality=4)
+    return gzip.compress (data, compresslevel=5)
+
+def output_json (data, code, headers=None):
+    """ A flask_restful representation encoding JSON with the configured serializer. """
+    response = make_response (dumps (data), code)
+    response.headers.extend (headers or {})
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+def compress_response (response):
+    """ Compress a finished Flask response if the client accepts it and it is worth it. """
+    if response.direct_passthrough or response.is_streamed or \
+       'Content-Encoding' in response.headers or \
+       not response.mimetype.startswith (compressible) or \
+       response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+    response.vary.add ('Accept-Encoding')
+    coding = choose_encoding (request.headers.get ('Accept-Encoding'))
+    data = response.get_data ()
+    if coding is None or len(data) < minimum_size:
+        return response
+    response.set_data (compress (data, coding))
+    response.headers['Content-Encoding'] = coding
+    return response
+
+def configure_serialization (app, api, config):
+    """ Encode a Flask app's JSON with the fast serializer and compress its responses. """
+    global minimum_size
+    set_serializer (config.get ('SERIALIZER', 'auto'))
+    minimum_size = int(config.get ('COMPRESSION_MIN_SIZE', minimum_size))
+    api.representations['application/json'] = output_json
+    app.after_request (compress_response)
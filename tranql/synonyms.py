@@ -0,0 +1,128 @@
+"""
+A local index of equivalent identifiers.
+
+The index is a prebuilt clique table: a text file with a line per identifier, holding the
+identifier and the id of its clique (the preferred identifier of the clique) separated by a
+tab, sorted by identifier. The file is memory-mapped and searched in place, so opening it costs
+nothing however large it is, and the operating system shares its pages between processes.
+Identifiers looked up are remembered.
+
+Build an index from cliques, given as JSON lists of identifiers a line, preferred first:
+
+    python -m tranql.synonyms cliques.jsonl synonyms.tsv
+"""
+import argparse
+import json
+import logging
+import mmap
+import os
+import threading
+
+logger = logging.getLogger (__name__)
+
+class SynonymIndex:
+    """ Map identifiers to the ids of their cliques. """
+
+    """ Forget remembered identifiers past this many, so the memo can't grow without bound. """
+    cache_limit = 100000
+
+    def __init__(self, path):
+        """
+        :param path: A clique table written by SynonymIndex.build.
+        """
+        self.path = path
+        self.cache = {}
+        self.map = None
+        with open (path, 'rb') as stream:
+            if os.fstat (stream.fileno ()).st_size > 0:
+                self.map = mmap.mmap (stream.fileno (), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, identifier):
+        return self.clique (identifier) is not None
+
+    def clique (self, identifier):
+        """ The id of the clique of an identifier, or None if the index doesn't know it. """
+        if identifier in self.cache:
+            return self.cache[identifier]
+        clique = self.search (identifier.encode ('utf-8')) if self.map is not None else None
+        if len(self.cache) >= self.cache_limit:
+            self.cache.clear ()
+        self.cache[identifier] = clique
+        return clique
+
+    def search (self, key):
+        """ Binary search the sorted lines of the table for key. """
+        data = self.map
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind (b'\n', lo, mid) + 1 or lo
+            end = data.find (b'\n', start, hi)
+            if end == -1:
+                end = hi
+            identifier, _, clique = data[start:end].partition (b'\t')
+            if identifier == key:
+                return clique.decode ('utf-8')
+            if identifier < key:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+    def close (self):
+        if self.map is not None:
+            self.map.close ()
+            self.map = None
+
+    @staticmethod
+    def build (cliques, path):
+        """
+        Write a clique table.
+
+        :param cliques: Lists of equivalent identifiers, the preferred identifier of each first.
+        :param path: Where to write the table.
+        :return: The number of identifiers written.
+        """
+        table = {}
+        for clique in cliques:
+            if len(clique) == 0:
+                continue
+            for identifier in clique:
+                table.setdefault (identifier, clique[0])
+        with open (path, 'w', encoding='utf-8') as stream:
+            for identifier in sorted (table):
+                stream.write (f"{identifier}\t{table[identifier]}\n")
+        return len(table)
+
+""" Indexes opened, by path. Each is mapped once and shared by every interpreter of the process. """
+_indexes = {}
+_indexes_lock = threading.Lock ()
+
+def open_synonyms (config):
+    """ The shared index named by the SYNONYM_INDEX setting, if there is one. """
+    path = config.get ('SYNONYM_INDEX')
+    if not path or path == 'none':
+        return None
+    path = os.path.abspath (path)
+    with _indexes_lock:
+        index = _indexes.get (path)
+        if index is None:
+            logger.info ("Using synonym index %s", path)
+            index = _indexes[path] = SynonymIndex (path)
+    return index
+
+def close_synonyms ():
+    """ Close the shared indexes. Later calls to open_synonyms open them again. """
+    with _indexes_lock:
+        for index in _indexes.values ():
+            index.close ()
+        _indexes.clear ()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a TranQL synonym index')
+    parser.add_argument('cliques', help="File of JSON lists of equivalent identifiers, one a line, preferred first.")
+    parser.add_argument('index', help="Where to write the index.")
+    args = parser.parse_args()
+    with open (args.cliques) as stream:
+        count = SynonymIndex.build ((json.loads (line) for line in stream if line.strip ()), args.index)
+    print (f"Wrote {count} identifiers to {args.index}")
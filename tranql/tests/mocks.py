@@ -1,6 +1,32 @@
 import json
 import os
 
+""" A one hop query the workflow-5 mocks answer. """
+chemical_gene_query = """
+    SELECT chemical_substance->gene
+      FROM '/graph/gamma/quick'
+     WHERE chemical_substance = 'CHEBI:28177'
+"""
+
+def synchronous_tranql ():
+    """ An interpreter sending questions one at a time without resolving names, as the mocks answer them. """
+    from tranql.main import TranQL
+    tranql = TranQL ()
+    tranql.asynchronous = False
+    tranql.resolve_names = False
+    return tranql
+
+async def make_requests_async (pool, maxRequests=3):
+    """ Answer a pool of asynchronous requests through the mocked synchronous transport. """
+    import requests
+    responses = [ requests.request (r['method'], r['url'], json=r['json']) for r in pool ]
+    return {
+        "responses" : [ r.json () for r in responses ],
+        "errors" : [],
+        "stats" : [ { "url" : r.url, "status" : r.status_code, "elapsed" : 0, "bytes" : len(r.content) }
+                    for r in responses ]
+    }
+
 class MockHelper:
     def get_obj (self, file_name):
         """ Get an object from file. """
@@ -15,9 +41,25 @@ class MockHelper:
         return json.dumps (self.get_obj (file_name), indent=2)
 
 class MockMap(MockHelper):
+    @staticmethod
+    def answer_batches (text, batches=True):
+        """
+        Answer a batch (a list of questions) with a list holding the response for each. Routes
+        that don't answer batches reject them as the backplane does.
+        """
+        def respond (request, context):
+            body = request.json () if request.body else None
+            if isinstance (body, list):
+                if not batches:
+                    context.status_code = 400
+                    return "A message must be a JSON object."
+                return json.dumps ([ json.loads (text) for question in body ])
+            return text
+        return respond
+
     def __init__(self, requests_mock, test_name):
         super().__init__()
-        """ A map of urls to file names of responses. """
+        """ A map of urls to file names of responses. Backplane routes answer batches unless batches is False. """
         self.mock_map = {
             "workflow-5" : {
                 "http://localhost:8099/clinical/cohort/disease_to_chemical_exposure" : {
@@ -54,7 +96,7 @@ class MockMap(MockHelper):
             method = v['method'] if 'method' in v else 'post'
             text = self.get_obj_text (v['path'])
             if method == 'post':
-                requests_mock.post (k, text=text)
+                requests_mock.post (k, text=self.answer_batches (text, v.get ('batches', True)))
             elif method == 'get':
                 requests_mock.get (k, text=text)
             else:
@@ -0,0 +1,302 @@
+import aiohttp
+import asyncio
+import json
+import pytest
+from tranql.backplane import server, upstream
+
+@pytest.fixture
+def client ():
+    return server.app.test_client ()
+
+def test_message_validator_is_cached ():
+    """ The interchange schema is parsed and compiled once per version. """
+    print ("test_message_validator_is_cached ()")
+    validator = server.message_validator (server.default_schema_version)
+    assert server.message_validator (server.default_schema_version) is validator
+    assert validator.is_valid ({ "knowledge_graph" : { "nodes" : [], "edges" : [] } })
+
+def test_structural_validation ():
+    """ Top level property types are checked without the full schema. """
+    print ("test_structural_validation ()")
+    version = server.default_schema_version
+    assert server.structural_error ([], version) is not None
+    assert server.structural_error ({ "knowledge_graph" : [] }, version) is not None
+    assert server.structural_error ({ "knowledge_graph" : {}, "extra" : 1 }, version) is None
+
+def test_validate_rejects_malformed_message (client):
+    """ Malformed messages are rejected with a 400 before any upstream request. """
+    print ("test_validate_rejects_malformed_message ()")
+    response = client.post ('/graph/gamma/quick', json={ "knowledge_graph" : "nope" })
+    assert response.status_code == 400
+    assert "knowledge_graph" in response.get_data (as_text=True)
+
+def test_upstream_retries_idempotent_calls (requests_mock, monkeypatch):
+    """ Idempotent upstream calls are retried on gateway errors, others are not. """
+    print ("test_upstream_retries_idempotent_calls ()")
+    monkeypatch.setattr (upstream.time, "sleep", lambda seconds: None)
+    client = upstream.UpstreamClient (retries=2, backoff=0.01)
+    url = "http://reasoner.test/query"
+    requests_mock.get (url, [ { "status_code" : 503 }, { "json" : { "ok" : True } } ])
+    response = client.request ("get", url)
+    assert response.json () == { "ok" : True }
+    assert requests_mock.call_count == 2
+    assert requests_mock.last_request.timeout == client.timeout
+
+    requests_mock.post (url, status_code=503)
+    assert client.request ("post", url).status_code == 503
+    assert requests_mock.call_count == 3
+    assert client.request ("post", url, idempotent=True).status_code == 503
+    assert requests_mock.call_count == 6
+
+    """ Failures to connect are retried; timeouts reading an answer are not. """
+    import requests
+    requests_mock.get (url, [ { "exc" : requests.ConnectTimeout }, { "json" : { "ok" : True } } ])
+    assert client.request ("get", url).json () == { "ok" : True }
+    assert requests_mock.call_count == 8
+    requests_mock.get (url, exc=requests.ReadTimeout)
+    with pytest.raises (requests.ReadTimeout):
+        client.request ("get", url)
+    assert requests_mock.call_count == 9
+    assert not client.retryable (asyncio.TimeoutError ()) and client.retryable (aiohttp.ClientConnectionError ())
+
+def test_upstream_sessions_are_pooled_per_host ():
+    """ Calls to one upstream share a session; other upstreams get their own. """
+    print ("test_upstream_sessions_are_pooled_per_host ()")
+    client = upstream.UpstreamClient ()
+    session = client.session ("https://a.test/one")
+    assert client.session ("https://a.test/two?x=1") is session
+    assert client.session ("https://b.test/one") is not session
+    assert all (client.delay (attempt) <= client.max_backoff for attempt in range (10))
+    client.close ()
+
+def test_merge_results_drops_duplicates ():
+    """ Result graphs are folded into the knowledge graph without duplicate nodes or edges. """
+    print ("test_merge_results_drops_duplicates ()")
+    edge = { "id" : "e0", "type" : "treats", "source_id" : "CHEBI:1", "target_id" : "MONDO:1" }
+    result = {
+        "node_bindings" : { "n0" : "CHEBI:1" },
+        "edge_bindings" : { "e0" : "e0" },
+        "result_graph" : {
+            "nodes" : [ { "id" : "CHEBI:1" }, { "id" : "MONDO:1" } ],
+            "edges" : [ dict(edge) ]
+        }
+    }
+    message = {
+        "knowledge_graph" : { "nodes" : [ { "id" : "MONDO:1" } ], "edges" : [] },
+        "results" : [ result, json.loads (json.dumps (result)) ]
+    }
+    message = server.StandardAPIResource ().merge_results (message)
+    assert [ n['id'] for n in message['knowledge_graph']['nodes'] ] == [ "MONDO:1", "CHEBI:1" ]
+    assert message['knowledge_graph']['edges'] == [ edge ]
+    assert len(message['knowledge_map']) == 2
+
+def test_curie_rewriting ():
+    """ Curie prefixes are rewritten to and from an upstream's spelling in one pass. """
+    print ("test_curie_rewriting ()")
+    to_rtx, from_rtx = server.curie_rewriters ("rtx")
+    question = { "question_graph" : { "nodes" : [ { "id" : "n0", "curie" : "CHEMBL:CHEMBL3" },
+                                                  { "id" : "n1", "curie" : [ "MONDO:1", "CHEMBL:CHEMBL4" ] } ],
+                                       "edges" : [] } }
+    nodes = to_rtx.rewrite_message (question)['question_graph']['nodes']
+    assert nodes[0]['curie'] == "CHEMBL.COMPOUND:CHEMBL3"
+    assert nodes[1]['curie'] == [ "MONDO:1", "CHEMBL.COMPOUND:CHEMBL4" ]
+    answer = {
+        "knowledge_graph" : {
+            "nodes" : [ { "id" : "CHEMBL.COMPOUND:CHEMBL3" } ],
+            "edges" : [ { "source_id" : "CHEMBL.COMPOUND:CHEMBL3", "target_id" : "MONDO:1" } ]
+        },
+        "knowledge_map" : [ { "node_bindings" : { "n0" : [ "CHEMBL.COMPOUND:CHEMBL3" ] },
+                              "edge_bindings" : { "e0" : [ "CHEMBL.COMPOUND:e" ] } } ]
+    }
+    answer = from_rtx.rewrite_message (answer)
+    assert answer['knowledge_graph']['nodes'][0]['id'] == "CHEMBL:CHEMBL3"
+    assert answer['knowledge_graph']['edges'][0] == { "source_id" : "CHEMBL:CHEMBL3", "target_id" : "MONDO:1" }
+    assert answer['knowledge_map'][0]['node_bindings']['n0'] == [ "CHEMBL:CHEMBL3" ]
+    assert answer['knowledge_map'][0]['edge_bindings']['e0'] == [ "CHEMBL.COMPOUND:e" ]
+    assert not server.curie_rewriters (None)[0]
+
+def asgi_request (app, method, path, body=None):
+    """ Drive an ASGI app through one request, returning its status and body. """
+    import asyncio
+    sent = []
+    async def receive ():
+        return { 'type' : 'http.request', 'body' : json.dumps (body).encode ('utf-8') if body is not None else b'', 'more_body' : False }
+    async def send (message):
+        sent.append (message)
+    async def run ():
+        await app ({ 'type' : 'http', 'method' : method, 'path' : path, 'query_string' : b'', 'headers' : [] }, receive, send)
+        await upstream.get_upstream ().close_async ()
+    asyncio.run (run ())
+    return sent[0]['status'], b''.join (m.get ('body', b'') for m in sent[1:])
+
+def test_asgi_proxies_upstream (monkeypatch):
+    """ Adapters served over ASGI await their upstream call and translate its answer. """
+    print ("test_asgi_proxies_upstream ()")
+    from tranql.backplane.asgi import app
+    assert app.routes[("POST", "/graph/gamma/quick")] is server.GammaQuery
+    assert ("POST", "/implicit_conversion") not in app.routes
+    calls = []
+    async def upstream_request_async (method, url, **kwargs):
+        calls.append ((method, url, kwargs))
+        return upstream.UpstreamResponse (url, 200, json.dumps ({
+            "question_graph" : { "nodes" : [ { "node_id" : "n0" } ], "edges" : [] },
+            "knowledge_graph" : { "nodes" : [], "edges" : [] },
+            "answers" : [ { "node_bindings" : { "n0" : "MONDO:1" } } ]
+        }).encode ('utf-8'))
+    monkeypatch.setattr (server, "upstream_request_async", upstream_request_async)
+    """ Upstream answers are decoded and normalized off the event loop's thread. """
+    import threading
+    threads = []
+    upstream_result = server.GammaQuery.upstream_result
+    def record_thread (self, call, response):
+        threads.append (threading.current_thread ())
+        return upstream_result (self, call, response)
+    monkeypatch.setattr (server.GammaQuery, "upstream_result", record_thread)
+    status, body = asgi_request (app, "POST", "/graph/gamma/quick", {
+        "question_graph" : { "nodes" : [], "edges" : [] },
+        "knowledge_graph" : { "nodes" : [], "edges" : [] },
+        "knowledge_maps" : [],
+        "options" : {}
+    })
+    assert status == 200
+    assert threads and threading.main_thread () not in threads
+    assert calls[0][0] == "post" and calls[0][2]['idempotent']
+    result = json.loads (body)
+    assert result['question_graph']['nodes'] == [ { "id" : "n0" } ]
+    assert result['knowledge_map'] == [ { "node_bindings" : { "n0" : "MONDO:1" } } ]
+
+    status, body = asgi_request (app, "POST", "/graph/gamma/quick", { "knowledge_graph" : "nope" })
+    assert status == 400
+    assert len(calls) == 1
+
+def test_upstream_request_async_retries ():
+    """ Asynchronous upstream calls pool, retry and read responses like the synchronous ones. """
+    print ("test_upstream_request_async_retries ()")
+    import asyncio
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    hits = []
+    async def handler (request):
+        hits.append (request.headers.get ('traceparent'))
+        if len(hits) == 1:
+            return web.Response (status=503)
+        return web.json_response ({ "ok" : True })
+    async def run ():
+        web_app = web.Application ()
+        web_app.router.add_get ("/query", handler)
+        async with TestServer (web_app) as test_server:
+            client = upstream.UpstreamClient (retries=2, backoff=0.01)
+            response = await client.request_async ("get", str(test_server.make_url ("/query")))
+            await client.close_async ()
+            return response
+    response = asyncio.run (run ())
+    assert response.ok and response.json () == { "ok" : True }
+    assert len(hits) == 2
+
+def test_batch_answers_each_message (client, monkeypatch):
+    """ A list of messages is answered with a list of answers, in order, malformed ones with an error. """
+    print ("test_batch_answers_each_message ()")
+    def upstream_request (method, url, **kwargs):
+        return upstream.UpstreamResponse (url, 200, json.dumps ({
+            "knowledge_graph" : { "nodes" : [ { "id" : kwargs['json']['question_graph']['nodes'][0]['curie'] } ], "edges" : [] },
+            "answers" : []
+        }).encode ('utf-8'))
+    monkeypatch.setattr (server, "upstream_request", upstream_request)
+    def question (curie):
+        return {
+            "question_graph" : { "nodes" : [ { "id" : "n0", "curie" : curie, "type" : "disease" } ], "edges" : [] },
+            "knowledge_graph" : { "nodes" : [], "edges" : [] },
+            "knowledge_maps" : [],
+            "options" : {}
+        }
+    response = client.post ('/graph/gamma/quick', json=[ question ("MONDO:1"), { "knowledge_graph" : "nope" }, question ("MONDO:2") ])
+    assert response.status_code == 200
+    answers = response.get_json ()
+    assert [ a['knowledge_graph']['nodes'][0]['id'] for a in (answers[0], answers[2]) ] == [ "MONDO:1", "MONDO:2" ]
+    assert answers[1]['status'] == "error" and answers[1]['code'] == "invalid_message"
+
+def test_asgi_batch_is_bounded (monkeypatch):
+    """ Batches answered over ASGI ask the upstream at most batch_workers messages at once. """
+    print ("test_asgi_batch_is_bounded ()")
+    import asyncio
+    from tranql.backplane.asgi import app
+    monkeypatch.setattr (server, "batch_workers", 2)
+    in_flight = []
+    most = []
+    async def upstream_request_async (method, url, **kwargs):
+        in_flight.append (url)
+        most.append (len(in_flight))
+        await asyncio.sleep (0.01)
+        in_flight.pop ()
+        return upstream.UpstreamResponse (url, 200, json.dumps ({
+            "knowledge_graph" : { "nodes" : [], "edges" : [] },
+            "answers" : []
+        }).encode ('utf-8'))
+    monkeypatch.setattr (server, "upstream_request_async", upstream_request_async)
+    """ Messages lacking the properties the adapter drops are answered too. """
+    question = { "question_graph" : { "nodes" : [], "edges" : [] } }
+    status, body = asgi_request (app, "POST", "/graph/gamma/quick", [ question ] * 5)
+    assert status == 200
+    assert len(json.loads (body)) == 5
+    assert len(most) == 5 and max (most) == 2
+
+def test_implicit_conversion_answers_batches (client):
+    """ Implicit conversions are answered without an upstream, batches of them too, as are all the schema's routes. """
+    print ("test_implicit_conversion_answers_batches ()")
+    import yaml
+    from tranql.util import Resource
+    schema = yaml.safe_load (open (Resource.get_resource_path ("conf/schema.yaml")))['schema']
+    for reasoner in schema.values ():
+        view = server.app.view_functions[server.app.url_map.bind ('').match (reasoner['url'], method='POST')[0]]
+        assert view.view_class.answers_batches (), reasoner['url']
+    def question (curie):
+        return {
+            "question_graph" : { "nodes" : [ { "id" : "drug_exposure", "curie" : curie, "type" : "drug_exposure" },
+                                             { "id" : "chemical_substance", "type" : "chemical_substance" } ], "edges" : [] },
+            "knowledge_graph" : { "nodes" : [], "edges" : [] }
+        }
+    response = client.post ('/implicit_conversion', json=[ question ("CHEBI:1"), question ("CHEBI:2") ])
+    assert response.status_code == 200
+    answers = response.get_json ()
+    assert [ a['knowledge_graph']['nodes'][0]['id'] for a in answers ] == [ "CHEBI:1", "CHEBI:2" ]
+    assert client.post ('/implicit_conversion', json=question ("CHEBI:1")).get_json ()['knowledge_map'] == answers[0]['knowledge_map']
+
+def test_icees_identifiers_are_cached (requests_mock, monkeypatch):
+    """ Identifiers of each distinct feature are fetched once and reused by later parses. """
+    print ("test_icees_identifiers_are_cached ()")
+    from tranql.backplane.iceesclient import ICEES, ExpiringCache
+    monkeypatch.setattr (ICEES, "identifier_cache", ExpiringCache ("icees_identifiers", ttl=60))
+    for feature in [ "Prednisone", "Albuterol" ]:
+        requests_mock.get (f"https://icees.renci.org/1.0.0/patient/{feature}/identifiers",
+                           json={ "return value" : { "identifiers" : [ f"MESH:{feature}" ] } })
+    response = { "return value" : [
+        { "feature_b" : { "feature_name" : "Prednisone" }, "p_value" : 0.1 },
+        { "feature_b" : { "feature_name" : "Albuterol" }, "p_value" : 0.2 },
+        { "feature_b" : { "feature_name" : "Prednisone" }, "p_value" : 0.3 }
+    ] }
+    icees = ICEES ()
+    graph = icees.parse_1_x_N (response)
+    assert requests_mock.call_count == 2
+    assert [ n['id'] for n in graph['nodes'][1:] ] == [ "MESH:Prednisone", "MESH:Albuterol", "MESH:Prednisone" ]
+    assert [ e['attributes']['p_val'] for e in graph['edges'] ] == [ 0.1, 0.2, 0.3 ]
+    assert ICEES ().parse_1_x_N (response) == graph
+    assert requests_mock.call_count == 2
+
+def test_icees_cohorts_are_memoized (requests_mock, monkeypatch):
+    """ A cohort is defined once per filter; the dictionary is fetched once. """
+    print ("test_icees_cohorts_are_memoized ()")
+    from tranql.backplane.iceesclient import DefineCohort, GetDictionary, ExpiringCache
+    monkeypatch.setattr (DefineCohort, "cohort_cache", ExpiringCache ("icees_cohorts", ttl=60))
+    monkeypatch.setattr (GetDictionary, "dictionary_cache", ExpiringCache ("icees_dictionary", ttl=60))
+    cohort = requests_mock.post ("https://icees.renci.org/1.0.0/patient/2010/cohort",
+                                 json={ "return value" : { "cohort_id" : "COHORT:1", "size" : 10 } })
+    dictionary = requests_mock.get ("https://icees.renci.org/1.0.0/patient/2010/cohort/dictionary",
+                                    json={ "return value" : [] })
+    define = DefineCohort ()
+    first = define.run_define_cohort ("AgeStudyStart", 2, ">")
+    assert DefineCohort ().run_define_cohort ("AgeStudyStart", 2, ">") == first
+    assert cohort.call_count == 1
+    define.run_define_cohort ("AgeStudyStart", 3, ">")
+    assert cohort.call_count == 2
+    assert GetDictionary ().run_get_dictionary () == GetDictionary ().run_get_dictionary ()
+    assert dictionary.call_count == 1
@@ -10,6 +10,7 @@ from tranql.main import TranQLParser, set_verbose
 from tranql.tranql_ast import SetStatement
 from tranql.tests.mocks import MockHelper
 from tranql.tests.mocks import MockMap
+from tranql.tests.mocks import chemical_gene_query, make_requests_async, synchronous_tranql
 #set_verbose ()
 
 def assert_lists_equal (a, b):
@@ -198,6 +199,7 @@ def test_parse_query_with_repeated_concept (requests_mock):
 # AST tests. Test abstract syntax tree components.
 #
 #####################################################
+
 def test_ast_set_variable (requests_mock):
     set_mock(requests_mock, "workflow-5")
     """ Test setting a varaible to an explicit value. """
@@ -207,6 +209,7 @@ def test_ast_set_variable (requests_mock):
     statement = SetStatement (variable="variable", value="x")
     statement.execute (tranql)
     assert tranql.context.resolve_arg ("$variable") == 'x'
+
 def test_ast_set_graph (requests_mock):
     set_mock(requests_mock, "workflow-5")
     """ Set a variable to a graph passed as a result. """
@@ -216,6 +219,7 @@ def test_ast_set_graph (requests_mock):
     statement = SetStatement (variable="variable", value=None, jsonpath_query=None)
     statement.execute (tranql, context={ 'result' : { "a" : 1 } })
     assert tranql.context.resolve_arg ("$variable")['a'] == 1
+
 def test_ast_set_graph (requests_mock):
     set_mock(requests_mock, "workflow-5")
     """ Set a variable to the value returned by executing a JSONPath query. """
@@ -231,6 +235,7 @@ def test_ast_set_graph (requests_mock):
         }
     })
     assert tranql.context.resolve_arg ("$variable")[0]['id'] == "x:y"
+
 def test_ast_generate_questions (requests_mock):
     set_mock(requests_mock, "workflow-5")
     """ Validate that
@@ -512,6 +517,7 @@ def test_ast_bidirectional_query (requests_mock):
 # Interpreter tests. Test the interpreter interface.
 #
 #####################################################
+
 def test_interpreter_set (requests_mock):
     set_mock(requests_mock, "workflow-5")
     """ Test set statements by executing a few and checking values after. """
@@ -575,3 +581,652 @@ def test_program (requests_mock):
     kg = tranql.context.resolve_arg("$knowledge_graph")
     assert kg['knowledge_graph']['nodes'][0]['id'] == "CHEBI:28177"
     assert kg['knowledge_map'][0]['node_bindings']['chemical_substance'] == "CHEBI:28177"
+
+def test_parse_explain (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Verify explain and explain analyze wrap the select statement's token stream. """
+    print ("test_parse_explain ()")
+    assert_parse_tree (
+        code = """
+        EXPLAIN ANALYZE
+        SELECT disease->chemical_substance
+          FROM "/graph/gamma/quick"
+         WHERE disease = "MONDO:0004979"
+        """,
+        expected = [
+            ["explain", "analyze", "\n", "        ",
+             [["select", "disease", "->", "chemical_substance", "\n"],
+              "          ",
+              ["from", ["/graph/gamma/quick"]],
+              ["where", ["disease", "=", "MONDO:0004979"]],
+              [""]]]
+        ])
+
+def test_explain_plan (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Explain describes plan segments and estimates question counts without executing. """
+    print ("test_explain_plan ()")
+    tranql = TranQL ()
+    tranql.resolve_names = False
+    tranql.context.set ("diseases", [ "MONDO:0004979", "MONDO:0005148", "SMILES:xyz" ])
+    tranql.context.set ("id_filters", "SMILES")
+    context = tranql.execute ("""
+        EXPLAIN
+        SELECT cohort_diagnosis:disease->diagnoses:disease
+          FROM '/schema'
+         WHERE cohort_diagnosis = $diseases
+    """)
+    plan = context.resolve_arg ("$result")['plan']
+    assert plan['analyze'] == False
+    assert len(plan['segments']) == 2
+    for segment in plan['segments']:
+        assert segment['steps'] == [ "cohort_diagnosis:disease->diagnoses:disease" ]
+        assert segment['estimated_questions'] == 2
+        assert not 'actual' in segment
+    """ Only schemas were loaded. No questions were sent. """
+    assert all ([ r.method == 'GET' for r in requests_mock.request_history ])
+
+def test_explain_analyze (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Explain analyze executes the statement and reports per segment statistics. """
+    print ("test_explain_analyze ()")
+    tranql = synchronous_tranql ()
+    tranql.context.set ("chemicals", [ "CHEBI:28177", "CHEBI:28177", "CHEBI:6801" ])
+    context = tranql.execute ("""
+        EXPLAIN ANALYZE
+        SELECT chemical_substance->gene
+          FROM '/graph/gamma/quick'
+         WHERE chemical_substance = $chemicals
+    """)
+    plan = context.resolve_arg ("$result")['plan']
+    segment = plan['segments'][0]
+    assert segment['service'] == "http://localhost:8099/graph/gamma/quick"
+    assert segment['estimated_questions'] == 3
+    actual = segment['actual']
+    assert actual['questions_generated'] == 3
+    assert actual['questions_deduped'] == 1
+    assert actual['questions_sent'] == 2
+    assert actual['questions_truncated'] == 0
+    """ Both questions went to the backplane in one batch. """
+    assert actual['batches'] == 1
+    assert actual['latency']['count'] == 1
+    assert actual['bytes_received'] > 0
+    assert actual['merge_time'] >= 0
+
+def test_interpreter_timings (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Executing a program records nested timing spans for each phase. """
+    print ("test_interpreter_timings ()")
+    tranql = synchronous_tranql ()
+    tranql.execute (chemical_gene_query + "SET '$.knowledge_graph.nodes.[*].id' AS genes")
+    timings = tranql.instrumentation.to_dict ()
+    phases = timings['phases']
+    for phase in [ "execute", "parse", "ast", "schema.load", "statement",
+                   "questions", "requests", "request", "merge", "set" ]:
+        assert phases[phase]['count'] > 0
+    assert phases['request']['count'] == 1
+    root = timings['spans'][0]
+    assert root['name'] == 'execute'
+    assert [ c['name'] for c in root['children'] ] == [ "parse", "ast", "statement" ]
+    assert timings['total'] >= phases['merge']['total']
+
+def test_interpreter_tracing (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Spans share a trace, are exported, and carry trace context to reasoners. """
+    print ("test_interpreter_tracing ()")
+    from tranql.instrumentation import InMemorySpanExporter, set_exporter
+    exporter = InMemorySpanExporter ()
+    previous = set_exporter (exporter)
+    try:
+        tranql = synchronous_tranql ()
+        trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+        tranql.execute (chemical_gene_query, traceparent=f"00-{trace_id}-00f067aa0ba902b7-01")
+        spans = exporter.get_finished_spans ()
+        assert len(spans) > 0
+        assert all ([ s.trace_id == trace_id for s in spans ])
+        by_id = { s.span_id : s for s in spans }
+        root = [ s for s in spans if s.name == 'execute' ][0]
+        assert root.parent_span_id == "00f067aa0ba902b7"
+        for s in spans:
+            if s is not root:
+                assert s.parent_span_id in by_id
+        request_span = [ s for s in spans if s.name == 'request' ][0]
+        assert request_span.to_otlp ()['kind'] == 3
+        posts = [ r for r in requests_mock.request_history if r.method == 'POST' ]
+        assert posts[0].headers['traceparent'] == request_span.traceparent ()
+    finally:
+        set_exporter (previous)
+
+def test_interpreter_metrics (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Executing a program records reasoner, question and merge metrics. """
+    print ("test_interpreter_metrics ()")
+    from prometheus_client import REGISTRY
+    def sample (name, **labels):
+        return REGISTRY.get_sample_value (name, labels) or 0
+    service = "http://localhost:8099/graph/gamma/quick"
+    before = {
+        "requests" : sample ("tranql_reasoner_requests_total", service=service, status="200"),
+        "questions" : sample ("tranql_questions_per_query_count"),
+        "merges" : sample ("tranql_merge_size_count", kind="nodes")
+    }
+    tranql = synchronous_tranql ()
+    tranql.execute (chemical_gene_query)
+    assert sample ("tranql_reasoner_requests_total", service=service, status="200") == before['requests'] + 1
+    assert sample ("tranql_questions_per_query_count") == before['questions'] + 1
+    assert sample ("tranql_merge_size_count", kind="nodes") == before['merges'] + 1
+
+def test_metrics_endpoint ():
+    """ Instrumented apps count requests per route and serve /metrics. """
+    print ("test_metrics_endpoint ()")
+    from flask import Flask
+    from tranql.metrics import instrument
+    app = Flask ("test_metrics_endpoint")
+    app.add_url_rule ('/ping/<name>', 'ping', lambda name: name)
+    instrument (app, "test")
+    client = app.test_client ()
+    assert client.get ('/ping/a').status_code == 200
+    assert client.get ('/ping/b').status_code == 200
+    response = client.get ('/metrics')
+    assert response.status_code == 200
+    text = response.get_data (as_text=True)
+    assert 'tranql_http_requests_total{app="test",method="GET",route="/ping/<name>",status="200"} 2.0' in text
+    assert 'tranql_http_requests_in_flight{app="test"} 1.0' in text
+
+def test_lazy_log_arguments ():
+    """ Lazy log arguments are only built when a record is emitted, and are truncated. """
+    print ("test_lazy_log_arguments ()")
+    import logging
+    from tranql.util import Lazy, LazyJSON
+    calls = []
+    def build ():
+        calls.append (1)
+        return "x" * 50
+    logger = logging.getLogger ("test_lazy_log_arguments")
+    logger.setLevel (logging.WARNING)
+    logger.debug ("%s", Lazy (build))
+    assert calls == []
+    assert str(Lazy (build, limit=10)).startswith ("x" * 10 + "...")
+    assert len(calls) == 1
+    assert json.loads (str(LazyJSON ({ "a" : [ 1, 2 ] }))) == { "a" : [ 1, 2 ] }
+
+def test_execute_async (requests_mock, monkeypatch):
+    set_mock(requests_mock, "workflow-5")
+    """ The asynchronous interpreter produces the same result as the synchronous one. """
+    print ("test_execute_async ()")
+    import asyncio
+    import tranql.tranql_ast
+    monkeypatch.setattr (tranql.tranql_ast, "make_requests_async", make_requests_async)
+    """ Question generation and merging run off the event loop's thread. """
+    import threading
+    threads = []
+    merge_results = tranql.tranql_ast.SelectStatement.merge_results
+    def record_thread (self, *args, **kwargs):
+        threads.append (threading.current_thread ())
+        return merge_results (self, *args, **kwargs)
+    monkeypatch.setattr (tranql.tranql_ast.SelectStatement, "merge_results", record_thread)
+    program = chemical_gene_query + "SET '$.knowledge_graph.nodes.[*].id' AS genes"
+    expected = synchronous_tranql ()
+    expected.execute (program)
+    actual = TranQL ()
+    threads.clear ()
+    context = asyncio.run (actual.execute_async (program))
+    assert threads and threading.main_thread () not in threads
+    assert context.resolve_arg ("$genes") == expected.context.resolve_arg ("$genes")
+    assert context.resolve_arg ("$result") == expected.context.resolve_arg ("$result")
+    phases = actual.instrumentation.to_dict ()['phases']
+    assert phases['requests']['count'] == 1 and phases['set']['count'] == 1
+
+def test_requests_async_are_bounded ():
+    """ Asynchronous requests of a pool are made at most maxRequests at a time. """
+    print ("test_requests_async_are_bounded ()")
+    import asyncio
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from tranql.request_util import make_requests_async
+    in_flight = []
+    most = []
+    async def handler (request):
+        in_flight.append (request)
+        most.append (len(in_flight))
+        await asyncio.sleep (0.02)
+        in_flight.remove (request)
+        return web.json_response ({ "knowledge_graph" : { "nodes" : [], "edges" : [] } })
+    async def run ():
+        web_app = web.Application ()
+        web_app.router.add_post ("/query", handler)
+        async with TestServer (web_app) as test_server:
+            url = str(test_server.make_url ("/query"))
+            return await make_requests_async ([ { "method" : "post", "url" : url, "json" : {} } ] * 6, maxRequests=2)
+    result = asyncio.run (run ())
+    assert len(result['responses']) == 6 and result['errors'] == []
+    assert len(most) == 6 and max (most) == 2
+
+def test_asgi_query (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ The ASGI app answers queries from a coroutine. """
+    print ("test_asgi_query ()")
+    import asyncio
+    from tranql.asgi import app
+    body = json.dumps ({ "query" : """
+        EXPLAIN
+        SELECT cohort_diagnosis:disease->diagnoses:disease
+          FROM '/schema'
+         WHERE cohort_diagnosis = 'MONDO:0004979'
+    """ }).encode ('utf-8')
+    sent = []
+    async def receive ():
+        return { 'type' : 'http.request', 'body' : body, 'more_body' : False }
+    async def send (message):
+        sent.append (message)
+    asyncio.run (app ({
+        'type' : 'http',
+        'method' : 'POST',
+        'path' : '/tranql/query',
+        'query_string' : b'timings=true',
+        'headers' : [ (b'content-type', b'application/json') ]
+    }, receive, send))
+    assert sent[0]['status'] == 200
+    result = json.loads (sent[1]['body'])
+    assert len(result['plan']['segments']) == 2
+    assert 'execute' in result['timings']['phases']
+
+def test_query_job (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ A query submitted as a job can be polled until it is done. """
+    print ("test_query_job ()")
+    import time
+    from tranql.api import app
+    client = app.test_client ()
+    response = client.post ('/tranql/query', json={
+        "async" : True,
+        "query" : """
+            EXPLAIN
+            SELECT cohort_diagnosis:disease->diagnoses:disease
+              FROM '/schema'
+             WHERE cohort_diagnosis = 'MONDO:0004979'
+        """ })
+    assert response.status_code == 202
+    job = response.get_json ()
+    assert job['status'] in [ "queued", "running" ]
+    for i in range(100):
+        job = client.get (f"/tranql/jobs/{job['job_id']}").get_json ()
+        if job['status'] not in [ "queued", "running" ]:
+            break
+        time.sleep (0.1)
+    assert job['status'] == "done"
+    assert job['statements'] == { "completed" : 1, "total" : 1 }
+    assert len(job['result']['plan']['segments']) == 2
+    assert client.get ("/tranql/jobs/nonesuch").status_code == 404
+
+def test_cancel_query_job (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Cancelling a job aborts its in flight reasoner requests. """
+    print ("test_cancel_query_job ()")
+    import socketserver
+    import threading
+    import time
+    from tranql.jobs import Job, JobManager
+    connected = threading.Event ()
+    closed = threading.Event ()
+    class Reasoner(socketserver.BaseRequestHandler):
+        """ Accept a request and never answer it. """
+        def handle (self):
+            connected.set ()
+            while self.request.recv (4096):
+                pass
+            closed.set ()
+    server = socketserver.ThreadingTCPServer (("127.0.0.1", 0), Reasoner)
+    threading.Thread (target=server.serve_forever, daemon=True).start ()
+    try:
+        manager = JobManager (workers=1)
+        job = manager.submit (f"""
+            SELECT chemical_substance->gene
+              FROM 'http://127.0.0.1:{server.server_address[1]}/graph/gamma/quick'
+             WHERE chemical_substance = 'CHEBI:28177'
+        """)
+        queued = manager.submit ("SET x = 'y'")
+        assert connected.wait (10)
+        assert job.status == Job.RUNNING and queued.status == Job.QUEUED
+        manager.cancel (job.id)
+        assert closed.wait (10)
+        for i in range(100):
+            if queued.done:
+                break
+            time.sleep (0.1)
+        assert job.status == Job.CANCELLED
+        assert queued.status == Job.DONE
+    finally:
+        server.shutdown ()
+        server.server_close ()
+
+def test_merge_knowledge_graphs ():
+    """ Later nodes with an equivalent identifier are folded into earlier ones, and their edges follow. """
+    print ("test_merge_knowledge_graphs ()")
+    from tranql.knowledge_graph import KnowledgeGraphMerger
+    merged = []
+    merger = KnowledgeGraphMerger (sink=lambda kind, item: merged.append ((kind, item['id'] if 'id' in item else item)))
+    merger.add ({
+        "question_graph" : { "nodes" : [], "edges" : [] },
+        "knowledge_graph" : {
+            "nodes" : [ { "id" : "CHEBI:1", "equivalent_identifiers" : [ "CHEBI:1", "CHEMBL:1" ] },
+                        { "id" : "HGNC:1" } ],
+            "edges" : [ { "id" : "e1", "type" : "affects", "source_id" : "CHEBI:1", "target_id" : "HGNC:1" } ]
+        },
+        "knowledge_map" : [ { "node_bindings" : { "a" : "CHEBI:1" } } ]
+    })
+    merger.add ({
+        "knowledge_graph" : {
+            "nodes" : [ { "id" : "CHEMBL:1" }, { "id" : "HGNC:1" }, { "id" : "HGNC:2" } ],
+            "edges" : [ { "id" : "e2", "type" : "affects", "source_id" : "CHEMBL:1", "target_id" : "HGNC:1" },
+                        { "id" : "e3", "type" : "affects", "source_id" : "CHEMBL:1", "target_id" : "HGNC:2" } ]
+        },
+        "knowledge_map" : [ { "node_bindings" : { "a" : "CHEMBL:1" } } ]
+    })
+    result = merger.result ()
+    assert 'question_graph' in result
+    assert [ n['id'] for n in result['knowledge_graph']['nodes'] ] == [ "CHEBI:1", "HGNC:1", "HGNC:2" ]
+    assert [ (e['id'], e['source_id']) for e in result['knowledge_graph']['edges'] ] == [ ("e1", "CHEBI:1"), ("e3", "CHEBI:1") ]
+    assert len(result['knowledge_map']) == 2
+    assert [ kind for kind, item in merged ] == [ "node", "node", "edge", "answer", "node", "edge", "answer" ]
+
+def test_stream_query (requests_mock, monkeypatch):
+    set_mock(requests_mock, "workflow-5")
+    """ Streaming runs a job responding with a record per merged element followed by a summary. """
+    print ("test_stream_query ()")
+    import tranql.api
+    import tranql.tranql_ast
+    monkeypatch.setattr (tranql.tranql_ast, "make_requests_async", make_requests_async)
+    client = tranql.api.app.test_client ()
+    query = chemical_gene_query
+    expected = tranql.api.TranQLQuery ().query_result (synchronous_tranql ().execute (query))
+    response = client.post ('/tranql/query', json={ "query" : query },
+                            headers={ "accept" : "application/x-ndjson" })
+    assert response.mimetype == "application/x-ndjson"
+    records = [ json.loads (line) for line in response.get_data (as_text=True).splitlines () ]
+    assert records[-1]['type'] == 'summary'
+    assert 'knowledge_map' not in records[-1]
+    assert [ r['node'] for r in records if r['type'] == 'node' ] == expected['knowledge_graph']['nodes']
+    assert [ r['edge'] for r in records if r['type'] == 'edge' ] == expected['knowledge_graph']['edges']
+    assert [ r['answer'] for r in records if r['type'] == 'answer' ] == expected['knowledge_map']
+    """ The streamed elements were not kept. """
+    job = max (tranql.api.jobs.jobs.values (), key=lambda job: job.created)
+    assert job.context.resolve_arg ("$result")['knowledge_graph']['edges'] == []
+
+def test_query_capture (tmpdir):
+    """ Sampled captures are kept in memory and written in the background. """
+    print ("test_query_capture ()")
+    from tranql.capture import QueryCapture
+    disabled = QueryCapture ()
+    assert not disabled.capture ("query", { "a" : 1 })
+    assert disabled.recent () == []
+    capture = QueryCapture (directory=str(tmpdir), sample_rate=1.0, capacity=2)
+    for i in range(3):
+        assert capture.capture ("query", { "i" : i })
+    capture.flush ()
+    assert [ r['payload']['i'] for r in capture.recent () ] == [ 1, 2 ]
+    written = sorted (tmpdir.listdir ())
+    assert len(written) + capture.dropped == 3
+    assert json.loads (written[0].read ()) == { "i" : 0 }
+
+def test_shared_interpreter_core (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Interpreters share vocabulary and schemas but not their variables. """
+    print ("test_shared_interpreter_core ()")
+    from tranql.tranql_schema import Schema
+    Schema.clear_shared ()
+    first = TranQL ()
+    second = TranQL ()
+    first.context.set ("x", 1)
+    assert second.context.resolve_arg ("$x") is None
+    assert first.context.resolve_arg ("$a1bg") == second.context.resolve_arg ("$a1bg") == "HGNC:5"
+    program = chemical_gene_query
+    schema_requests = len(requests_mock.request_history)
+    assert first.parse (program).schema is second.parse (program).schema
+    loaded = len(requests_mock.request_history) - schema_requests
+    second.parse (program)
+    assert len(requests_mock.request_history) - schema_requests == loaded
+    """ They share their configuration, parser and services too. """
+    assert first.core is second.core
+    assert first.parser is second.parser and first.name_resolver is second.name_resolver
+
+def test_shared_schema_loads (monkeypatch):
+    """ Callers arriving while a shared schema loads wait for that load, and expired schemas are reloaded. """
+    print ("test_shared_schema_loads ()")
+    import threading
+    import time
+    from tranql.tranql_schema import Schema
+    loads = []
+    class SlowSchema(Schema):
+        _shared = {}
+        _loading = {}
+        def __init__(self, backplane):
+            loads.append (backplane)
+            time.sleep (0.2)
+            self.loadErrors = []
+    schemas = []
+    threads = [ threading.Thread (target=lambda: schemas.append (SlowSchema.shared ("b"))) for i in range(4) ]
+    for thread in threads:
+        thread.start ()
+    for thread in threads:
+        thread.join ()
+    assert len(loads) == 1 and all ([ schema is schemas[0] for schema in schemas ])
+    monkeypatch.setattr (SlowSchema, "shared_ttl", 0)
+    assert SlowSchema.shared ("b") is not schemas[0]
+    assert len(loads) == 2
+
+def test_response_compression ():
+    """ JSON responses use the configured serializer and are compressed when the client accepts it. """
+    print ("test_response_compression ()")
+    import gzip
+    from flask import Flask
+    from flask_restful import Api, Resource
+    from tranql import serialization
+    assert serialization.choose_encoding ("gzip, deflate") == "gzip"
+    assert serialization.choose_encoding ("identity") is None
+    assert serialization.choose_encoding ("gzip;q=0, br") == ("br" if serialization.brotli else None)
+    app = Flask ("test_response_compression")
+    api = Api (app)
+    class Big(Resource):
+        def get (self):
+            return { "nodes" : [ { "id" : f"CHEBI:{i}" } for i in range(500) ] }
+    api.add_resource (Big, '/big')
+    serialization.configure_serialization (app, api, { "SERIALIZER" : "json" })
+    client = app.test_client ()
+    plain = client.get ('/big')
+    assert 'Content-Encoding' not in plain.headers
+    assert len(plain.get_json ()['nodes']) == 500
+    compressed = client.get ('/big', headers={ "Accept-Encoding" : "gzip" })
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert json.loads (gzip.decompress (compressed.get_data ())) == plain.get_json ()
+    serialization.set_serializer ('auto')
+
+def test_concept_filter_nodes ():
+    """ Include and exclude patterns keep the same nodes whether literal, anchored or regular expressions. """
+    print ("test_concept_filter_nodes ()")
+    from tranql.util import Concept
+    nodes = [ "CHEBI:15", "chebi:2", "MONDO:0004979", "HP:0001", { "id" : "MONDO:15" }, "NCBIGene:15" ]
+    concept = Concept (name="c", type_name="chemical_substance")
+    assert concept.filter_nodes (nodes) == nodes
+    concept.include_patterns.extend ([ "CHEBI:", "^mondo:" ])
+    concept.exclude_patterns.append (r"00049\d+$")
+    assert concept.filter_nodes (nodes) == [ "CHEBI:15", "chebi:2", { "id" : "MONDO:15" } ]
+    concept.include_patterns.append (r"^(NCBI)Gene:\d+")
+    assert concept.filter_nodes (nodes)[-1] == "NCBIGene:15"
+    """ Concepts made without patterns don't share pattern lists. """
+    assert Concept (name="d", type_name="gene").include_patterns == []
+
+def test_curie_prefix_filter ():
+    """ $id_filters excludes curies by prefix, ignoring case and whitespace, and is built once per value. """
+    print ("test_curie_prefix_filter ()")
+    from tranql.util import CuriePrefixFilter
+    id_filter = CuriePrefixFilter.compile ("SMILES, cas")
+    assert CuriePrefixFilter.compile ("SMILES, cas") is id_filter
+    assert id_filter.filter ([ "smiles:C1", "CAS:50-00-0", "MONDO:1", "CHEBI" ]) == [ "MONDO:1", "CHEBI" ]
+    nodes = [ { "curie" : "MONDO:1" }, { "curie" : "Smiles:x" } ]
+    assert id_filter.filter (nodes, curie=lambda n: n['curie']) == [ { "curie" : "MONDO:1" } ]
+    assert not CuriePrefixFilter.compile (None)
+    assert CuriePrefixFilter.compile (None).filter ([ "SMILES:x" ]) == [ "SMILES:x" ]
+
+def test_expiring_cache_evicts (monkeypatch):
+    """ Expired entries are dropped as entries are stored, and the oldest when the cache is full. """
+    print ("test_expiring_cache_evicts ()")
+    import time
+    from tranql.util import ExpiringCache
+    from tranql.name_resolver import NameResolver
+    now = [ 1000.0 ]
+    monkeypatch.setattr (time, "time", lambda: now[0])
+    cache = ExpiringCache ("test", ttl=10, limit=4)
+    cache.put ("a", 1)
+    now[0] += 11
+    cache.put ("b", 2)
+    assert list (cache.entries) == [ "b" ]
+    for key in "cdef":
+        cache.put (key, key)
+    assert len(cache.entries) <= 4 and cache.peek ("f") == "f" and cache.peek ("b") is None
+    """ Resolvers are shared by the process, and bound their lookups across all their callers. """
+    assert NameResolver.shared (workers=2) is NameResolver.shared (workers=2)
+    import threading
+    resolver = NameResolver (workers=2)
+    lock = threading.Lock ()
+    in_flight = []
+    most = []
+    def lookup (name, type_name):
+        with lock:
+            in_flight.append (name)
+            most.append (len(in_flight))
+        time.sleep (0.02)
+        with lock:
+            in_flight.remove (name)
+        return [ name ]
+    resolver.lookup = lookup
+    callers = [ threading.Thread (target=resolver.resolve_many, args=([ (f"{c}{i}", "disease") for i in range (3) ],))
+                for c in "ab" ]
+    for caller in callers:
+        caller.start ()
+    for caller in callers:
+        caller.join ()
+    assert len(most) == 6 and max (most) == 2
+
+def test_resolve_equivalent_identifiers (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Names are resolved once each, concurrently, so nodes of different responses with the same name merge. """
+    print ("test_resolve_equivalent_identifiers ()")
+    from tranql.name_resolver import NameResolver
+    lookup = requests_mock.get ("https://bionames.renci.org/lookup/asthma/disease/",
+                                json=[ { "id" : "MONDO:0004979" }, { "id" : "DOID:2841" } ])
+    requests_mock.get ("https://bionames.renci.org/lookup/nothing/disease/", status_code=500)
+    tranql = TranQL ()
+    tranql.resolve_names = True
+    tranql.name_resolver = NameResolver (workers=2)
+    select = tranql.parse ("SELECT disease->gene FROM '/graph/gamma/quick'").statements[0]
+    responses = [
+        { "knowledge_graph" : { "nodes" : [ { "id" : "MONDO:0004979", "name" : "asthma", "type" : "disease" } ], "edges" : [] } },
+        { "knowledge_graph" : { "nodes" : [ { "id" : "DOID:2841", "name" : "asthma", "type" : [ "disease" ] },
+                                            { "id" : "DOID:1", "name" : "nothing", "type" : "disease" } ], "edges" : [] } }
+    ]
+    merged = select.merge_results (responses, select.service, tranql)
+    assert [ n['id'] for n in merged['knowledge_graph']['nodes'] ] == [ "MONDO:0004979", "DOID:1" ]
+    assert merged['knowledge_graph']['nodes'][1]['equivalent_identifiers'] == [ "DOID:1" ]
+    assert lookup.call_count == 1
+    """ Resolved names are remembered across queries. """
+    assert tranql.name_resolver.resolve ("asthma", "disease") == [ "MONDO:0004979", "DOID:2841" ]
+    assert lookup.call_count == 1
+
+def test_synonym_index (tmpdir):
+    """ Nodes whose identifiers share a clique of the synonym index are merged. """
+    print ("test_synonym_index ()")
+    from tranql.knowledge_graph import KnowledgeGraphMerger
+    from tranql.synonyms import SynonymIndex
+    path = str(tmpdir.join ("synonyms.tsv"))
+    count = SynonymIndex.build ([
+        [ "CHEBI:30769", "CHEMBL:CHEMBL1261", "MESH:D019343" ],
+        [ "MONDO:0004979", "DOID:2841" ],
+        [ "HGNC:1" ]
+    ], path)
+    assert count == 6
+    synonyms = SynonymIndex (path)
+    assert [ synonyms.clique (i) for i in [ "CHEBI:30769", "CHEMBL:CHEMBL1261", "MESH:D019343", "DOID:2841", "HGNC:1" ] ] == \
+        [ "CHEBI:30769", "CHEBI:30769", "CHEBI:30769", "MONDO:0004979", "HGNC:1" ]
+    assert synonyms.clique ("AAA:0") is None and synonyms.clique ("ZZZ:0") is None and "CHEBI:3" not in synonyms
+    merger = KnowledgeGraphMerger (synonyms=synonyms)
+    merger.add ({ "knowledge_graph" : {
+        "nodes" : [ { "id" : "CHEMBL:CHEMBL1261" }, { "id" : "HGNC:1" } ],
+        "edges" : [ { "type" : "affects", "source_id" : "CHEMBL:CHEMBL1261", "target_id" : "HGNC:1" } ] } })
+    merger.add ({ "knowledge_graph" : {
+        "nodes" : [ { "id" : "MESH:D019343" }, { "id" : "HGNC:1" } ],
+        "edges" : [ { "type" : "affects", "source_id" : "MESH:D019343", "target_id" : "HGNC:1" } ] } })
+    result = merger.result ()['knowledge_graph']
+    assert [ n['id'] for n in result['nodes'] ] == [ "CHEMBL:CHEMBL1261", "HGNC:1" ]
+    assert len(result['edges']) == 1
+    synonyms.close ()
+    """ Interpreters share one index per path. """
+    from tranql.synonyms import open_synonyms, close_synonyms
+    shared = open_synonyms ({ "SYNONYM_INDEX" : path })
+    assert open_synonyms ({ "SYNONYM_INDEX" : path }) is shared and shared.clique ("DOID:2841") == "MONDO:0004979"
+    close_synonyms ()
+    assert shared.map is None and open_synonyms ({ "SYNONYM_INDEX" : "none" }) is None
+    """ An empty index knows no identifiers. """
+    SynonymIndex.build ([], path)
+    assert SynonymIndex (path).clique ("HGNC:1") is None
+
+def test_merge_interns_curies ():
+    """ A merged graph is made of the messages' own dicts, with each distinct curie held once. """
+    print ("test_merge_interns_curies ()")
+    from tranql.knowledge_graph import KnowledgeGraphMerger, bindings
+    from tranql.util import Context
+    message = {
+        "question_graph" : { "nodes" : [], "edges" : [] },
+        "knowledge_graph" : {
+            "nodes" : [ { "id" : "CHEBI:1", "name" : "a", "type" : "chemical_substance" },
+                        { "id" : "HGNC:1", "name" : "g1", "type" : "gene" },
+                        { "id" : "HGNC:2", "name" : "g2", "type" : [ "gene" ] } ],
+            "edges" : [ { "id" : "e1", "type" : "affects", "source_id" : "CHEBI:1", "target_id" : "HGNC:1", "weight" : 0.25, "publications" : [] },
+                        { "id" : "e2", "type" : "affects", "source_id" : "CHEBI:1", "target_id" : "HGNC:2", "weight" : 0.75, "publications" : [ "PMID:1" ] },
+                        { "id" : "e3", "source_id" : "HGNC:1", "target_id" : "HGNC:2", "weight" : 1 } ]
+        },
+        "knowledge_map" : [ { "node_bindings" : { "c" : "CHEBI:1", "g" : [ "HGNC:1", "HGNC:2" ] } } ]
+    }
+    expected = json.loads (json.dumps (message))
+    first, second = json.loads (json.dumps (message)), json.loads (json.dumps (message))
+    merger = KnowledgeGraphMerger ()
+    merger.add (first)
+    merger.add (second)
+    result = merger.result ()
+    assert result['knowledge_graph']['edges'] == expected['knowledge_graph']['edges']
+    assert [ node['id'] for node in result['knowledge_graph']['nodes'] ] == [ "CHEBI:1", "HGNC:1", "HGNC:2" ]
+    assert result['knowledge_graph']['edges'][0] is first['knowledge_graph']['edges'][0]
+    nodes = { node['id'] : node for node in result['knowledge_graph']['nodes'] }
+    edge = result['knowledge_graph']['edges'][1]
+    assert edge['source_id'] is nodes['CHEBI:1']['id'] and edge['target_id'] is nodes['HGNC:2']['id']
+    assert bindings (result['knowledge_map'], "g") == [ [ "HGNC:1", "HGNC:2" ] ] * 2
+    assert result['knowledge_map'][1]['node_bindings']['c'] is nodes['CHEBI:1']['id']
+    context = Context ()
+    context.set ("result", result)
+    assert context.top ("gene", n=2) == [
+        [ "g1", "HGNC:1", None, "g2", "HGNC:2", 1, [] ],
+        [ "a", "CHEBI:1", "affects", "g2", "HGNC:2", 0.75, [ "PMID:1" ] ]
+    ]
+
+def test_statements_share_planner (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Statements of a program share one planner and schema, and carry no per instance dict. """
+    print ("test_statements_share_planner ()")
+    tranql = TranQL ()
+    ast = tranql.parse ("""
+        SELECT disease->gene FROM '/graph/gamma/quick' WHERE disease = 'MONDO:0004979'
+        SELECT chemical_substance->gene FROM '/graph/gamma/quick' WHERE chemical_substance = 'CHEBI:1'
+    """)
+    first, second = ast.statements
+    assert first.planner is second.planner is ast.planner
+    assert ast.planner.schema is ast.schema
+    assert first.jsonkit is second.jsonkit
+    for element in [ first, first.query, first.query.concepts['disease'] ]:
+        assert not hasattr (element, '__dict__')
+    """ Nor does a statement of any other kind. """
+    from tranql.tranql_ast import CreateGraphStatement, ExplainStatement, Statement
+    statements = [ SetStatement ("x", value=1), CreateGraphStatement ("$x", "/visualize/ndex", "x"),
+                   ExplainStatement (first, analyze=True) ]
+    assert { type(stmt) for stmt in statements + [ first ] } == set (Statement.__subclasses__ ())
+    for stmt in statements:
+        assert not hasattr (stmt, '__dict__')
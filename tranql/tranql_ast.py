@@ -11,9 +11,16 @@ from tranql.concept import ConceptModel
 from tranql.concept import BiolinkModelWalker
 from tranql.tranql_schema import Schema
 from tranql.util import Concept
+from tranql.util import CuriePrefixFilter
 from tranql.util import JSONKit
-from tranql.request_util import async_make_requests
+from tranql.request_util import async_make_requests, make_requests_async, run_blocking
+from tranql.instrumentation import span, inject
+from tranql.metrics import observe_cache, observe_merge, observe_reasoner_requests, questions_per_query, record_error
 from tranql.util import Text
+from tranql.util import Stats
+from tranql.util import Lazy
+from tranql.util import LazyJSON
+from tranql.knowledge_graph import KnowledgeGraphMerger, bindings
 from tranql.tranql_schema import Schema
 from tranql.exception import ServiceInvocationError
 from tranql.exception import UndefinedVariableError
@@ -28,33 +35,21 @@ logger = logging.getLogger (__name__)
 def truncate (s, max_length=75):
     return (s[:max_length] + '..') if len(s) > max_length else s
 
-class Bionames:
-    """ Resolve natural language names to ontology identifiers. """
-    url = "https://bionames.renci.org/lookup/{input}/{type}/"
-
-    @staticmethod
-    def get_ids (name, type_name):
-        url = Bionames.url.format (**{
-            "input" : name,
-            "type"  : type_name
-        })
-        result = None
-        response = requests.get(
-            url = url,
-            headers = {
-                'accept': 'application/json'
-            })
-        if response.status_code == 200 or response.status_code == 202:
-            result = response.json ()
-        else:
-            raise ServiceInvocationError (response.text)
-        return result
-
 class Statement:
     """ The interface contract for a statement. """
+    __slots__ = ()
+
+    """ Stateless, so shared by all statements. """
+    jsonkit = JSONKit ()
+
     def execute (self, interpreter, context={}):
         pass
 
+    async def execute_async (self, interpreter):
+        """ Execute the statement from a coroutine. Statements without native asynchronous
+        I/O run in a worker thread so they don't block the event loop. """
+        return await run_blocking (self.execute, interpreter)
+
     def resolve_backplane_url(self, url, interpreter):
         result = url
         if url.startswith ('/'):
@@ -79,74 +74,101 @@ class Statement:
             "options" : options
         }
 
-    def request (self, url, message):
-        """ Make a web request to a service (url) posting a message. """
-        logger.debug (f"request({url})> {json.dumps(message, indent=2)}")
+    def request (self, url, message, stats=None):
+        """ Make a web request to a service (url) posting a message.
+        If a stats list is supplied, append the url, status, latency and size of the response. """
+        logger.debug ("request(%s)> %s", url, LazyJSON (message))
         response = {}
         unknown_service = False
+        start = time.time ()
         try:
-            http_response = requests.post (
-                url = url,
-                json = message,
-                headers = {
-                    'accept': 'application/json'
+            with span ("request", kind="client", url=url) as request_span:
+                http_response = requests.post (
+                    url = url,
+                    json = message,
+                    headers = inject ({
+                        'accept': 'application/json'
+                    }))
+                request_span.set_attribute ("status", http_response.status_code)
+                request_span.set_attribute ("bytes", len(http_response.content))
+            observe_cache ("requests", http_response)
+            if stats is not None:
+                stats.append ({
+                    "url" : url,
+                    "status" : http_response.status_code,
+                    "elapsed" : time.time () - start,
+                    "bytes" : len(http_response.content)
                 })
             """ Check status and handle response. """
             if http_response.status_code == 200 or http_response.status_code == 202:
                 response = http_response.json ()
                 #logger.error (f" response: {json.dumps(response, indent=2)}")
-                status = response.get('status', None)
+                status = response.get('status', None) if isinstance (response, dict) else None
                 if status == "error":
                     raise ServiceInvocationError(
                         message=f"An error occurred invoking service: {url}.",
                         details=truncate(response['message'], max_length=5000))
-                logging.debug (f"{json.dumps(response, indent=2)}")
+                logger.debug ("%s", LazyJSON (response))
             elif http_response.status_code == 404:
                 unknown_service = True
             else:
-                logger.error (f"error {http_response.status_code} processing request: {message}")
-                logger.error (http_response.text)
+                logger.error ("error %s processing request: %s", http_response.status_code, LazyJSON (message))
+                logger.error ("%s", Lazy (lambda: http_response.text))
         except ServiceInvocationError as e:
+            record_error (e)
             raise e
         except Exception as e:
-            logger.error (f"error performing request: {json.dumps(message, indent=2)} to url: {url}")
+            record_error (e)
+            logger.error ("error performing request: %s to url: %s", LazyJSON (message), url)
             #traceback.print_exc ()
             logger.error (traceback.format_exc ())
         if unknown_service:
-            raise UnknownServiceError (f"Service {url} was not found. Is it misspelled?")
+            error = UnknownServiceError (f"Service {url} was not found. Is it misspelled?")
+            record_error (error)
+            raise error
         return response
 
 class SetStatement(Statement):
     """ Model the set statement's semantics and variants. """
+    __slots__ = ('variable', 'value', 'jsonpath_query')
+
     def __init__(self, variable, value=None, jsonpath_query=None):
         """ Model the various forms of assignment supported. """
         self.variable = variable
         self.value = value
         self.jsonpath_query = jsonpath_query
-        self.jsonkit = JSONKit ()
     def execute (self, interpreter, context={}):
-        logger.debug (f"set-statement: {self.variable}={self.value}")
+        with span ("set", variable=self.variable):
+            return self.assign (interpreter, context)
+
+    async def execute_async (self, interpreter):
+        """ Assignment does no I/O; run it inline. """
+        return self.execute (interpreter)
+
+    def assign (self, interpreter, context={}):
+        """ Assign an explicit value, a result, or a JSONPath selection from a result. """
+        logger.debug ("set-statement: %s=%s", self.variable, self.value)
         return_val = None
         if self.value:
-            logger.debug (f"exec-set-statement(explicit-value): {self}")
+            logger.debug ("exec-set-statement(explicit-value): %s", self)
             interpreter.context.set (self.variable, self.value)
             return_val = self.value
         elif 'result' in context:
             result = context['result']
             if self.jsonpath_query is not None:
-                logger.debug (f"exec-set-statement(jsonpath): {self}")
+                logger.debug ("exec-set-statement(jsonpath): %s", self)
                 value = self.jsonkit.select (
                     query=self.jsonpath_query,
                     graph=result)
                 if len(value) == 0:
-                    logger.warn (f"Got empty set for query {self.jsonpath_query} on " +
-                           f"object {json.dumps(result, indent=2)}")
+                    logger.warning ("Got empty set for query %s on object %s",
+                                    self.jsonpath_query, LazyJSON (result))
                 interpreter.context.set (
                     self.variable,
                     value)
                 return_val = value
             else:
-                logger.debug (f"exec-set-statement(result): {self}")
+                logger.debug ("exec-set-statement(result): %s", self)
                 interpreter.context.set (self.variable, result)
                 return_val = result
         return return_val
@@ -161,6 +183,8 @@ class SetStatement(Statement):
 
 class CreateGraphStatement(Statement):
     """ Create a graph, sending it to a sink. """
+    __slots__ = ('graph', 'service', 'name')
+
     def __init__(self, graph, service, name):
         """ Construct a graph creation statement. """
         self.graph = graph
@@ -173,8 +197,8 @@ class CreateGraphStatement(Statement):
         self.service = self.resolve_backplane_url(self.service,
                                                   interpreter)
         graph = interpreter.context.resolve_arg (self.graph)
-        logger.debug (f"------- {type(graph).__name__}")
-        logger.debug (f"--- create graph {self.service} graph-> {json.dumps(graph, indent=2)}")
+        logger.debug ("------- %s", type(graph).__name__)
+        logger.debug ("--- create graph %s graph-> %s", self.service, LazyJSON (graph))
         response = None
         with requests_cache.disabled ():
             response = self.request (url=self.service,
@@ -188,7 +212,7 @@ def synonymize(nodetype,identifier):
     url=f'http://{robokop_server}/api/synonymize/{identifier}/{nodetype}/'
     url=f'http://{robokop_server}:6010/api/synonymize/{identifier}/{nodetype}/'
     response = requests.post(url)
-    logger.debug (f'Return Status: {response.status_code}' )
+    logger.debug ('Return Status: %s', response.status_code)
     if response.status_code == 200:
         return response.json()
     return []
@@ -198,6 +222,17 @@ class SelectStatement(Statement):
     Model a select statement.
     This entails all capabilities from specifying a knowledge path, service to invoke, constraints, and handoff.
     """
+    """ The maximum number of questions sent to a service per statement. """
+    maximum_query_requests = 50
+
+    """ The most requests to have in flight at once when requesting asynchronously. """
+    maximum_parallel_requests = 4
+
+    """ The most questions to send the backplane in one batch. """
+    maximum_batch_size = 10
+
+    __slots__ = ('ast', 'query', 'service', 'where', 'set_statements', 'stats', 'batched', 'sink')
+
     def __init__(self, ast, service=None):
         """ Initialize a new select statement. """
         self.ast = ast
@@ -205,12 +240,21 @@ class SelectStatement(Statement):
         self.service = service
         self.where = []
         self.set_statements = []
-        self.jsonkit = JSONKit ()
-        self.planner = QueryPlanStrategy (ast.backplane)
+        """ Receives merged knowledge graph elements as they are merged. See KnowledgeGraphMerger. """
+        self.sink = None
+        """ Execution statistics, populated by execute (). """
+        self.stats = {}
+        """ Whether questions go to the backplane in batches. Decided by prepare_requests (). """
+        self.batched = False
 
     def __repr__(self):
         return f"SELECT {self.query} from:{self.service} where:{self.where} set:{self.set_statements}"
 
+    @property
+    def planner (self):
+        """ The query planner of the program, shared by its statements. """
+        return self.ast.planner
+
     def edge (self, index, source, target, type_name=None):
         """ Generate a question edge. """
         e = {
@@ -241,25 +285,40 @@ class SelectStatement(Statement):
                 result = None
         return result
 
-    def resolve_name (self, name, type_names):
-        if not isinstance(type_names, list):
-            type_names = [type_names]
-        #result += self.synonymize (value, type_name)
-        result = []
-        for type_name in type_names:
-            equivalent_identifiers = Bionames.get_ids (name, type_name)
-            for i in equivalent_identifiers:
-                result.append(i["id"])
-        for type_name in type_names:
-            if type_name == 'chemical_substance':
-                response = requests.get (f"http://mychem.info/v1/query?q={name}").json ()
-                for obj in response['hits']:
-                    if 'chebi' in obj:
-                        result.append (obj['chebi']['id'])
-                    if 'chembl' in obj:
-                        result.append ("CHEMBL:"+obj['chembl']['molecule_chembl_id'])
-        logger.debug (f"name resolution result: {name} => {result}")
-        return result
+    def resolve_name (self, interpreter, name, type_names):
+        """ The identifiers of a name of any of the given types. """
+        return interpreter.name_resolver.resolve (name, type_names)
+
+    def resolve_equivalent_identifiers (self, interpreter, responses):
+        """
+        Give each node lacking equivalent_identifiers those of its name, resolving the distinct
+        names of all responses concurrently. A node whose name can't be resolved is only
+        equivalent to its own identifier. Nodes the synonym index knows need no lookup.
+        """
+        synonyms = interpreter.synonyms
+        unresolved = [
+            node
+            for response in responses if isinstance (response, dict)
+            for node in (response.get ('knowledge_graph') or {}).get ('nodes', [])
+            if 'equivalent_identifiers' not in node and not (synonyms is not None and node['id'] in synonyms)
+        ]
+        if len(unresolved) == 0:
+            return
+        prev = time.time ()
+        type_names = lambda node: node['type'] if isinstance (node.get ('type'), list) else [ node.get ('type', '') ]
+        with span ("resolve_names", nodes=len(unresolved)):
+            resolved = interpreter.name_resolver.resolve_many ([
+                (node['name'], type_name)
+                for node in unresolved if node.get ('name')
+                for type_name in type_names (node)
+            ], strict=False)
+        for node in unresolved:
+            keys = [ (node.get ('name'), type_name) for type_name in type_names (node) ]
+            if node.get ('name') and all ([ key in resolved for key in keys ]):
+                node['equivalent_identifiers'] = [ i for key in keys for i in resolved[key] ]
+            else:
+                node['equivalent_identifiers'] = [ node['id'] ]
+        logger.info ('Fetched equivalent identifiers for %s nodes (%ss).', len(unresolved), time.time () - prev)
 
     def expand_nodes (self, interpreter, concept):
         """ Expand variable expressions to nodes. """
@@ -268,7 +327,7 @@ class SelectStatement(Statement):
             if value.startswith ("$"):
                 varname = value
                 value = interpreter.context.resolve_arg (varname)
-                logger.debug (f"resolved {varname} to {value}")
+                logger.debug ("resolved %s to %s", varname, value)
                 if value == None:
                     raise UndefinedVariableError (f"Undefined variable: {varname}")
                 elif isinstance (value, str):
@@ -286,9 +345,9 @@ class SelectStatement(Statement):
                     """ Bind something that's not a curie. Dynamic id lookup.
                     This is frowned upon. While it *may* be useful for prototyping and,
                     interactive exploration, it will probably be removed. """
-                    logger.debug (f"performing dynamic lookup resolving {concept}={value}")
-                    concept.set_nodes (self.resolve_name (value, concept.type_name))
-                    logger.debug (f"resolved {value} to identifiers: {concept.nodes}")
+                    logger.debug ("performing dynamic lookup resolving %s=%s", concept, value)
+                    concept.set_nodes (self.resolve_name (interpreter, value, concept.type_name))
+                    logger.debug ("resolved %s to identifiers: %s", value, Lazy (lambda: concept.nodes))
                 else:
                     """ This is a single curie. Bind it to the node. """
                     pass
@@ -300,12 +359,12 @@ class SelectStatement(Statement):
         for phase in plan:
             schema, url, steps = phase
             """ Make a new select statement for each segment. Set the from clause given the url. """
-            logger.debug (f"Making select for schema segment: {schema}")
+            logger.debug ("Making select for schema segment: %s", schema)
             statement = SelectStatement (ast=self.ast, service=url)
             statements.append (statement)
             for index, step in enumerate (steps):
                 subj, pred, obj = step
-                logger.debug (f" --> {schema}:{url} {subj} {pred} {obj}")
+                logger.debug (" --> %s:%s %s %s %s", schema, url, subj, pred, obj)
                 """ Add each concept and transition to the query. """
                 statement.query.add (subj)
                 statement.query.add (pred)
@@ -334,7 +393,7 @@ class SelectStatement(Statement):
             concept = self.query[name]
             if len(concept.nodes) > 0:
                 self.expand_nodes (interpreter, concept)
-                logger.debug (f"concept--nodes: {concept.nodes}")
+                logger.debug ("concept--nodes: %s", Lazy (lambda: concept.nodes))
                 concept.set_nodes ([
                     self.node (
                         index = name, #index,
@@ -342,13 +401,9 @@ class SelectStatement(Statement):
                         value = self.val(v, field='curie'))
                     for v in concept.nodes
                 ])
-                filters = interpreter.context.resolve_arg ('$id_filters')
-                if filters:
-                    filters = [ f.lower () for f in filters.split(",") ]
-                    concept.set_nodes ([
-                        n for n in concept.nodes
-                        if not n['curie'].split(':')[0].lower () in filters
-                    ])
+                id_filter = self.id_filter (interpreter)
+                if id_filter:
+                    concept.set_nodes (id_filter.filter (concept.nodes, curie=lambda n: n['curie']))
             else:
                 """ There are no values - it's just a template for a model type. """
                 concept.set_nodes ([ self.node (
@@ -359,7 +414,7 @@ class SelectStatement(Statement):
         for constraint in self.where:
             """ This is where we pass constraints to a service. We do this only for constraints
             which do not refer to elements in the query. """
-            logger.debug (f"manage constraint: {constraint}")
+            logger.debug ("manage constraint: %s", constraint)
             name, op, value = constraint
             value = interpreter.context.resolve_arg (value)
             if not name in self.query:
@@ -370,11 +425,11 @@ class SelectStatement(Statement):
                 options[name] = constraint[1:]
         edges = []
         questions = []
-        logger.debug (f"concept order> {self.query.order}")
+        logger.debug ("concept order> %s", self.query.order)
         for index, name in enumerate (self.query.order):
             concept = self.query[name]
             previous = self.query.order[index-1] if index > 0 else None
-            logger.debug (f"query:{self.query}")
+            logger.debug ("query:%s", self.query)
             #logger.debug (f"questions:{index} ==>> {json.dumps(questions, indent=2)}")
             if index == 0:
                 """ Model the first step. """
@@ -397,7 +452,7 @@ class SelectStatement(Statement):
                             """ Permute each question. """
                             nodes = copy.deepcopy (question["question_graph"]['nodes'])
                             if len(nodes) == 0:
-                                logger.debug (f"No values in concept {concept.name}")
+                                logger.debug ("No values in concept %s", concept.name)
                                 continue
                             lastnode = nodes[-1]
                             nodes.append (node)
@@ -435,6 +490,41 @@ class SelectStatement(Statement):
                 questions = new_questions
         return questions
 
+    def dedupe_questions (self, questions):
+        """ Remove duplicate questions, preserving order. Handoff values often repeat. """
+        seen = set ()
+        result = []
+        for question in questions:
+            key = json.dumps (question, sort_keys=True)
+            if not key in seen:
+                seen.add (key)
+                result.append (question)
+        return result
+
+    def count_bindings (self, interpreter, concept):
+        """ Estimate the number of values bound to a concept without resolving names or
+        mutating the concept. Returns None if the count can't be known before execution. """
+        if len(concept.nodes) == 0:
+            return 1
+        value = concept.nodes[0]
+        values = concept.nodes
+        if isinstance(value, str) and value.startswith ("$"):
+            value = interpreter.context.resolve_arg (value)
+            if value is None:
+                raise UndefinedVariableError (f"Undefined variable: {concept.nodes[0]}")
+            values = [ value ] if isinstance(value, str) else value
+        elif isinstance(value, str) and not ':' in value:
+            """ Requires dynamic name resolution. """
+            return None
+        values = concept.filter_nodes (values)
+        values = self.id_filter (interpreter).filter (values, curie=lambda v: self.val (v, field='curie'))
+        return len(values)
+
+    def id_filter (self, interpreter):
+        """ The curie prefixes excluded by the $id_filters variable. """
+        filters = interpreter.context.resolve_arg ('$id_filters')
+        return CuriePrefixFilter.compile (filters if isinstance (filters, str) else None)
+
     def execute (self, interpreter, context={}):
         """
         Execute all statements in the abstract syntax tree.
@@ -442,219 +532,383 @@ class SelectStatement(Statement):
         - Resolve the service name.
         - Execute the questions.
         """
-        result = None
         if self.service == "/schema":
-            result = self.execute_plan (interpreter)
-        else:
-            self.service = self.resolve_backplane_url (self.service, interpreter)
-            questions = self.generate_questions (interpreter)
-            [self.ast.schema.validate_question(question) for question in questions]
-            service = interpreter.context.resolve_arg (self.service)
-
-            """ Invoke the service and store the response. """
-
-            # For each question, make a request to the service with the question
-            # Only have a maximum of maximumParallelRequests requests executing at any given time
-            logger.setLevel (logging.DEBUG)
-            logger.debug (f"Starting queries on service: {service} (asynchronous={interpreter.asynchronous})")
-            logger.setLevel (logging.INFO)
-            prev = time.time ()
-            # We don't want to flood the service so we cap the maximum number of requests we can make to it.
-            maximumQueryRequests = 50
-            interpreter.context.set('requestErrors',[])
+            return self.execute_plan (interpreter)
+        service, sent = self.prepare_requests (interpreter)
+        prev = time.time ()
+        with span ("requests", service=service, questions=len(sent)):
             if interpreter.asynchronous:
-                maximumParallelRequests = 4
-                responses = async_make_requests ([
-                    {
-                        "method" : "post",
-                        "url" : service,
-                        "json" : q,
-                        "headers" : {
-                            "accept": "application/json"
-                        }
-                    }
-                    for q in questions[:maximumQueryRequests]
-                ],maximumParallelRequests)
-                errors = responses["errors"]
-                responses = responses["responses"]
-                interpreter.context.mem.get('requestErrors', []).extend(errors)
-
+                responses, request_stats = self.collect_responses (
+                    interpreter,
+                    async_make_requests (self.request_pool (service, sent), self.maximum_parallel_requests))
+                responses = self.unbatch (interpreter, service, responses)
             else:
                 responses = []
-                for index, q in enumerate(questions):
-                    logger.debug (f"executing question {json.dumps(q, indent=2)}")
-                    response = self.request (service, q)
-                    # TODO - add a parameter to limit service invocations.
-                    # Until we parallelize requests, cap the max number we attempt for performance reasons.
-                    if index >= maximumQueryRequests:
-                        break
+                request_stats = []
+                for q in self.batches (sent):
+                    logger.debug ("executing question %s", LazyJSON (q))
+                    response = self.request (service, q, stats=request_stats)
                     #logger.debug (f"response: {json.dumps(response, indent=2)}")
                     responses.append (response)
+                responses = self.unbatch (interpreter, service, responses)
+        return self.complete_requests (interpreter, service, responses, request_stats, prev)
 
+    async def execute_async (self, interpreter, context={}):
+        """ Execute the statement, awaiting reasoner requests on the running event loop. """
+        if self.service == "/schema":
+            return await self.execute_plan_async (interpreter)
+        """ Question generation (which may look up names) and merging block, so they run in a worker thread. """
+        service, sent = await run_blocking (self.prepare_requests, interpreter)
+        prev = time.time ()
+        with span ("requests", service=service, questions=len(sent)):
+            responses, request_stats = self.collect_responses (
+                interpreter,
+                await make_requests_async (self.request_pool (service, sent), self.maximum_parallel_requests))
+            responses = self.unbatch (interpreter, service, responses)
+        return await run_blocking (self.complete_requests, interpreter, service, responses, request_stats, prev)
 
-            logger.setLevel (logging.DEBUG)
-            logger.debug (f"Making requests took {time.time()-prev} s (asynchronous = {interpreter.asynchronous})")
-            logger.setLevel (logging.INFO)
-            if len(responses) == 0:
-                # interpreter.context.mem.get('requestErrors',[]).append(ServiceInvocationError(
-                #     f"No valid results from {self.service} with query {self.query}"
-                # ))
-                raise ServiceInvocationError (
-                    f"No valid results from service {self.service} executing " +
-                    f"query {self.query}. Unable to continue query. Exiting.")
-            result = self.merge_results (responses, service, interpreter)
+    def prepare_requests (self, interpreter):
+        """ Generate, validate, dedupe and cap the questions to send. Returns the service url and the questions. """
+        self.service = self.resolve_backplane_url (self.service, interpreter)
+        with span ("questions"):
+            questions = self.generate_questions (interpreter)
+            [self.ast.schema.validate_question(question) for question in questions]
+        service = interpreter.context.resolve_arg (self.service)
+
+        """ Invoke the service and store the response. """
+
+        # We don't want to flood the service so we cap the maximum number of requests we can make to it.
+        unique_questions = self.dedupe_questions (questions)
+        sent = unique_questions[:self.maximum_query_requests]
+        self.stats = {
+            "service" : service,
+            "questions_generated" : len(questions),
+            "questions_deduped" : len(questions) - len(unique_questions),
+            "questions_truncated" : len(unique_questions) - len(sent),
+            "questions_sent" : len(sent)
+        }
+        questions_per_query.observe (len(sent))
+
+        """ The backplane answers a list of questions in one request, asking its upstream concurrently. """
+        backplane = interpreter.context.resolve_arg ("$backplane")
+        self.batched = interpreter.batch_requests and len(sent) > 1 and \
+            bool(backplane) and service.startswith (backplane)
+        self.stats['batches'] = len(self.batches (sent)) if self.batched else 0
+
+        # For each question, make a request to the service with the question
+        # Only have a maximum of maximum_parallel_requests requests executing at any given time
+        logger.debug ("Starting queries on service: %s (asynchronous=%s)", service, interpreter.asynchronous)
+        interpreter.context.set('requestErrors',[])
+        return service, sent
+
+    def batches (self, questions):
+        """ The request bodies carrying the questions: batches of them for the backplane, otherwise one each. """
+        if not self.batched:
+            return questions
+        size = self.maximum_batch_size
+        return [ questions[i:i + size] for i in range (0, len(questions), size) ]
+
+    def unbatch (self, interpreter, service, responses):
+        """ Flatten the answers of batches, recording the errors of questions the backplane could not answer. """
+        if not self.batched:
+            return responses
+        answers = []
+        for response in responses:
+            for answer in (response if isinstance (response, list) else [ response ]):
+                if isinstance (answer, dict) and answer.get ('status', None) == "error":
+                    error = ServiceInvocationError (
+                        message=f"An error occurred invoking service: {service}.",
+                        details=truncate (answer.get ('message', ''), max_length=5000))
+                    interpreter.context.mem.get ('requestErrors', []).append (error)
+                    record_error (error)
+                elif answer:
+                    answers.append (answer)
+        return answers
+
+    def request_pool (self, service, questions):
+        """ Describe a request per batch or question in the form the request engine accepts. """
+        return [
+            {
+                "method" : "post",
+                "url" : service,
+                "json" : q,
+                "headers" : {
+                    "accept": "application/json"
+                }
+            }
+            for q in self.batches (questions)
+        ]
+
+    def collect_responses (self, interpreter, responses):
+        """ Record the errors of a pool of concurrent requests. Returns the responses and request stats. """
+        errors = responses["errors"]
+        interpreter.context.mem.get('requestErrors', []).extend(errors)
+        for error in errors:
+            record_error (error)
+        return responses["responses"], responses["stats"]
+
+    def complete_requests (self, interpreter, service, responses, request_stats, prev):
+        """ Record request stats, merge the responses and execute associated set statements. """
+        request_time = time.time () - prev
+        logger.debug ("Making requests took %s s (asynchronous = %s)", request_time, interpreter.asynchronous)
+        self.stats.update ({
+            "request_time" : request_time,
+            "latency" : Stats.summarize ([ r['elapsed'] for r in request_stats ]),
+            "bytes_received" : sum ([ r['bytes'] for r in request_stats ])
+        })
+        observe_reasoner_requests (request_stats)
+        if len(responses) == 0:
+            # interpreter.context.mem.get('requestErrors',[]).append(ServiceInvocationError(
+            #     f"No valid results from {self.service} with query {self.query}"
+            # ))
+            raise ServiceInvocationError (
+                f"No valid results from service {self.service} executing " +
+                f"query {self.query}. Unable to continue query. Exiting.")
+        prev = time.time ()
+        with span ("merge", responses=len(responses)):
+            result = self.merge_results (responses, service, interpreter, sink=self.sink)
+        self.stats['merge_time'] = time.time () - prev
+        return self.finish (interpreter, result)
+
+    def finish (self, interpreter, result):
         interpreter.context.set('result', result)
         """ Execute set statements associated with this statement. """
         for set_statement in self.set_statements:
-            logger.debug (f"{set_statement}")
+            logger.debug ("%s", set_statement)
             set_statement.execute (interpreter, context = { "result" : result })
         return result
 
     def execute_plan (self, interpreter):
         """ Execute a query using a schema based query planning strategy. """
-        self.service = ''
-        plan = self.planner.plan (self.query)
-        statements = self.plan (plan)
+        statements = self.plan_statements ()
         responses = []
-        first_concept = None
         for index, statement in enumerate(statements):
-            logger.debug (f" -- {statement.query}")
+            logger.debug (" -- %s", statement.query)
             response = statement.execute (interpreter)
             responses.append (response)
-            if index < len(statements) - 1:
-                """ Implement handoff. Finds the type name of the first element of the
-                next plan segment, looks up values for that type from the answer bindings of the
-                last response, and transfers values to the new question. TODO: incorporate
-                user specified namnes. """
-                next_statement = statements[index+1]
-                name = next_statement.query.order [0]
-                #name = statement.query.order[-1]
-                #values = self.jsonkit.select (f"$.knowledge_map.[*].node_bindings.{name}", response)
-                # logger.error (f"querying $.knowledge_map.[*].[*].node_bindings.{name} from {json.dumps(response, indent=2)}")
-                values = self.jsonkit.select (f"$.knowledge_map.[*].[*].node_bindings.{name}", response)
-                first_concept = next_statement.query.concepts[name]
-                if statements[index].query.order == next_statement.query.order:
-                    first_concept.set_nodes (statements[index].query.concepts[name].nodes)
-                else:
-                    first_concept.set_nodes (values)
-                    if len(values) == 0:
-                        message = f"No valid results from service {statement.service} executing " + \
-                                  f"query {statement.query}. Unable to continue query. Exiting."
-                        raise ServiceInvocationError (
-                            message = message,
-                            details = Text.short (obj=f"{json.dumps(response, indent=2)}", limit=1000))
-        merged = self.merge_results (responses, self.service, interpreter)
+            self.handoff (interpreter, statements, index, response)
+        return self.finish (interpreter, self.merge_plan (interpreter, statements, responses))
+
+    async def execute_plan_async (self, interpreter):
+        """ Execute a planned query, awaiting each segment in turn. """
+        statements = self.plan_statements ()
+        responses = []
+        for index, statement in enumerate(statements):
+            logger.debug (" -- %s", statement.query)
+            response = await statement.execute_async (interpreter)
+            responses.append (response)
+            self.handoff (interpreter, statements, index, response)
+        return self.finish (interpreter, await run_blocking (self.merge_plan, interpreter, statements, responses))
+
+    def plan_statements (self):
+        """ Plan the query and build a select statement per plan segment. """
+        self.service = ''
+        with span ("plan"):
+            plan = self.planner.plan (self.query)
+            return self.plan (plan)
+
+    def handoff (self, interpreter, statements, index, response):
+        """ Implement handoff. Finds the type name of the first element of the
+        next plan segment, looks up values for that type from the answer bindings of the
+        last response, and transfers values to the new question. TODO: incorporate
+        user specified namnes. """
+        if index >= len(statements) - 1:
+            return
+        statement = statements[index]
+        next_statement = statements[index+1]
+        name = next_statement.query.order [0]
+        #name = statement.query.order[-1]
+        #values = self.jsonkit.select (f"$.knowledge_map.[*].node_bindings.{name}", response)
+        # logger.error (f"querying $.knowledge_map.[*].[*].node_bindings.{name} from {json.dumps(response, indent=2)}")
+        values = bindings (response.get ('knowledge_map') or [], name)
+        first_concept = next_statement.query.concepts[name]
+        if statement.query.order == next_statement.query.order:
+            first_concept.set_nodes (statement.query.concepts[name].nodes)
+        else:
+            """ Drop values $id_filters excludes now, so a handoff of only excluded values stops here. """
+            values = next_statement.id_filter (interpreter).filter (
+                values, curie=lambda v: v if isinstance (v, str) else None)
+            first_concept.set_nodes (values)
+            if len(values) == 0:
+                message = f"No valid results from service {statement.service} executing " + \
+                          f"query {statement.query}. Unable to continue query. Exiting."
+                raise ServiceInvocationError (
+                    message = message,
+                    details = Text.short (obj=f"{json.dumps(response, indent=2)}", limit=1000))
+        statement.stats['handoff_cardinality'] = len(first_concept.nodes)
+
+    def merge_plan (self, interpreter, statements, responses):
+        """ Merge the responses of all plan segments. """
+        prev = time.time ()
+        with span ("merge", responses=len(responses)):
+            merged = self.merge_results (responses, self.service, interpreter, sink=self.sink)
+        self.stats = {
+            "service" : self.service,
+            "segments" : [ statement.stats for statement in statements ],
+            "merge_time" : time.time () - prev
+        }
         questions = self.generate_questions (interpreter)
         merged['question_graph'] = questions[0]['question_graph']
         return merged
 
-    def merge_results (self, responses, service, interpreter):
-        """ Merge results. """
+    def merge_results (self, responses, service, interpreter, sink=None):
+        """ Merge results. If a sink is given, pass it each node, edge and knowledge map entry as it is merged.
+        Unless set statements need them, the sink then has them alone: the result holds the rest of the message. """
+        if len(responses) > 0 and not 'knowledge_graph' in responses[0]:
+            message = "Malformed response does not contain knowledge_graph element."
+            logger.error ("%s svce: %s: %s", message, service, LazyJSON (responses[0]))
+            raise MalformedResponseError (message)
 
         """
-        If True, SelectStatement::resolve_name (and therefore the Bionames API) will be called on every node that does not already possess the `equivalent_identifiers` property.
-        As of now, this feature should be left disabled as it results in large queries failing due to the flooding of the Bionames API. Additionally, the Bionames class does not use async requests as of now, so it is also quite slow.
+        If resolve_names is set, nodes lacking equivalent_identifiers get those of their names,
+        so nodes of different responses that are the same concept merge into one.
         """
-        RESOLVE_EQUIVALENT_IDENTIFIERS = interpreter.resolve_names
-
-        result = responses[0] if len(responses) > 0 else None
-        if result == None:
-            return {
-                "knowledge_graph": {
-                    "nodes": [],
-                    "edges": []
-                },
-                "knowledge_map": []
-            }
-        if not 'knowledge_graph' in result:
-            message = "Malformed response does not contain knowledge_graph element."
-            logger.error (f"{message} svce: {service}: {json.dumps(result, indent=2)}")
-            raise MalformedResponseError (message)
-        kg = result['knowledge_graph']
-        #answers = result['answers']
-        answers = result['knowledge_map']
+        if interpreter.resolve_names:
+            self.resolve_equivalent_identifiers (interpreter, responses)
+        merger = KnowledgeGraphMerger (sink=sink, synonyms=interpreter.synonyms,
+                                       keep=sink is None or len(self.set_statements) > 0)
+        for response in responses:
+            merger.add (response)
+        observe_merge (merger.merged['node'], merger.merged['edge'])
+        return merger.result ()
 
-        node_map = { n['id'] : n for n in kg.get('nodes',[]) }
+class ExplainStatement(Statement):
+    """
+    Describe the plan for a select statement without executing it. With ANALYZE, execute
+    the statement and annotate each plan segment with what actually happened.
+    """
+    __slots__ = ('select', 'analyze')
 
-        replace_edge_ids = []
-        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-            logger.info ('Starting to fetch equivalent identifiers')
-        total_requests = 0
-        prev_time = time.time()
-        for response in responses:
-            if 'knowledge_graph' in response:
-                for node in response['knowledge_graph'].get('nodes',[]):
-                    if 'equivalent_identifiers' not in node:
-                        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-                            ids = self.resolve_name (node.get('name',None), node.get('type',''))
-                        else:
-                            ids = [node['id']]
-                        node['equivalent_identifiers'] = ids
-                        total_requests += 1
-        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-            logger.info (f'Finished fetching equivalent identifiers for {total_requests} nodes ({time.time()-prev_time}s).')
-
-        # TODO: This probably needs a rewrite. It should just construct an empty Message object and then iterate over the entire list of repsonses normally, rather than having to start with the first and using that as the starting Message object.
-        for response in responses[1:]:
-            #logger.error (f"   -- Response message: {json.dumps(result, indent=2)}")
-            # TODO: Preserve reasoner provenance. This treats nodes as equal if
-            # their ids are equal. Consider merging provenance/properties.
-            # Edges, we may keep distinct and whole or merge to some tbd extent.
-            if 'knowledge_graph' in response:
-                rkg = response['knowledge_graph']
-                other_edges = rkg['edges'] if 'edges' in rkg else []
-                for e in other_edges:
-                    exists = False
-                    for edge in kg['edges']:
-                        edge_type = edge.get('type',None)
-                        e_type = e.get('type',None)
-                        if edge_type == e_type and edge['source_id'] == e['source_id'] and edge['target_id'] == e['target_id']:
-                            exists = True
-                            break
-                    if not exists:
-                        kg['edges'].append (e)
-                #result['answers'] += response['answers']
-                result['knowledge_map'] += response['knowledge_map']
-                other_nodes = rkg['nodes'] if 'nodes' in rkg else []
-                for n in other_nodes:
-                    """
-                    If possible, try to convert all nodes to a single identifier so that we don't end up with multiple separate nodes that are actually the same in the graph.
-                    Example: https://i.imgur.com/Z76R1wZ.png. The node on left is called "citric acid," and the node on right is called "anhydrous citric acid." The left node's id is "CHEBI:30769" and the right node's id is "CHEMBL:CHEMBL1261." These identifiers are actually equivalent to each other.
-                    """
-                    ids = n['equivalent_identifiers']
-                    exists = False
-                    for id in ids:
-                        for node_id in node_map:
-                            node = node_map[node_id]
-                            if id == node_id or id in node['equivalent_identifiers']:
-                                exists = True
-                                break
-                        if exists:
-                            replace_edge_ids.append([n["id"], node["id"]])
-                            break
-                    if not exists:
-                        node_map[n['id']] = n
-                        kg['nodes'].append (n)
-        # We need to update the edges' ids if we changed any node ids.
-        for old_id, new_id in replace_edge_ids:
-            for edge in result['knowledge_graph'].get('edges',[]):
-                if old_id == edge['source_id']:
-                    edge['source_id'] = new_id
-                if old_id == edge['target_id']:
-                    edge['target_id'] = new_id
+    def __init__(self, select, analyze=False):
+        """ Explain a select statement. """
+        self.select = select
+        self.analyze = analyze
+
+    def __repr__(self):
+        return f"EXPLAIN{' ANALYZE' if self.analyze else ''} {self.select}"
+
+    def describe_concept (self, concept):
+        """ Render a concept in the query syntax. """
+        return concept.type_name if concept.name == concept.type_name else \
+            f"{concept.name}:{concept.type_name}"
+
+    def describe_step (self, source, predicate, target):
+        """ Render a transition in the query syntax. """
+        arrow = predicate.direction
+        if predicate.predicate is not None:
+            arrow = f"-[{predicate.predicate}]->" if predicate.direction == Query.forward_arrow \
+                    else f"<-[{predicate.predicate}]-"
+        return f"{self.describe_concept (source)}{arrow}{self.describe_concept (target)}"
+
+    def estimate_questions (self, interpreter, concepts):
+        """ Questions are permutations of concept bindings. Estimate their number. """
+        estimate = 1
+        for concept in concepts:
+            count = self.select.count_bindings (interpreter, concept)
+            if count is None:
+                return None
+            estimate = estimate * count
+        return estimate
+
+    def describe_segment (self, interpreter, schema, url, concepts, steps, bound=True):
+        """ Describe a plan segment. If its first concept is bound by handoff, the number of
+        questions it will generate is not known until execution. """
+        estimate = self.estimate_questions (interpreter, concepts) if bound else None
+        return {
+            "schema" : schema,
+            "service" : self.select.resolve_backplane_url (url, interpreter),
+            "implicit_conversion" : schema == "implicit_conversion",
+            "steps" : steps,
+            "estimated_questions" : estimate,
+            "estimated_requests" : min(estimate, self.select.maximum_query_requests) \
+                                   if estimate is not None else None
+        }
+
+    def execute (self, interpreter, context={}):
+        """ Plan the select statement and, for ANALYZE, execute it. """
+        result = self.describe (interpreter)
+        if self.analyze:
+            start = time.time ()
+            self.select.execute (interpreter)
+            self.annotate (result, start)
+        return self.report (interpreter, result)
+
+    async def execute_async (self, interpreter):
+        result = self.describe (interpreter)
+        if self.analyze:
+            start = time.time ()
+            await self.select.execute_async (interpreter)
+            self.annotate (result, start)
+        return self.report (interpreter, result)
+
+    def describe (self, interpreter):
+        """ Describe the plan of the select statement. """
+        select = self.select
+        if select.service == "/schema":
+            plan = select.planner.plan (select.query)
+            segments = []
+            for index, phase in enumerate(plan):
+                schema, url, steps = phase
+                """ Parallel segments over the same concepts share their bindings. """
+                bound = index == 0 or \
+                        [ s[0].name for s in plan[index-1][2] ] == [ s[0].name for s in steps ]
+                segments.append (self.describe_segment (
+                    interpreter, schema, url,
+                    concepts = [ steps[0][0] ] + [ step[2] for step in steps ],
+                    steps = [ self.describe_step (*step) for step in steps ],
+                    bound = bound))
+        else:
+            query = select.query
+            concepts = [ query.concepts[name] for name in query.order ]
+            steps = [
+                self.describe_step (concept, query.arrows[index], concepts[index+1])
+                for index, concept in enumerate(concepts[:-1])
+            ]
+            segments = [ self.describe_segment (
+                interpreter, None, select.service,
+                concepts = concepts,
+                steps = steps if len(steps) > 0 else [ self.describe_concept (c) for c in concepts ]) ]
+        result = {
+            "statement" : str(select),
+            "analyze" : self.analyze,
+            "question_limit" : select.maximum_query_requests,
+            "segments" : segments,
+            "implicit_conversions" : [
+                {
+                    "service" : segment['service'],
+                    "steps" : segment['steps']
+                }
+                for segment in segments if segment['implicit_conversion']
+            ]
+        }
         return result
 
+    def annotate (self, result, start):
+        """ Annotate a plan description with what happened when the select statement ran. """
+        result['elapsed'] = time.time () - start
+        stats = self.select.stats
+        actual = stats['segments'] if 'segments' in stats else [ stats ]
+        for segment, segment_stats in zip (result['segments'], actual):
+            segment['actual'] = segment_stats
+        result['merge_time'] = stats.get ('merge_time')
+
+    def report (self, interpreter, result):
+        report = { "plan" : result }
+        interpreter.context.set ('result', report)
+        return report
+
 class TranQL_AST:
     """Represent the abstract syntax tree representing the logical structure of a parsed program."""
 
     def __init__(self, parse_tree, backplane):
-        logger.debug (f"{json.dumps(parse_tree, indent=2)}")
+        logger.debug ("%s", LazyJSON (parse_tree))
         """ Create an abstract syntax tree from the parser token stream. """
-        self.schema = Schema (backplane=backplane)
+        with span ("schema.load"):
+            self.schema = Schema.shared (backplane)
         self.backplane = backplane
+        self.planner = QueryPlanStrategy (backplane, schema=self.schema)
         self.statements = []
         self.parse_tree = parse_tree
-        logger.debug (f"{json.dumps(self.parse_tree, indent=2)}")
         for index, element in enumerate(self.parse_tree):
             if isinstance (element, list):
                 statement = self.remove_whitespace (element, also=["->"])
@@ -663,6 +917,8 @@ class TranQL_AST:
                         self.statements.append (SetStatement (
                             variable = element[1],
                             value = element[3]))
+                elif element[0] == 'explain':
+                    self.parse_explain (element)
                 elif isinstance(element[0], list):
                     statement = self.remove_whitespace (element[0], also=["->"])
                     command = statement[0]
@@ -679,7 +935,7 @@ class TranQL_AST:
                 graph = element[0][2],
                 service = element[1][1],
                 name = element[2][1]))
-        logger.debug (f"--parse_create(): {self.statements[-1]}")
+        logger.debug ("--parse_create(): %s", self.statements[-1])
 
     def remove_whitespace (self, group, also=[]):
         """
@@ -690,6 +946,15 @@ class TranQL_AST:
                  if not isinstance(x, str) or
                  (not x.isspace () and not x in also) ]
 
+    def parse_explain (self, element):
+        """ Parse an explain statement wrapping a select statement. """
+        element = self.remove_whitespace (element)
+        analyze = element[1] == 'analyze'
+        self.parse_select (element[-1])
+        self.statements.append (ExplainStatement (
+            select = self.statements.pop (),
+            analyze = analyze))
+
     def parse_select (self, statement):
         """ Parse a select statement. """
         select = SelectStatement (ast=self)
@@ -736,6 +1001,8 @@ class TranQL_AST:
         return json.dumps(self.parse_tree)
 
 class Edge:
+    __slots__ = ('direction', 'predicate')
+
     def __init__(self, direction, predicate=None):
         self.direction = direction
         self.predicate = predicate
@@ -757,6 +1024,8 @@ class Query:
     """ The biolink model. Will use for query validation. """
     concept_model = ConceptModel ("biolink-model")
 
+    __slots__ = ('order', 'arrows', 'concepts', 'disable', 'errors')
+
     def __init__(self):
         self.order = []
         self.arrows = []
@@ -827,15 +1096,18 @@ class QueryPlan:
 class QueryPlanStrategy:
     """ A strategy for developing a query plan given a schema. """
 
-    def __init__(self, backplane):
-        """ Construct a query strategy, specifying the schema. """
-        self.schema = Schema (backplane)
+    def __init__(self, backplane, schema=None):
+        """ Construct a query strategy, specifying the schema. Without one, the shared schema of the backplane is used. """
+        if schema is None:
+            with span ("schema.load"):
+                schema = Schema.shared (backplane)
+        self.schema = schema
 
     def plan (self, query):
         """
         Plan a query over the configured sources and their associated schemas.
         """
-        logger.debug (f"--planning query: {query}")
+        logger.debug ("--planning query: %s", query)
         plan = []
         for index, element_name in enumerate(query.order):
             if index == len(query.order) - 1:
@@ -846,7 +1118,7 @@ class QueryPlanStrategy:
                 source=query.concepts[element_name],
                 target=query.concepts[query.order[index+1]],
                 predicate=query.arrows[index])
-        logger.debug (f"--created plan {plan}")
+        logger.debug ("--created plan %s", plan)
         return plan
 
     def plan_edge (self, plan, source, target, predicate):
@@ -861,7 +1133,7 @@ class QueryPlanStrategy:
             sub_schema = sub_schema_package ['schema']
             sub_schema_url = sub_schema_package ['url']
             if source.type_name in sub_schema:
-                logger.debug (f"  --{schema_name} - {source.type_name} => {target.type_name}")
+                logger.debug ("  --%s - %s => %s", schema_name, source.type_name, target.type_name)
                 if target.type_name in sub_schema[source.type_name]:
                     """ Matching path. Write it to the plan. """
                     top_schema = None
@@ -883,7 +1155,7 @@ class QueryPlanStrategy:
                     implicit_conversion_schema = "implicit_conversion"
                     implicit_conversion_url = self.schema.schema[implicit_conversion_schema]['url']
                     if conv_type in sub_schema:
-                        logger.debug (f"  --impconv: {schema_name} - {conv_type} => {target.type_name}")
+                        logger.debug ("  --impconv: %s - %s => %s", schema_name, conv_type, target.type_name)
                         if target.type_name in sub_schema[conv_type]:
                             plan.append ([
                                 implicit_conversion_schema,
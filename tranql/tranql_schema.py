@@ -5,10 +5,17 @@ import logging
 import requests
 import requests_cache
 import os
+import threading
+import time
+import concurrent.futures
 from tranql.concept import BiolinkModelWalker
 from collections import defaultdict
 from tranql.exception import TranQLException, InvalidTransitionException
+from tranql.metrics import observe_cache
 from tranql.redis_graph import RedisGraph
+from tranql.util import LazyJSON
+
+logger = logging.getLogger (__name__)
 
 class NetworkxGraph:
     def __init__(self):
@@ -84,6 +91,57 @@ class GraphTranslator:
 class Schema:
     """ A schema for a distributed knowledge network. """
 
+    """ Schemas shared by interpreters, by backplane, with the time each was loaded. """
+    _shared = {}
+    _shared_lock = threading.Lock ()
+
+    """ Loads of shared schemas in progress, by backplane. """
+    _loading = {}
+
+    """ Seconds a shared schema is used before it is loaded again. """
+    shared_ttl = 60 * 60
+
+    @classmethod
+    def shared (cls, backplane):
+        """ A schema for the backplane, built on first use and shared until it expires. Schemas that
+        failed to load part of the network are not kept, so the next caller tries again. Callers must
+        treat shared schemas as read only.
+
+        A schema is loaded outside the lock, once: callers arriving during a load wait for it, or
+        use the expired schema if there is one, so a slow upstream only holds up callers of its
+        backplane that have nothing to use. """
+        with cls._shared_lock:
+            entry = cls._shared.get (backplane)
+            if entry is not None and time.time () - entry[0] < cls.shared_ttl:
+                return entry[1]
+            loading = cls._loading.get (backplane)
+            owner = loading is None
+            if owner:
+                loading = cls._loading[backplane] = concurrent.futures.Future ()
+            elif entry is not None:
+                return entry[1]
+        if not owner:
+            return loading.result ()
+        try:
+            schema = cls (backplane)
+        except BaseException as e:
+            with cls._shared_lock:
+                del cls._loading[backplane]
+            loading.set_exception (e)
+            raise
+        with cls._shared_lock:
+            if len(schema.loadErrors) == 0:
+                cls._shared[backplane] = (time.time (), schema)
+            del cls._loading[backplane]
+        loading.set_result (schema)
+        return schema
+
+    @classmethod
+    def clear_shared (cls):
+        """ Forget shared schemas so they are reloaded. """
+        with cls._shared_lock:
+            cls._shared.clear ()
+
     def __init__(self, backplane):
         """
         Create a metadata map of the knowledge network.
@@ -107,6 +165,7 @@ class Schema:
                 # If schema_data is a URL
                 try:
                     response = requests.get (schema_data)
+                    observe_cache ("meta_cache", response)
                     schema_data = response.json()
                 except requests.exceptions.RequestException as e:
                     # If the request errors for any number of reasons (likely a timeout), append an error message
@@ -168,7 +227,7 @@ class Schema:
             sub_schema_url = sub_schema_package ['url']
             #print (sub_schema)
             if source_type in sub_schema:
-                print (f"  --{schema_name} - {source_type} => {target_type}")
+                logger.debug ("  --%s - %s => %s", schema_name, source_type, target_type)
                 if target_type in sub_schema[source_type]:
                     top_schema = None
                     if len(plan) > 0:
@@ -191,7 +250,7 @@ class Schema:
                     implicit_conversion_schema = "implicit_conversion"
                     implicit_conversion_url = self.schema[implicit_conversion_schema]['url']
                     if conv_type in sub_schema:
-                        print (f"  --impconv: {schema_name} - {conv_type} => {target_type}")
+                        logger.debug ("  --impconv: %s - %s => %s", schema_name, conv_type, target_type)
                         if target_type in sub_schema[conv_type]:
                             plan.append ([
                                 implicit_conversion_schema,
@@ -217,7 +276,7 @@ class Schema:
                  transition
         Start with: Linear paths; no predicates.
         """
-        print (query)
+        logger.debug ("%s", query)
         plan = []
         #plan = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
         for index, element_name in enumerate(query.order):
@@ -232,7 +291,7 @@ class Schema:
                 target_type=query.concepts[query.order[index+1]].name,
                 predicate=query.arrows[index].predicate,
                 edge_direction=query.arrows[index].direction)
-        print (f"----------> {json.dumps(plan, indent=2)}")
+        logger.debug ("----------> %s", LazyJSON (plan))
         return plan
 
     def get_node (self, node_id, attrs={}):
@@ -271,7 +330,7 @@ class Schema:
             source = nodes[edge['source_id']]['type']
             target = nodes[edge['target_id']]['type']
             self.validate_edge (source, target)
-            print (f"  -- valid transition: {source}->{target}")
+            logger.debug ("  -- valid transition: %s->%s", source, target)
 
 def get_test_kg (file_name):
     path = "https://raw.githubusercontent.com/NCATS-Tangerine/NCATS-ReasonerStdAPI-diff/master"
@@ -1,13 +1,20 @@
+import collections
 import copy
+import functools
 import logging
 import logging.config
 import importlib
+import itertools
 import json
+import math
 import traceback
 import unittest
 import datetime
 import os
 import re
+import sys
+import threading
+import time
 from collections import namedtuple
 from tranql.disease_vocab import DiseaseVocab
 from jinja2 import Template
@@ -167,13 +174,26 @@ class JSONKit:
 
 class Context:
     """ A trivial context implementation. """
+
+    """ Gene and disease names, loaded once and shared, read only, beneath each context's variables. """
+    _vocabulary = None
+    _vocabulary_lock = threading.Lock ()
+
     def __init__(self):
-        self.mem = {
-        }
+        self.mem = collections.ChainMap ({}, Context.vocabulary ())
         self.jk = JSONKit ()
-        generate_gene_vocab (self)
-        #generate_disease_vocab (self)
-        DiseaseVocab (self)
+
+    @classmethod
+    def vocabulary (cls):
+        with cls._vocabulary_lock:
+            if cls._vocabulary is None:
+                vocabulary = Context.__new__ (Context)
+                vocabulary.mem = {}
+                generate_gene_vocab (vocabulary)
+                #generate_disease_vocab (vocabulary)
+                DiseaseVocab (vocabulary)
+                cls._vocabulary = vocabulary.mem
+        return cls._vocabulary
 
     '''
     def resolve_arg(self, val):
@@ -194,29 +214,34 @@ class Context:
             return self.jk.select (query, self.mem[key])
         
     def top (self, type_name, k='result', n=10, start=-1):
+        """
+        The heaviest edges of a message to nodes of a type, as rows of source name and id, edge type,
+        target name and id, weight and publications. Skips the first start - 1 of them.
+        """
         obj = self.mem[k] if k in self.mem else None
         result = []
         count = 0
         if obj:
-            nodes = obj['knowledge_graph']['nodes']
-            id2node = { n['id'] : n for n in nodes }
-            edges = obj['knowledge_graph']['edges']
-            sorted_edges = sorted(edges,
-                                  key=lambda e: e['weight'],
-                                  reverse=True)
-            for e in sorted_edges:
-                target = id2node [e['target_id']]
-                source = id2node [e['source_id']]
-                node_type = target['type']
+            kg = obj.get ('knowledge_graph') or {}
+            id2node = { n['id'] : n for n in kg.get ('nodes', []) }
+            def weight (edge):
+                weight = edge.get ('weight')
+                return weight if isinstance (weight, (int, float)) and not isinstance (weight, bool) else -math.inf
+            for e in sorted (kg.get ('edges', []), key=weight, reverse=True):
+                source = id2node.get (e['source_id'])
+                target = id2node.get (e['target_id'])
+                if source is None or target is None:
+                    continue
+                node_type = target.get ('type')
                 if node_type == type_name or (isinstance(node_type, list) and type_name in node_type):
                     count = count + 1
                     if count < start:
                         continue
                     result.append ([
-                        source['name'], source['id'],
-                        e['type'],
-                        target['name'], target['id'],
-                        round(e['weight'], 2), e['publications']
+                        source.get ('name'), source['id'],
+                        e.get ('type'),
+                        target.get ('name'), target['id'],
+                        round(e.get ('weight', math.nan), 2), e.get ('publications', [])
                     ])
                     if len(result) == n:
                         break
@@ -246,43 +271,202 @@ class Context:
         ipd.display(ipd.HTML(result))
         #return result
     
+class PatternMatcher:
+    """
+    Match identifiers against a set of case insensitive regular expressions, any of which may match.
+
+    Plain text patterns (eg CHEBI:) are tested as substrings, and anchored plain text patterns
+    (eg ^CHEBI:) as prefixes, of the lower cased identifier. The rest are combined into a single
+    alternation compiled once.
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        prefixes = []
+        substrings = []
+        expressions = []
+        for pattern in patterns:
+            if pattern.startswith ('^') and re.escape (pattern[1:]) == pattern[1:]:
+                prefixes.append (pattern[1:].lower ())
+            elif re.escape (pattern) == pattern:
+                substrings.append (pattern.lower ())
+            else:
+                expressions.append (pattern)
+        self.prefixes = tuple (prefixes)
+        self.substrings = tuple (substrings)
+        self.expressions = []
+        if expressions:
+            try:
+                self.expressions = [ re.compile ('|'.join ([ f"(?:{e})" for e in expressions ]), re.IGNORECASE) ]
+            except re.error:
+                """ Patterns that can't be combined (eg numbered backreferences) are compiled one by one. """
+                self.expressions = [ re.compile (e, re.IGNORECASE) for e in expressions ]
+
+    def __bool__(self):
+        return len(self.patterns) > 0
+
+    def matches (self, identifier):
+        if self.prefixes or self.substrings:
+            lowered = identifier.lower ()
+            if self.prefixes and lowered.startswith (self.prefixes):
+                return True
+            for substring in self.substrings:
+                if substring in lowered:
+                    return True
+        for expression in self.expressions:
+            if expression.search (identifier) is not None:
+                return True
+        return False
+
+    @staticmethod
+    @functools.lru_cache (maxsize=1024)
+    def compile (patterns):
+        """ The matcher of a tuple of patterns, built once per distinct tuple. """
+        return PatternMatcher (patterns)
+
+@functools.lru_cache (maxsize=100000)
+def curie_prefix (curie):
+    """ The lower cased, interned prefix of a curie: the text before its first colon. """
+    return sys.intern (curie.partition (':')[0].lower ())
+
+class CuriePrefixFilter:
+    """
+    Exclude curies by prefix, as the $id_filters variable asks: a comma separated list of
+    prefixes, eg "chembl,mesh". Matching ignores case.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.prefixes = frozenset ([ p.strip ().lower () for p in (spec or '').split (',') if p.strip () ])
+
+    def __bool__(self):
+        return len(self.prefixes) > 0
+
+    def excludes (self, curie):
+        return curie_prefix (curie or '') in self.prefixes
+
+    def filter (self, values, curie=lambda v: v):
+        """ The values whose curies (as curie extracts them) are not excluded. """
+        if not self.prefixes:
+            return list(values)
+        prefixes = self.prefixes
+        return [ v for v in values if curie_prefix (curie (v) or '') not in prefixes ]
+
+    @staticmethod
+    @functools.lru_cache (maxsize=128)
+    def compile (spec):
+        """ The filter of an $id_filters value, built once per distinct value. """
+        return CuriePrefixFilter (spec)
+
 class Concept:
-    def __init__(self, name, type_name, include_patterns = [], exclude_patterns = []):
+    __slots__ = ('name', 'type_name', 'nodes', 'include_patterns', 'exclude_patterns')
+
+    def __init__(self, name, type_name, include_patterns = None, exclude_patterns = None):
         self.name = name
         self.type_name = type_name
         self.nodes = []
-        self.include_patterns = include_patterns
-        self.exclude_patterns = exclude_patterns
+        self.include_patterns = include_patterns if include_patterns is not None else []
+        self.exclude_patterns = exclude_patterns if exclude_patterns is not None else []
     def __repr__(self):
         return f"{self.name}:{self.nodes}"
     def set_exclude_patterns (self, patterns):
         self.exclude_patterns = patterns
     def filter_nodes (self, nodes):
-        final_list = []
-        for n in nodes:
-            exclude = False
-            for pat in self.exclude_patterns:
-                identifier = n if isinstance(n, str) else n['id']
-                matches = re.search (pat, identifier, re.IGNORECASE)
-                if matches is not None:
-                    exclude = True
-                    break
-            include = not len(self.include_patterns) > 0 
-            for pat in self.include_patterns:
-                identifier = n if isinstance(n, str) else n['id']
-                matches = re.search (pat, identifier, re.IGNORECASE)
-                if matches is not None:
-                    include = True
-                    break
-            if include and not exclude:
-                final_list.append (n)
-        return final_list
+        """ Keep the nodes (identifiers, or dicts with an id) matching an include pattern, if there are any,
+        and no exclude pattern. Patterns are compiled once; without patterns nodes are not examined. """
+        include = PatternMatcher.compile (tuple (self.include_patterns))
+        exclude = PatternMatcher.compile (tuple (self.exclude_patterns))
+        if not include and not exclude:
+            return list(nodes)
+        identifiers = [ n if isinstance(n, str) else n['id'] for n in nodes ]
+        keep = [ True ] * len(identifiers)
+        if include:
+            keep = [ include.matches (i) for i in identifiers ]
+        if exclude:
+            keep = [ k and not exclude.matches (i) for k, i in zip (keep, identifiers) ]
+        return [ n for n, k in zip (nodes, keep) if k ]
     def set_nodes (self, nodes):
         self.nodes = self.filter_nodes (nodes)
     def apply_filters (self):
         nodes = self.filter_nodes (self.nodes)
         self.nodes = nodes
 
+class ExpiringCache:
+    """
+    A thread safe map whose entries expire ttl seconds after they are stored. Lookups are counted under name.
+
+    Expired entries are dropped as entries are stored, at least once every ttl seconds. With a limit,
+    the oldest entries are dropped too when there are that many, so the map can't grow without bound.
+    """
+    def __init__(self, name, ttl, limit=None, observe=None):
+        """
+        :param observe: Called with the name and whether it hit on each lookup, eg metrics.observe_cache_lookup.
+        """
+        self.name = name
+        self.ttl = ttl
+        self.limit = limit
+        self.observe = observe
+        self.entries = {}
+        self.lock = threading.Lock ()
+        self.next_sweep = time.time () + ttl
+
+    def peek (self, key):
+        """ The live value of a key, or None, without counting the lookup. """
+        entry = self.entries.get (key)
+        if entry is not None and time.time () - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def get (self, key):
+        value = self.peek (key)
+        if self.observe is not None:
+            self.observe (self.name, value is not None)
+        return value
+
+    def put (self, key, value):
+        now = time.time ()
+        with self.lock:
+            # Keep entries in the order they were stored, oldest first.
+            self.entries.pop (key, None)
+            if now >= self.next_sweep or (self.limit is not None and len(self.entries) >= self.limit):
+                self.sweep (now)
+            self.entries[key] = (now, value)
+        return value
+
+    def sweep (self, now):
+        """ Drop expired entries and, past the limit, the oldest quarter of the rest. Call holding the lock. """
+        self.entries = { k : entry for k, entry in self.entries.items () if now - entry[0] < self.ttl }
+        if self.limit is not None and len(self.entries) >= self.limit:
+            for key in list (itertools.islice (self.entries, len(self.entries) - self.limit * 3 // 4)):
+                del self.entries[key]
+        self.next_sweep = now + self.ttl
+
+    def clear (self):
+        with self.lock:
+            self.entries.clear ()
+
+class Stats:
+    """ Descriptive statistics over a list of samples. """
+
+    @staticmethod
+    def percentile (values, p):
+        """ Nearest rank percentile of a list of values. """
+        if len(values) == 0:
+            return None
+        ordered = sorted (values)
+        rank = max (0, min (len(ordered) - 1, math.ceil (p / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+    @staticmethod
+    def summarize (values, points=[ 50, 90, 99 ]):
+        """ Summarize a distribution as count, min, max and selected percentiles. """
+        result = {
+            "count" : len(values),
+            "min"   : min(values) if len(values) > 0 else None,
+            "max"   : max(values) if len(values) > 0 else None
+        }
+        for p in points:
+            result[f"p{p}"] = Stats.percentile (values, p)
+        return result
+
 class Text:
     """ Utilities for processing text. """
 
@@ -299,6 +483,30 @@ class Text:
         text = str(obj) if obj else None
         return (text[:min(len(text),limit)] + ('...' if len(text)>limit else '')) if text else None
         
+class Lazy:
+    """
+    Defer building a log message argument until a handler formats the record.
+
+    Pass instances as logger arguments rather than formatting them into the message:
+        logger.debug ("request(%s)> %s", url, LazyJSON (message))
+    When the level is disabled the logger never calls __str__, so nothing is built. Output
+    longer than limit characters is truncated.
+    """
+    def __init__(self, build, limit=10000):
+        self.build = build
+        self.limit = limit
+    def __str__(self):
+        text = str(self.build ())
+        if self.limit and len(text) > self.limit:
+            text = f"{text[:self.limit]}... ({len(text) - self.limit} more characters)"
+        return text
+    __repr__ = __str__
+
+class LazyJSON(Lazy):
+    """ Serialize an object as indented JSON only if the log record is emitted. """
+    def __init__(self, obj, limit=10000, indent=2):
+        super().__init__(lambda: json.dumps (obj, indent=indent, default=str), limit=limit)
+
 def generate_gene_vocab ():
     gene_map = {}
     with open('genes.txt', 'r') as stream: